@@ -0,0 +1,257 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - parallel sensor acquisition
+
+    Reads every sensor at the same time instead of one after another.
+    Each sensor gets its own long-lived worker thread, a deadline and a
+    retry budget, and every tick comes back as one timestamped Snapshot
+    with a status per sensor:
+
+        ok       value read within the deadline
+        error    every attempt raised (e.g. DHT11 invalid read)
+        timeout  the deadline passed before a value came back
+        busy     the previous read is still stuck, so it was not asked again
+
+    A stuck read only ties up its own worker; the rest of the tick carries
+    on. SimulatedSensor stands in for the hardware so tick latency can be
+    benchmarked without a Pi (run this file directly).
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import random
+import threading
+import time
+
+from collections import namedtuple
+
+from scheduler import monotonic, sleep_on, wait_on, wall_time
+
+
+class SensorError(Exception):
+    """ Raised by a read function for a bad read that is worth retrying """
+    pass
+
+
+SensorResult = namedtuple("SensorResult", "status value latency attempts")
+
+
+class Sensor(object):
+    """ A named read function with its deadline and retry budget """
+
+    def __init__(self, name, read, timeout=1.0, retries=0, retry_delay=0.0):
+        self.name = name
+        self.read = read
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+class Snapshot(object):
+    """ The result of one acquisition tick """
+
+    def __init__(self, timestamp, results, elapsed):
+        self.timestamp = timestamp
+        self.results = results
+        self.elapsed = elapsed
+
+    def ok(self, name):
+        result = self.results.get(name)
+        return result is not None and result.status == "ok"
+
+    def value(self, name, default=None):
+        if self.ok(name):
+            return self.results[name].value
+        return default
+
+    def status(self):
+        return dict((name, res.status) for name, res in self.results.items())
+
+
+class _Request(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result = None
+
+
+class _SensorWorker(threading.Thread):
+    """ Runs one sensor's reads, one request at a time """
+
+    def __init__(self, sensor, clock):
+        super(_SensorWorker, self).__init__(name="sensor-" + sensor.name)
+        self.daemon = True
+        self.sensor = sensor
+        self.clock = clock
+        self.request = None
+        self._wake = threading.Condition()
+
+    def busy(self):
+        return self.request is not None
+
+    def submit(self, request):
+        with self._wake:
+            self.request = request
+            self._wake.notify()
+
+    def run(self):
+        while True:
+            with self._wake:
+                while self.request is None:
+                    self._wake.wait()
+                request = self.request
+            request.result = self._read(request.deadline)
+            self.request = None
+            request.done.set()
+
+    def _read(self, deadline):
+        sensor = self.sensor
+        start = self.clock()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                value = sensor.read()
+                return SensorResult("ok", value, self.clock() - start, attempts)
+            except Exception:
+                if attempts > sensor.retries:
+                    break
+                if self.clock() + sensor.retry_delay >= deadline:
+                    break
+                if sensor.retry_delay:
+                    sleep_on(self.clock, sensor.retry_delay)
+        return SensorResult("error", None, self.clock() - start, attempts)
+
+
+class Acquisition(object):
+    """ Reads a set of Sensors in parallel, one Snapshot per call to read() """
+
+    def __init__(self, sensors, clock=monotonic):
+        self.clock = clock
+        self.sensors = list(sensors)
+        self.workers = {}
+        for sensor in self.sensors:
+            worker = _SensorWorker(sensor, clock)
+            worker.start()
+            self.workers[sensor.name] = worker
+
+    def read(self):
+        """ Read every sensor at once and wait for each up to its deadline """
+        timestamp = wall_time(self.clock)
+        start = self.clock()
+        pending = {}
+        results = {}
+        for sensor in self.sensors:
+            worker = self.workers[sensor.name]
+            if worker.busy():
+                results[sensor.name] = SensorResult("busy", None, 0.0, 0)
+                continue
+            request = _Request(start + sensor.timeout)
+            worker.submit(request)
+            pending[sensor.name] = request
+
+        for name, request in pending.items():
+            remaining = request.deadline - self.clock()
+            if remaining > 0:
+                wait_on(self.clock, request.done, remaining)
+            if request.done.is_set():
+                results[name] = request.result
+            else:
+                results[name] = SensorResult("timeout", None,
+                                             self.clock() - start, 0)
+
+        return Snapshot(timestamp, results, self.clock() - start)
+
+
+# ============================================================================
+# SIMULATED SENSORS
+# ============================================================================
+
+class SimulatedSensor(object):
+    """ Read function that sleeps like real hardware and sometimes fails
+
+    latency   typical seconds per read, plus up to 'jitter' extra
+    fail_rate chance a read raises SensorError (DHT11 invalid, bad CRC)
+    hang_rate chance a read blocks for 'hang' seconds
+    """
+
+    def __init__(self, value, latency=0.0, jitter=0.0, fail_rate=0.0,
+                 hang_rate=0.0, hang=10.0, seed=None):
+        self.value = value
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.random = random.Random(seed)
+
+    def __call__(self):
+        delay = self.latency + self.random.random() * self.jitter
+        if self.random.random() < self.hang_rate:
+            delay = self.hang
+        time.sleep(delay)
+        if self.random.random() < self.fail_rate:
+            raise SensorError("simulated bad read")
+        if callable(self.value):
+            return self.value()
+        return self.value
+
+
+def simulated_sensors(seed=None, hang_rate=0.0):
+    """ Sensors with latencies roughly like the real station's """
+    return [
+        Sensor("sense", SimulatedSensor(21.5, latency=0.015, jitter=0.005,
+                                        seed=seed), timeout=0.5),
+        Sensor("cpu", SimulatedSensor(48.0, latency=0.030, jitter=0.020,
+                                      seed=seed), timeout=0.5),
+        Sensor("w1", SimulatedSensor(20.9, latency=0.750, jitter=0.050,
+                                     fail_rate=0.05, hang_rate=hang_rate,
+                                     seed=seed),
+               timeout=2.0, retries=1),
+        Sensor("dht", SimulatedSensor((21.0, 45.0), latency=0.020,
+                                      jitter=0.010, fail_rate=0.3, seed=seed),
+               timeout=1.0, retries=3, retry_delay=0.1),
+    ]
+
+
+def bench(ticks=10):
+    """ Compare sequential vs parallel tick latency on simulated sensors """
+    sensors = simulated_sensors(seed=1)
+
+    start = monotonic()
+    for _ in range(ticks):
+        for sensor in sensors:
+            for _ in range(sensor.retries + 1):
+                try:
+                    sensor.read()
+                    break
+                except SensorError:
+                    time.sleep(sensor.retry_delay)
+    sequential = (monotonic() - start) / ticks
+
+    acq = Acquisition(simulated_sensors(seed=1))
+    statuses = {}
+    start = monotonic()
+    for _ in range(ticks):
+        snap = acq.read()
+        for name, status in snap.status().items():
+            statuses[(name, status)] = statuses.get((name, status), 0) + 1
+    parallel = (monotonic() - start) / ticks
+
+    print("sequential tick: {:.1f} ms".format(sequential * 1000.0))
+    print("parallel tick:   {:.1f} ms".format(parallel * 1000.0))
+    for key in sorted(statuses):
+        print("  {:<6} {:<8} {}".format(key[0], key[1], statuses[key]))
+
+    # one probe hangs: the tick is still bounded by its deadline
+    acq = Acquisition(simulated_sensors(seed=2, hang_rate=1.0))
+    snap = acq.read()
+    print("with a hung w1 probe: {:.1f} ms {}".format(
+        snap.elapsed * 1000.0, snap.status()))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,491 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - backfill Weather Underground from the local record
+
+    When the network or WU is down for longer than the upload queue
+    (uploader.py) holds, or the station ran with uploads off, WU is left
+    with a hole the station still has locally. This sends a time range
+    from the store (tsstore.py) or the old text logs (log_import.py) to
+    WU, each reading with the dateutc it was taken at, not "now".
+
+    Every reading is sent, as the live WU sink does by default, or thinned
+    with --compression deadband (compression.py), then sent over 'connections'
+    kept-alive connections, one per sender thread, at no more than 'rate'
+    requests a second between them. Failures are retried with backoff by
+    the uploader's rules; a reading WU rejects isn't retried.
+
+    Progress is checkpointed to a small SQLite file: every reading WU acked
+    or rejected is recorded by station and timestamp, so a run that was
+    interrupted, or a second run over an overlapping range, skips whatever
+    already went. The live uploader records its readings in the same
+    checkpoint (full_ws.py CHECKPOINT), and readings still waiting in its
+    queue are skipped as well (--queue), the uploader will send those.
+
+    The store is read as written; a store kept compressed (COMPRESS_STORE)
+    should be backfilled from the text logs instead.
+
+    usage: backfill.py --start "YYYY-MM-DD[ HH:MM]" [--end ...] [--store DIR |
+                       --logs log_weather-*.log] [--url URL] [--connections N]
+                       [--rate N] [--checkpoint FILE] [--queue FILE]
+           backfill.py bench
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+    from http.client import HTTPException
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlsplit
+except ImportError:
+    # Python 2
+    import Queue as queue
+    from httplib import HTTPException
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlsplit
+
+from compression import KINDS, WU_FIELDS, Compressor, default_channels
+from scheduler import monotonic
+from uploader import (REJECTED, SENT, WU_URL, Checkpoint, DiskQueue, WUConnection,
+                      taken_at, wu_params)
+
+# as in full_ws.py
+STORE_DIR = "/home/pi/pi_weather_station/Store/"
+UPLOAD_QUEUE = "/home/pi/pi_weather_station/wu_queue.db"
+CHECKPOINT = "/home/pi/pi_weather_station/backfill.db"
+# like COMPRESS_UPLOADS (off): every reading goes, or a compression.KINDS
+COMPRESSION = None
+# WU doesn't publish a limit; a day of minute readings still only takes
+# a few minutes at this rate
+RATE = 10.0  # requests per second
+CONNECTIONS = 4
+MAX_TRIES = 5
+# how many outcomes go into each checkpoint commit
+CHECKPOINT_EVERY = 100
+
+FAILED = "failed"
+
+
+def parse_time(text):
+    """ 'YYYY-MM-DD[ HH:MM[:SS]]' local time (like the logs) to epoch seconds """
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            when = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return time.mktime(when.timetuple())
+    raise ValueError("expected YYYY-MM-DD[ HH:MM[:SS]], got {!r}".format(text))
+
+
+def load(start=None, end=None, store=STORE_DIR, logs=None):
+    """ Readings with start <= ts < end (epoch seconds), in the store layout """
+    if logs:
+        import numpy as np
+        from log_import import load_logs
+        arrays = load_logs(logs)[0]
+        keep = np.ones(len(arrays["ts"]), bool)
+        if start is not None:
+            keep &= arrays["ts"] >= int(start * 1000000)
+        if end is not None:
+            keep &= arrays["ts"] < int(end * 1000000)
+        return dict((key, value[keep]) for key, value in arrays.items())
+    from tsstore import TSStore
+    return TSStore(store).read(start, end, fields=WU_FIELDS)
+
+
+def iter_records(arrays, fields=WU_FIELDS):
+    """ Records (records.py) from store-layout arrays, NaN as None """
+    columns = [(field, arrays[field]) for field in fields]
+    for i, ts in enumerate(arrays["ts"]):
+        record = {"ts": int(ts) / 1000000.0}
+        for field, column in columns:
+            value = float(column[i])
+            record[field] = None if value != value else value
+        yield record
+
+
+def _thinned(records, compressor):
+    for record in records:
+        for out in compressor.update(record):
+            yield out
+    for out in compressor.flush():
+        yield out
+
+
+def readings(arrays, station_id, station_key, compression=COMPRESSION, altitude=None):
+    """ (epoch second, WU parameters) for each reading worth sending, in order
+
+    altitude (metres) as in wu_params(), for sea-level pressure.
+    """
+    records = iter_records(arrays)
+    if compression is not None:
+        records = _thinned(records, Compressor(default_channels(compression, WU_FIELDS)))
+    for record in records:
+        params = wu_params(station_id, station_key, record["temp_f"],
+                           record["dew_pt_tec"], record["h_dht"], record["pressure"],
+                           when=datetime.datetime.utcfromtimestamp(record["ts"]),
+                           altitude=altitude)
+        # nothing but action, ID, PASSWORD and dateutc: no readings at all
+        if len(params) > 4:
+            yield int(record["ts"]), params
+
+
+def queued(path, station_id):
+    """ Epoch seconds of this station's readings waiting in an upload queue """
+    upload_queue = DiskQueue(path)
+    try:
+        items = upload_queue.peek(len(upload_queue))
+    finally:
+        upload_queue.close()
+    return set(taken_at(params) for _, params in items
+               if params.get("ID") == station_id)
+
+
+class RateLimiter(object):
+    """ Spaces calls from any number of threads at least 1/rate apart """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(self._next, now)
+            self._next = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BackfillStats(object):
+    """ Counts and timing for one backfill run """
+
+    def __init__(self):
+        self.sent = 0
+        self.rejected = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.seconds = 0.0
+
+    def records_per_second(self):
+        return (self.sent + self.rejected) / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return ("{} sent, {} rejected, {} failed, {} skipped, {} retries "
+                "in {:.2f} s, {:.1f} rec/s".format(
+                    self.sent, self.rejected, self.failed, self.skipped,
+                    self.retries, self.seconds, self.records_per_second()))
+
+
+class Backfill(object):
+    """ Sends (epoch second, params) readings over a pool of WU connections """
+
+    def __init__(self, url=WU_URL, connections=CONNECTIONS, rate=RATE, timeout=10.0,
+                 max_tries=MAX_TRIES, backoff_min=2.0, backoff_max=60.0,
+                 report_every=10.0):
+        self.url = url
+        self.connections = connections
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.report_every = report_every
+        self.limiter = RateLimiter(rate)
+        self.stats = BackfillStats()
+        self.last_error = None
+        self._checkpoint = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """ Finish the readings in flight and return from run() """
+        self._stop_event.set()
+
+    def _send(self, http, params):
+        """ One reading, retried; returns (outcome, retries) """
+        delay = 0.0
+        for tries in range(self.max_tries):
+            self.limiter.wait()
+            try:
+                status, _ = http.send(params)
+            except (HTTPException, IOError, OSError) as err:
+                http.close()
+                status = None
+                self.last_error = repr(err)
+            # the same rules as WUUploader
+            if status is not None and 200 <= status < 300:
+                return SENT, tries
+            if status is not None and 400 <= status < 500 and status not in (408, 429):
+                return REJECTED, tries
+            if status is not None:
+                self.last_error = "HTTP {}".format(status)
+            delay = min(self.backoff_max, max(self.backoff_min, delay * 2))
+            if self._stop_event.wait(delay * (0.5 + random.random() / 2)):
+                break
+        return FAILED, tries
+
+    def _finished(self, ts, outcome, retries):
+        with self._lock:
+            setattr(self.stats, outcome, getattr(self.stats, outcome) + 1)
+            self.stats.retries += retries
+            # a failure stays out of the checkpoint, so the next run retries it
+            if outcome != FAILED and self._checkpoint is not None:
+                self._pending.append((ts, outcome))
+                if len(self._pending) >= CHECKPOINT_EVERY:
+                    self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._checkpoint.mark(self._pending)
+            self._pending = []
+
+    def _sender(self, work):
+        http = WUConnection(self.url, self.timeout)
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    item = work.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                ts, params = item
+                outcome, retries = self._send(http, params)
+                self._finished(ts, outcome, retries)
+        finally:
+            http.close()
+
+    def _put(self, work, item):
+        """ Queue an item for the senders, False once they've been stopped """
+        while not self._stop_event.is_set():
+            try:
+                work.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _report(self):
+        print("backfill:", self.stats, file=sys.stderr)
+
+    def run(self, items, checkpoint=None, skip=()):
+        """ Send every reading not in skip or already in the checkpoint
+
+        Returns the BackfillStats. Ctrl-C (or stop()) lets the readings in
+        flight finish and still checkpoints them.
+        """
+        self.stats = stats = BackfillStats()
+        self._checkpoint = checkpoint
+        self._stop_event.clear()
+        work = queue.Queue(self.connections * 4)
+        senders = [threading.Thread(target=self._sender, args=(work,),
+                                    name="backfill-{}".format(i))
+                   for i in range(self.connections)]
+        for sender in senders:
+            sender.daemon = True
+            sender.start()
+
+        start = monotonic()
+        next_report = start + self.report_every
+        try:
+            for item in items:
+                if item[0] in skip:
+                    stats.skipped += 1
+                    continue
+                if not self._put(work, item):
+                    break
+                if monotonic() >= next_report:
+                    stats.seconds = monotonic() - start
+                    self._report()
+                    next_report += self.report_every
+            for _ in senders:
+                self._put(work, None)
+            for sender in senders:
+                while sender.is_alive():
+                    sender.join(1.0)
+        except KeyboardInterrupt:
+            print("backfill: stopping after the readings in flight", file=sys.stderr)
+            self.stop()
+            for sender in senders:
+                sender.join()
+        finally:
+            stats.seconds = monotonic() - start
+            if checkpoint is not None:
+                with self._lock:
+                    self._flush()
+        return stats
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """ Answers uploads like WU: "success", after the server's latency """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            fail = random.random() < server.failures
+        status, body = (503, b"busy\n") if fail else (200, b"success\n")
+        if server.observer is not None and not fail:
+            server.observer(dict(parse_qsl(urlsplit(self.path).query)))
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandIn(ThreadingMixIn, HTTPServer):
+    """ A local stand-in for WU: some latency and a share of 503s """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.05, failures=0.0, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _StandInHandler)
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        # optional observer(params) for every upload it accepts
+        self.observer = None
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever, name="stand-in")
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}{}".format(self.server_address[1], urlsplit(WU_URL).path)
+
+
+def bench(n=1000, latency=0.02):
+    """ Records per second against a local stand-in, by pool size and rate """
+    from compression import synthetic
+
+    arrays = synthetic(20000)
+    arrays = dict((key, value[:n]) for key, value in arrays.items())
+    items = list(readings(arrays, "BENCH", "key", compression=None))
+    for kind in sorted(KINDS):
+        print("{} readings, {} after {}".format(
+            len(items), len(list(readings(arrays, "BENCH", "key", kind))), kind))
+    print("stand-in WU: {:.0f} ms per request".format(latency * 1000))
+
+    server = StandIn(latency)
+    for connections, rate in ((1, None), (4, None), (16, None), (32, None), (16, RATE * 10)):
+        backfill = Backfill(server.url, connections, rate)
+        stats = backfill.run(items)
+        print("{:>2} connections, rate {:<5}: {}".format(
+            connections, rate or "-", stats))
+
+    server.failures = 0.05
+    backfill = Backfill(server.url, 16, None, backoff_min=0.05)
+    print("5% 503s, 16 connections:        ", backfill.run(items))
+    server.failures = 0.0
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        # stop part way through, then resume from the checkpoint
+        checkpoint = Checkpoint(path, "BENCH")
+        backfill = Backfill(server.url, 16, None)
+        threading.Timer(len(items) / 2 * latency / 16, backfill.stop).start()
+        before = server.requests
+        print("interrupted:                    ", backfill.run(items, checkpoint))
+        stats = backfill.run(items, checkpoint, checkpoint.done())
+        print("resumed:                        ", stats)
+        print("again:                          ",
+              backfill.run(items, checkpoint, checkpoint.done()))
+        print("{} readings, {} requests in all, {} checkpointed".format(
+            len(items), server.requests - before, len(checkpoint.done())))
+        checkpoint.close()
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    server.shutdown()
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a time range of readings to WU")
+    parser.add_argument("--start", required=True, help="YYYY-MM-DD[ HH:MM], local time")
+    parser.add_argument("--end", help="YYYY-MM-DD[ HH:MM], local time (default: now)")
+    parser.add_argument("--store", default=STORE_DIR, help="the tsstore directory")
+    parser.add_argument("--logs", nargs="+", help="read these text logs instead")
+    parser.add_argument("--url", default=WU_URL)
+    parser.add_argument("--id", help="station ID (default: config.py)")
+    parser.add_argument("--key", help="station key (default: config.py)")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS)
+    parser.add_argument("--rate", type=float, default=RATE,
+                        help="requests per second, 0 = no limit")
+    parser.add_argument("--compression", default=COMPRESSION or "none",
+                        choices=sorted(KINDS) + ["none"])
+    parser.add_argument("--altitude", type=float,
+                        help="metres above sea level, to send sea-level pressure "
+                             "(ALTITUDE in full_ws.py)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT)
+    parser.add_argument("--queue", default=UPLOAD_QUEUE,
+                        help="skip what's waiting in this upload queue ('' = none)")
+    args = parser.parse_args()
+
+    station_id, station_key = args.id, args.key
+    if station_id is None or station_key is None:
+        from config import Config
+        station_id = station_id or Config.STATION_ID
+        station_key = station_key or Config.STATION_KEY
+    start = parse_time(args.start)
+    end = parse_time(args.end) if args.end else time.time()
+    compression = None if args.compression == "none" else args.compression
+
+    arrays = load(start, end, args.store, args.logs)
+    print("{} readings between {} and {}".format(
+        len(arrays["ts"]), time.ctime(start), time.ctime(end)))
+    checkpoint = Checkpoint(args.checkpoint, station_id)
+    skip = checkpoint.done(start, end)
+    if args.queue and os.path.exists(args.queue):
+        skip |= queued(args.queue, station_id)
+    backfill = Backfill(args.url, args.connections, args.rate or None)
+    try:
+        stats = backfill.run(readings(arrays, station_id, station_key, compression,
+                                      args.altitude), checkpoint, skip)
+    finally:
+        checkpoint.close()
+    print(stats)
+    if backfill.last_error:
+        print("last error:", backfill.last_error)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench()
+    else:
+        main()
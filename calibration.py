@@ -0,0 +1,262 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - Sense HAT CPU-heat calibration
+
+    get_sense_temp() used to correct for CPU heat with the fixed formula
+
+        t_corr = t - ((t_cpu - t) / 1.5)
+
+    which is a straight line in t (the pressure sensor temperature) and
+    t_cpu. Every logged line already has the DS18B20 reading (t_tecf) next
+    to t_press and t_cpu, so the line's coefficients can be fitted instead:
+
+        t_ds18b20 = c0 + c1 * t_press + c2 * t_cpu      (all in C)
+
+    fit() does a least-squares fit over historical arrays (tsstore.py or
+    log_import.py layout), RLS refits recursively as new records arrive,
+    and CoefficientStore keeps every fitted set as a numbered version in a
+    JSON file. The live path is HeatModel.apply(): two multiplies and two
+    adds, the same cost as the old formula.
+
+    usage: calibration.py [--save FILE] STORE_DIR | log_weather-*.log
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import datetime
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FEATURES = ("t_press", "t_cpu")
+TARGET = "t_tecf"
+# the old fixed formula, t + (t - t_cpu) / 1.5, as coefficients
+LEGACY_COEFFS = (0.0, 1.0 + 1.0 / 1.5, -1.0 / 1.5)
+
+
+def f_to_c(temp_f):
+    return (temp_f - 32.0) / 1.8
+
+
+class HeatModel(object):
+    """ t_corr = c0 + c1 * t_press + c2 * t_cpu, all in Celsius """
+
+    def __init__(self, coeffs=LEGACY_COEFFS, version=0, rmse=None, samples=0,
+                 created=None, source="legacy"):
+        self.coeffs = tuple(float(c) for c in coeffs)
+        self.version = version
+        self.rmse = rmse
+        self.samples = samples
+        self.created = created
+        self.source = source
+        self.c0, self.c1, self.c2 = self.coeffs
+
+    def apply(self, t_press, t_cpu):
+        """ Corrected temperature (C) from the raw readings (C) """
+        return self.c0 + self.c1 * t_press + self.c2 * t_cpu
+
+    def as_dict(self):
+        return {
+            "version": self.version,
+            "features": list(FEATURES),
+            "coeffs": list(self.coeffs),
+            "rmse": self.rmse,
+            "samples": self.samples,
+            "created": self.created,
+            "source": self.source,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["coeffs"], version=d["version"], rmse=d.get("rmse"),
+                   samples=d.get("samples", 0), created=d.get("created"),
+                   source=d.get("source", ""))
+
+    def __repr__(self):
+        return "HeatModel(v{}: {:.3f} + {:.3f} * t_press + {:.3f} * t_cpu, rmse={})".format(
+            self.version, self.c0, self.c1, self.c2,
+            "?" if self.rmse is None else "{:.3f}".format(self.rmse))
+
+
+def design_matrix(arrays):
+    """ Features and target in Celsius for rows where all of them are valid """
+    cols = [f_to_c(np.asarray(arrays[f], np.float64)) for f in FEATURES]
+    y = f_to_c(np.asarray(arrays[TARGET], np.float64))
+    X = np.column_stack([np.ones(len(y))] + cols)
+    ok = ~np.isnan(X).any(axis=1) & ~np.isnan(y)
+    return X[ok], y[ok]
+
+
+def fit(arrays):
+    """ Least-squares HeatModel over historical arrays (in F, as logged) """
+    X, y = design_matrix(arrays)
+    if len(y) < len(FEATURES) + 1:
+        raise ValueError("not enough valid samples to fit ({})".format(len(y)))
+    coeffs = np.linalg.lstsq(X, y, rcond=None)[0]
+    rmse = float(np.sqrt(np.mean((X.dot(coeffs) - y) ** 2)))
+    return HeatModel(coeffs, rmse=rmse, samples=len(y), source="batch")
+
+
+def rmse_of(model, arrays):
+    """ How well a model predicts the DS18B20 over some arrays """
+    X, y = design_matrix(arrays)
+    return float(np.sqrt(np.mean((X.dot(model.coeffs) - y) ** 2)))
+
+
+class RLS(object):
+    """ Recursive least squares with a forgetting factor
+
+    lam < 1 slowly forgets old samples, so the fit follows seasonal change
+    (a hot summer case behaves differently from a cold winter one). P is
+    kept symmetric and its trace capped at max_trace, otherwise forgetting
+    lets it blow up while the inputs sit still and the fit goes unstable.
+    """
+
+    def __init__(self, coeffs=LEGACY_COEFFS, lam=0.9995, delta=100.0,
+                 max_trace=1e4):
+        n = len(coeffs)
+        self.theta = np.array(coeffs, np.float64)
+        self.P = np.eye(n) * delta
+        self.lam = lam
+        self.max_trace = max_trace
+        self.samples = 0
+        # running mean of squared prediction error (before each update)
+        self.mse = None
+
+    def update(self, x, y):
+        """ Fold in one sample: x the feature row (with the leading 1), y the target """
+        x = np.asarray(x, np.float64)
+        err = y - x.dot(self.theta)
+        Px = self.P.dot(x)
+        gain = Px / (self.lam + x.dot(Px))
+        self.theta = self.theta + gain * err
+        P = (self.P - np.outer(gain, Px)) / self.lam
+        P = (P + P.T) / 2.0
+        trace = np.trace(P)
+        if trace > self.max_trace:
+            P *= self.max_trace / trace
+        self.P = P
+        self.samples += 1
+        sq = err * err
+        self.mse = sq if self.mse is None else self.mse + 0.01 * (sq - self.mse)
+        return err
+
+
+class CoefficientStore(object):
+    """ Every fitted HeatModel as a numbered version in a JSON file """
+
+    def __init__(self, path):
+        self.path = path
+        self.versions = []
+        self.active_version = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.versions = [HeatModel.from_dict(d) for d in data["versions"]]
+            self.active_version = data.get("active", 0)
+
+    def add(self, model, activate=True):
+        """ Store a model as the next version (and make it the active one) """
+        model.version = max([m.version for m in self.versions] + [0]) + 1
+        model.created = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        self.versions.append(model)
+        if activate:
+            self.active_version = model.version
+        self.save()
+        return model
+
+    def get(self, version):
+        for model in self.versions:
+            if model.version == version:
+                return model
+        if version == 0:
+            return HeatModel()
+        raise KeyError("no coefficient set version {}".format(version))
+
+    def active(self):
+        return self.get(self.active_version)
+
+    def activate(self, version):
+        """ Roll forward or back to another stored version """
+        self.get(version)
+        self.active_version = version
+        self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"active": self.active_version,
+                       "versions": [m.as_dict() for m in self.versions]}, f, indent=1)
+        os.rename(tmp, self.path)
+
+
+class Calibrator(object):
+    """ Refits the heat model from live records and publishes better versions
+
+    Each record updates the RLS fit. Every publish_every records the RLS
+    coefficients are stored as a new version, but only if their running
+    error is lower than the active model's on the same records.
+    """
+
+    def __init__(self, store, publish_every=1440, lam=0.9995):
+        self.store = store
+        self.model = store.active()
+        self.rls = RLS(self.model.coeffs, lam=lam)
+        self.publish_every = publish_every
+        self._active_mse = None
+        self._since_publish = 0
+
+    def update(self, record):
+        """ Feed one record (records.py); returns the active HeatModel """
+        values = [record.get(f) for f in FEATURES + (TARGET,)]
+        if any(v is None for v in values):
+            return self.model
+        x = [1.0] + [f_to_c(v) for v in values[:-1]]
+        y = f_to_c(values[-1])
+        err = y - self.model.apply(x[1], x[2])
+        sq = err * err
+        self._active_mse = sq if self._active_mse is None else \
+            self._active_mse + 0.01 * (sq - self._active_mse)
+        self.rls.update(x, y)
+
+        self._since_publish += 1
+        if self._since_publish >= self.publish_every:
+            self._since_publish = 0
+            if self.rls.mse < self._active_mse:
+                candidate = HeatModel(self.rls.theta, rmse=float(np.sqrt(self.rls.mse)),
+                                      samples=self.rls.samples, source="rls")
+                self.model = self.store.add(candidate)
+                self._active_mse = self.rls.mse
+        return self.model
+
+
+def main():
+    from log_import import load_logs
+    from tsstore import TSStore
+
+    parser = argparse.ArgumentParser(description="Fit the Sense HAT heat correction")
+    parser.add_argument("sources", nargs="+", help="a tsstore directory or log files")
+    parser.add_argument("--save", help="add the fit as a new version in this JSON file")
+    args = parser.parse_args()
+
+    if len(args.sources) == 1 and os.path.isdir(args.sources[0]):
+        arrays = TSStore(args.sources[0]).read(fields=FEATURES + (TARGET,))
+    else:
+        arrays = load_logs(args.sources)[0]
+    model = fit(arrays)
+    print("fitted:", model, "on", model.samples, "samples")
+    print("legacy formula rmse: {:.3f}".format(rmse_of(HeatModel(), arrays)))
+    if args.save:
+        model = CoefficientStore(args.save).add(model)
+        print("saved as version", model.version)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,673 @@
+#!/usr/bin/python3
+"""
+******************************************************************************
+    Pi Weather Station - fleet collector
+
+    A server that takes readings from many stations at once, in the same
+    format they send to Weather Underground, so a station's uploader only
+    needs pointing at it (WUUploader(queue, url="http://collector:8080" +
+    WU_PATH)):
+
+        GET  WU_PATH?action=updateraw&ID=..&PASSWORD=..&dateutc=..&tempf=..
+                replies "success" like WU does
+        POST BATCH_PATH
+                one updateraw query string per line, replies with JSON
+                counts of accepted, duplicate and rejected readings
+        GET  /stats
+                the collector's counters as JSON
+
+    Each station gets its own time-series store (tsstore.py) under
+    <root>/w<worker>/<station ID>/. Writes are group-committed: readings
+    that arrive while a write is running go out together in the next one,
+    on a writer thread, and a station only gets "success" once its
+    reading has been written to the store (fsynced on the store's usual
+    interval). A reading that wasn't acked will be retried by the station.
+
+    A retry of a reading the collector already has (same station and
+    dateutc, e.g. the ack got lost) is acked without storing it again;
+    each worker remembers the last 'window' readings per station. Several
+    worker processes can share the port (SO_REUSEPORT). A retry can then
+    land on a different worker, so read_station() merges the workers'
+    stores, sorts by time and drops anything left duplicated.
+
+    Python 3 only (asyncio). The stations themselves don't need it.
+
+    usage: collector.py serve [--root DIR] [--port N] [--workers N] [--keys FILE]
+           collector.py bench [--seconds N] [--connections N]
+           collector.py check
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import asyncio
+import calendar
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+import numpy as np
+
+from scheduler import monotonic
+from tsstore import TSStore, TSStoreWriter
+
+WU_PATH = "/weatherstation/updateweatherstation.php"
+BATCH_PATH = "/weatherstation/batch"
+PORT = 8080
+# the WU fields kept; anything else a station sends is ignored
+FIELDS = ("tempf", "dewptf", "humidity", "baromin", "windspeedmph",
+          "windgustmph", "winddir", "rainin", "dailyrainin", "solarradiation",
+          "UV", "soiltempf")
+# WU's "no reading"
+MISSING = "-9999"
+STATION_ID = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+MAX_BODY = 1 << 20
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class Rejected(ValueError):
+    """ A submission the collector won't store, with the HTTP status to send """
+
+    def __init__(self, status, message):
+        super(Rejected, self).__init__(message)
+        self.status = status
+
+
+def parse_dateutc(when, now=None):
+    """ Epoch seconds from WU's 'YYYY-MM-DD HH:MM:SS' (UTC) or 'now' """
+    if when == "now":
+        return now if now is not None else time.time()
+    # slicing is several times quicker than strptime and this is the hot path
+    try:
+        return float(calendar.timegm((int(when[0:4]), int(when[5:7]), int(when[8:10]),
+                                      int(when[11:13]), int(when[14:16]),
+                                      int(when[17:19]), 0, 0, 0)))
+    except (ValueError, IndexError):
+        raise Rejected(400, "bad dateutc")
+
+
+def parse_submission(params, keys=None, fields=FIELDS):
+    """ WU updateraw parameters to (station ID, record) """
+    station = params.get("ID")
+    if not station or not STATION_ID.match(station):
+        raise Rejected(400, "bad ID")
+    if keys is not None and keys.get(station) != params.get("PASSWORD"):
+        raise Rejected(401, "unauthorized")
+    record = {"ts": parse_dateutc(params.get("dateutc", "now"))}
+    for field in fields:
+        value = params.get(field)
+        if value is None or value == MISSING:
+            continue
+        try:
+            record[field] = float(value)
+        except ValueError:
+            raise Rejected(400, "bad " + field)
+    return station, record
+
+
+class RecentSet(object):
+    """ The last 'size' keys added, for spotting resubmissions """
+
+    def __init__(self, size):
+        self.size = size
+        self._order = collections.deque()
+        self._keys = set()
+
+    def add(self, key):
+        """ False if the key is already here """
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._order.append(key)
+        if len(self._order) > self.size:
+            self._keys.discard(self._order.popleft())
+        return True
+
+    def discard(self, key):
+        self._keys.discard(key)
+
+
+def raise_open_files():
+    """ Lift the soft open-file limit to the hard one, returns the limit """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return hard if soft == resource.RLIM_INFINITY else soft
+
+
+class StationStore(object):
+    """ A TSStoreWriter per station under root, at most max_open kept open
+
+    Each open store holds a file per column. Reopening one costs far more
+    than the write itself, so as many are kept open as the open-file limit
+    allows (max_open=None); past that the least recently written ones are
+    closed and reopen on their next write.
+    """
+
+    def __init__(self, root, fields=FIELDS, max_open=None, fsync="interval"):
+        self.root = root
+        self.fields = tuple(fields)
+        if max_open is None:
+            # ts, valid and a column per field; leave some for sockets
+            max_open = max(16, (raise_open_files() - 256) // (len(self.fields) + 2))
+        self.max_open = max_open
+        self.fsync = fsync
+        self._writers = collections.OrderedDict()
+        self.rows = 0
+
+    def write(self, batches):
+        """ batches maps station ID to a list of records """
+        for station, records in batches.items():
+            writer = self._writers.pop(station, None)
+            if writer is None:
+                writer = TSStoreWriter(os.path.join(self.root, station), self.fields,
+                                       fsync=self.fsync)
+            self._writers[station] = writer
+            records.sort(key=lambda r: r["ts"])
+            if len(records) < 8:
+                writer.append_many(records)
+            else:
+                # a backfill batch: a few column writes instead of a row at a time
+                writer.append_arrays(_columns(records, self.fields))
+            self.rows += len(records)
+            while len(self._writers) > self.max_open:
+                self._writers.popitem(last=False)[1].close()
+
+    def open_count(self):
+        return len(self._writers)
+
+    def close(self):
+        while self._writers:
+            self._writers.popitem()[1].close()
+
+
+def _columns(records, fields):
+    """ Records to arrays laid out like TSStore.read() """
+    nan = float("nan")
+    ts = np.array([r["ts"] for r in records])
+    out = {"ts": np.round(ts * 1000000).astype("<i8"),
+           "valid": np.zeros(len(records), "<u4")}
+    for i, field in enumerate(fields):
+        column = np.array([r.get(field, nan) for r in records], dtype="<f4")
+        out["valid"] |= (~np.isnan(column)).astype("<u4") << i
+        out[field] = column
+    return out
+
+
+class Collector(object):
+    """ Parses, deduplicates and group-commits submissions for one worker
+
+    keys maps station IDs to their passwords; None takes any station.
+    """
+
+    def __init__(self, root, keys=None, fields=FIELDS, window=512, fsync="interval"):
+        self.store = StationStore(root, fields, fsync=fsync)
+        self.keys = keys
+        self.fields = tuple(fields)
+        self.window = window
+        self.stats = collections.Counter()
+        self._seen = {}
+        self._pending = {}
+        self._waiters = []
+        self._writing = False
+        self._kicked = False
+        self._executor = ThreadPoolExecutor(1)
+
+    # ---- storing --------------------------------------------------------------
+
+    async def submit(self, submissions):
+        """ Store (station, record) pairs, returns (accepted, duplicates)
+
+        Returns once everything accepted is written; raises if the write
+        failed (and forgets the readings so a retry is taken).
+        """
+        accepted = []
+        for station, record in submissions:
+            seen = self._seen.get(station)
+            if seen is None:
+                seen = self._seen[station] = RecentSet(self.window)
+            if not seen.add(record["ts"]):
+                continue
+            self._pending.setdefault(station, []).append(record)
+            accepted.append((station, record["ts"]))
+        duplicates = len(submissions) - len(accepted)
+        self.stats["duplicates"] += duplicates
+        if not accepted:
+            return 0, duplicates
+
+        done = asyncio.get_event_loop().create_future()
+        self._waiters.append(done)
+        self._kick()
+        try:
+            await done
+        except Exception:
+            for station, ts in accepted:
+                self._seen[station].discard(ts)
+            raise
+        self.stats["readings"] += len(accepted)
+        return len(accepted), duplicates
+
+    def _kick(self):
+        # start a write after this loop iteration, so every submission that
+        # arrived in it goes in the same batch
+        if not self._writing and not self._kicked:
+            self._kicked = True
+            asyncio.get_event_loop().call_soon(self._start_write)
+
+    def _start_write(self):
+        self._kicked = False
+        if self._writing or not self._pending:
+            return
+        batch, waiters = self._pending, self._waiters
+        self._pending, self._waiters = {}, []
+        self._writing = True
+        asyncio.ensure_future(self._write(batch, waiters))
+
+    async def _write(self, batch, waiters):
+        start = monotonic()
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self._executor, self.store.write, batch)
+        except Exception as err:
+            self.stats["write_errors"] += 1
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(err)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+        finally:
+            self._writing = False
+            self.stats["writes"] += 1
+            self.stats["write_seconds"] += monotonic() - start
+            self.stats["max_batch"] = max(self.stats["max_batch"],
+                                          sum(len(r) for r in batch.values()))
+        # whatever came in during this write goes next
+        self._start_write()
+
+    async def close(self):
+        while self._writing or self._pending:
+            self._start_write()
+            await asyncio.sleep(0.01)
+        await asyncio.get_event_loop().run_in_executor(self._executor, self.store.close)
+        self._executor.shutdown()
+
+    # ---- HTTP ---------------------------------------------------------------
+
+    def _parse(self, query):
+        params = dict(parse_qsl(query))
+        if params.get("action", "updateraw") != "updateraw":
+            raise Rejected(400, "bad action")
+        return parse_submission(params, self.keys, self.fields)
+
+    async def dispatch(self, method, target, body):
+        """ (status, content type, body) for one request """
+        path, _, query = target.partition("?")
+        self.stats["requests"] += 1
+        try:
+            if path == WU_PATH and method == "GET":
+                await self.submit([self._parse(query)])
+                return 200, "text/plain", "success\n"
+            if path == BATCH_PATH and method == "POST":
+                submissions, rejected = [], 0
+                for line in body.decode("latin-1").splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        submissions.append(self._parse(line.strip()))
+                    except Rejected:
+                        rejected += 1
+                self.stats["rejected"] += rejected
+                accepted, duplicates = await self.submit(submissions)
+                return 200, "application/json", json.dumps({
+                    "accepted": accepted, "duplicates": duplicates, "rejected": rejected})
+            if path == "/stats" and method == "GET":
+                stats = dict(self.stats, stations=len(self._seen),
+                             open_stores=self.store.open_count(), rows=self.store.rows)
+                return 200, "application/json", json.dumps(stats)
+            return 404, "text/plain", "not found\n"
+        except Rejected as err:
+            self.stats["rejected"] += 1
+            return err.status, "text/plain", "INVALID {}\n".format(err)
+        except (IOError, OSError, ValueError) as err:
+            return 503, "text/plain", "write failed: {}\n".format(err)
+
+    async def handle(self, reader, writer):
+        """ One client connection, HTTP/1.1 with keep-alive """
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0) or 0)
+                if length > MAX_BODY:
+                    writer.write(_response(413, "text/plain", "too big\n", False))
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, ctype, text = await self.dispatch(method, target, body)
+                keep_alive = (version == "HTTP/1.1" and
+                              headers.get("connection", "").lower() != "close")
+                writer.write(_response(status, ctype, text, keep_alive))
+                if not keep_alive:
+                    break
+                if writer.transport.get_write_buffer_size() > 65536:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _response(status, ctype, text, keep_alive):
+    body = text.encode("utf-8")
+    return ("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n"
+            "Connection: {}\r\n\r\n".format(
+                status, REASONS.get(status, ""), ctype, len(body),
+                "keep-alive" if keep_alive else "close")).encode("latin-1") + body
+
+
+# ============================================================================
+# SERVING
+# ============================================================================
+
+async def _run_worker(root, host, port, keys, reuse_port):
+    collector = Collector(root, keys)
+    server = await asyncio.start_server(collector.handle, host, port,
+                                        reuse_port=reuse_port, backlog=1024)
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    server.close()
+    await collector.close()
+    print("worker {}: {}".format(os.getpid(), dict(collector.stats)))
+
+
+def run_worker(root, host=None, port=PORT, keys=None, index=0, reuse_port=False):
+    """ One collector process, writing under <root>/w<index> """
+    asyncio.run(_run_worker(os.path.join(root, "w{}".format(index)), host, port,
+                            keys, reuse_port))
+
+
+def start_workers(root, host=None, port=PORT, workers=1, keys=None):
+    """ 'workers' collector processes sharing the port, returns the Processes """
+    processes = []
+    for index in range(workers):
+        process = multiprocessing.Process(target=run_worker, name="collector-{}".format(index),
+                                          args=(root, host, port, keys, index, workers > 1))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def stop_workers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def stations(root):
+    """ Every station ID with readings under root """
+    return sorted(set(os.path.basename(path)
+                      for path in glob.glob(os.path.join(root, "w*", "*"))))
+
+
+def read_station(root, station, start=None, end=None, fields=FIELDS):
+    """ One station's readings from every worker, sorted and deduplicated
+
+    Same layout as TSStore.read().
+    """
+    parts = [TSStore(path).read(start, end, fields)
+             for path in sorted(glob.glob(os.path.join(root, "w*", station)))]
+    parts = [p for p in parts if len(p["ts"])]
+    if not parts:
+        out = {"ts": np.zeros(0, "<i8"), "valid": np.zeros(0, "<u4")}
+        out.update((f, np.zeros(0, "<f4")) for f in fields)
+        return out
+    ts = np.concatenate([p["ts"] for p in parts])
+    # first of every timestamp, in time order
+    _, first = np.unique(ts, return_index=True)
+    out = {"ts": ts[first]}
+    for key in ("valid",) + tuple(fields):
+        out[key] = np.concatenate([p[key] for p in parts])[first]
+    return out
+
+
+# ============================================================================
+# LOAD GENERATOR
+# ============================================================================
+
+def _get_request(host, station, ts):
+    params = {"action": "updateraw", "ID": station, "PASSWORD": "x",
+              "dateutc": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)),
+              "tempf": "68.3", "dewptf": "51.2", "humidity": "55", "baromin": "29.92"}
+    return ("GET {}?{} HTTP/1.1\r\nHost: {}\r\n\r\n".format(
+        WU_PATH, urlencode(params), host)).encode("latin-1")
+
+
+def _post_request(host, station, ts, batch):
+    lines = []
+    for i in range(batch):
+        lines.append(urlencode({
+            "action": "updateraw", "ID": station, "PASSWORD": "x",
+            "dateutc": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts + 60 * i)),
+            "tempf": "68.3", "humidity": "55", "baromin": "29.92"}))
+    body = "\n".join(lines).encode("latin-1")
+    return ("POST {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+        BATCH_PATH, host, len(body))).encode("latin-1") + body
+
+
+async def _client(host, port, name, stations, deadline, latencies, batch, ts, requests):
+    reader, writer = await asyncio.open_connection(host, port)
+    # every reading has its own timestamp so none are duplicates
+    n = 0
+    while monotonic() < deadline and n != requests:
+        station = "{}-{}".format(name, n % stations)
+        if batch:
+            request = _post_request(host, station, ts, batch)
+            ts += 60 * batch
+        else:
+            request = _get_request(host, station, ts)
+            ts += 60
+        n += 1
+        start = monotonic()
+        writer.write(request)
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+        await reader.readexactly(length)
+        latencies.append(monotonic() - start)
+    writer.close()
+
+
+def _load_process(host, port, connections, stations, seconds, batch, first_ts, requests,
+                  index):
+    latencies = []
+
+    async def run():
+        deadline = monotonic() + seconds
+        await asyncio.gather(*[
+            _client(host, port, "L{}{}x{}".format("P" if batch else "G", index, c),
+                    stations, deadline, latencies, batch, first_ts, requests)
+            for c in range(connections)])
+
+    asyncio.run(run())
+    return latencies
+
+
+def load(host, port, connections=64, stations=16, seconds=5.0, batch=0, processes=1,
+         first_ts=1500000000, requests=None):
+    """ Hammer a collector, returns (requests per second, p50, p99 seconds)
+
+    connections are spread over 'processes' client processes; each one
+    cycles through 'stations' station IDs. batch > 0 POSTs that many
+    readings per request instead of one GET each. Readings are a minute
+    apart from first_ts on. requests stops each connection after that many.
+    """
+    per_process = max(1, connections // processes)
+    args = [(host, port, per_process, stations, seconds, batch, first_ts, requests, i)
+            for i in range(processes)]
+    start = monotonic()
+    if processes == 1:
+        latencies = _load_process(*args[0])
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            latencies = sum(pool.starmap(_load_process, args), [])
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = monotonic() - start
+    latencies = np.array(latencies)
+    return (len(latencies) / elapsed, float(np.percentile(latencies, 50)),
+            float(np.percentile(latencies, 99)))
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for(host, port, timeout=10.0):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return
+        except (IOError, OSError):
+            time.sleep(0.05)
+    raise RuntimeError("collector didn't start")
+
+
+def bench(seconds=5.0, connections=64, ids=16, batch=60):
+    """ Requests/s and p99 with one worker and with one per core """
+    cores = multiprocessing.cpu_count()
+    print("{} CPU cores; load generator and collector share them".format(cores))
+    host = "127.0.0.1"
+    for workers in sorted(set([1, cores])):
+        root = tempfile.mkdtemp(prefix="collector-")
+        port = _free_port()
+        processes = start_workers(root, host, port, workers)
+        try:
+            _wait_for(host, port)
+            for size in (0, batch):
+                # the first write to a station creates its store (several ms);
+                # one reading to each first so the numbers are the steady state
+                load(host, port, connections, ids, 120.0, min(size, 1),
+                     processes=cores, requests=ids)
+                rate, p50, p99 = load(host, port, connections, ids, seconds,
+                                      batch=size, processes=cores,
+                                      first_ts=1500000000 + 30000)
+                print("{} worker(s), {:<10} {:8.0f} req/s {:9.0f} readings/s  "
+                      "p50 {:6.1f} ms  p99 {:6.1f} ms".format(
+                          workers, "GET" if not size else "POST x{}".format(size),
+                          rate, rate * max(1, size), p50 * 1000, p99 * 1000))
+        finally:
+            stop_workers(processes)
+            found = stations(root)
+            rows = sum(len(read_station(root, s, fields=("tempf",))["ts"]) for s in found)
+            print("  stored {} readings from {} stations".format(rows, len(found)))
+            shutil.rmtree(root)
+
+
+def check():
+    """ Late batches (row by row and bulk) read back in order; True if they do """
+    root = tempfile.mkdtemp(prefix="collector-")
+    try:
+        store = StationStore(os.path.join(root, "w0"), fsync="never")
+        start = 1500000000
+        minutes = list(range(0, 60, 2)) + list(range(1, 20, 2)) + [29, 31, 33]
+        for lo, hi in ((0, 30), (30, 40), (40, 43)):
+            # on time, then a bulk replay of older minutes, then a few more
+            store.write({"CHECK": [{"ts": start + 60.0 * m, "tempf": float(m)}
+                                   for m in minutes[lo:hi]]})
+        store.close()
+        got = read_station(root, "CHECK", start + 600, start + 1800)
+        expected = sorted(m for m in minutes if 10 <= m < 30)
+        ok = (got["ts"] // 1000000 - start).tolist() == [60 * m for m in expected]
+        ok &= got["tempf"].tolist() == [float(m) for m in expected]
+        everything = read_station(root, "CHECK")
+        ok &= bool((np.diff(everything["ts"]) > 0).all()) and \
+            len(everything["ts"]) == len(minutes)
+    finally:
+        shutil.rmtree(root)
+    print("{} late rows read back {}".format(
+        len(minutes) - 30, "in order" if ok else "WRONG"))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect readings from a fleet of stations")
+    sub = parser.add_subparsers(dest="command")
+    serve = sub.add_parser("serve")
+    serve.add_argument("--root", default="collector")
+    serve.add_argument("--host", default=None)
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--workers", type=int, default=1)
+    serve.add_argument("--keys", help="JSON file of {station ID: password}")
+    load_cmd = sub.add_parser("bench")
+    load_cmd.add_argument("--seconds", type=float, default=5.0)
+    load_cmd.add_argument("--connections", type=int, default=64)
+    sub.add_parser("check")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        keys = None
+        if args.keys:
+            with open(args.keys) as f:
+                keys = json.load(f)
+        if args.workers == 1:
+            run_worker(args.root, args.host, args.port, keys)
+        else:
+            processes = start_workers(args.root, args.host, args.port, args.workers, keys)
+            try:
+                for process in processes:
+                    process.join()
+            except KeyboardInterrupt:
+                stop_workers(processes)
+    elif args.command == "bench":
+        bench(args.seconds, args.connections)
+    elif args.command == "check":
+        raise SystemExit(0 if check() else 1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
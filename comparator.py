@@ -0,0 +1,349 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - cross-sensor comparator
+
+    The station reads temperature four ways (Sense HAT humidity and
+    pressure sensors, DHT11, DS18B20) and humidity two ways (Sense HAT,
+    DHT11). Comparator checks them against each other as records arrive,
+    O(1) per record:
+
+        outlier  a pair's difference jumps far outside its recent spread
+        drift    a pair's recent mean difference wanders from its long-run one
+        stuck    a sensor repeats the same value while the others move
+        stale    a sensor hasn't given a fresh read for a while
+
+    Pair flags are pinned on the sensor that disagrees with most of its
+    partners. A flagged sensor (and anything computed from it, like the
+    dew points) is listed in record["degraded"]; records.scrubbed() blanks
+    those fields before a record goes to an upload sink.
+
+    replay() runs the same checks over history from tsstore.py or
+    log_import.py.
+
+    usage: comparator.py [STORE_DIR | log_weather-*.log]   (synthetic faults
+           with no arguments)
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import collections
+import math
+import os
+import sys
+
+import numpy as np
+
+from records import FIELDS
+from scheduler import monotonic
+
+# readings computed from other readings, degraded along with their inputs
+DERIVED = {
+    "temp_f": ("t_press",),
+    "dew_pt_dht": ("t_dht", "h_dht"),
+    "dew_pt_tec": ("t_tecf", "h_dht"),
+}
+FLAGS = ("outlier", "drift", "stuck", "stale")
+
+
+def _missing(x):
+    return x is None or x != x
+
+
+def _median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+class Group(object):
+    """ Sensors that measure the same thing, with the limits to check them by
+
+    min_scale   smallest spread used for the outlier test
+    drift       how far the recent mean difference may move (clears at half)
+    motion      how far the other sensors must move before a constant
+                reading counts as stuck (DHT11 values are whole degrees)
+    """
+
+    def __init__(self, fields, min_scale, drift, motion, stuck_after=30):
+        self.fields = tuple(fields)
+        self.min_scale = min_scale
+        self.drift = drift
+        self.motion = motion
+        self.stuck_after = stuck_after
+
+
+def default_groups():
+    return [
+        Group(("t_hum", "t_press", "t_dht", "t_tecf"), min_scale=0.5, drift=3.0,
+              motion=5.0),
+        Group(("humidity", "h_dht"), min_scale=2.0, drift=8.0, motion=8.0),
+    ]
+
+
+class PairStats(object):
+    """ Running statistics of the difference a - b between two sensors
+
+    The fast mean and variance follow the last hour or so, the slow mean
+    the last week. Samples are clipped to the outlier limit before they
+    go in, so a glitch doesn't widen the spread it is judged by.
+    """
+
+    def __init__(self, a, b, group, alpha=1 / 60.0, slow_alpha=1 / 10080.0,
+                 k=5.0, warmup=30):
+        self.a = a
+        self.b = b
+        self.group = group
+        self.alpha = alpha
+        self.slow_alpha = slow_alpha
+        self.k = k
+        self.warmup = warmup
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.slow = 0.0
+        self.drifting = False
+
+    def update(self, diff):
+        """ Fold in one difference, returns (outlier, drifting) """
+        self.n += 1
+        n = self.n
+        # plain running averages until there is enough data for the EWMAs
+        alpha = max(self.alpha, 1.0 / n)
+        slow_alpha = max(self.slow_alpha, 1.0 / n)
+        limit = self.k * max(math.sqrt(self.var), self.group.min_scale)
+        dev = diff - self.mean
+        outlier = n > self.warmup and abs(dev) > limit
+        if n > self.warmup:
+            dev = max(-limit, min(limit, dev))
+        self.mean += alpha * dev
+        self.var = (1 - alpha) * (self.var + alpha * dev * dev)
+        self.slow += slow_alpha * (self.mean - self.slow)
+
+        if n > self.warmup:
+            shift = abs(self.mean - self.slow)
+            if shift > self.group.drift:
+                self.drifting = True
+            elif shift < self.group.drift / 2:
+                self.drifting = False
+        return outlier, self.drifting
+
+
+class SensorState(object):
+    """ Stuck-value tracking for one sensor """
+
+    def __init__(self, field, group):
+        self.field = field
+        self.group = group
+        self.value = None
+        self.run = 0
+        # range of the other sensors' median while this one hasn't changed
+        self.lo = self.hi = None
+
+    def update(self, x, others):
+        """ x this sensor, others the median of the rest of its group (or None) """
+        if x != self.value:
+            self.value = x
+            self.run = 1
+            self.lo = self.hi = others
+            return False
+        self.run += 1
+        if others is not None:
+            if self.lo is None:
+                self.lo = self.hi = others
+            else:
+                self.lo = min(self.lo, others)
+                self.hi = max(self.hi, others)
+        return (self.run >= self.group.stuck_after and self.lo is not None and
+                self.hi - self.lo >= self.group.motion)
+
+
+class Comparator(object):
+    """ Checks every record's sensors against each other """
+
+    def __init__(self, groups=None, stale_after=600.0, **pair_options):
+        self.groups = default_groups() if groups is None else groups
+        self.stale_after = stale_after
+        self.pairs = []
+        self.sensors = {}
+        for group in self.groups:
+            for i, a in enumerate(group.fields):
+                self.sensors[a] = SensorState(a, group)
+                for b in group.fields[i + 1:]:
+                    self.pairs.append(PairStats(a, b, group, **pair_options))
+        self.records = 0
+        self.counts = collections.Counter()
+        # fields held out of the most recent record
+        self.degraded = []
+
+    def update(self, record, updated=None):
+        """ Check one record (records.py), returns {field: [flags]}
+
+        updated maps a field to the time (epoch seconds) of its last fresh
+        read; sensors that keep their last good value between reads are
+        stale once that falls stale_after behind the record.
+        """
+        self.records += 1
+        flags = collections.defaultdict(set)
+        values = {}
+        for field in self.sensors:
+            value = record.get(field)
+            if not _missing(value):
+                values[field] = value
+
+        if updated:
+            for field, when in updated.items():
+                if field in values and record["ts"] - when > self.stale_after:
+                    flags[field].add("stale")
+
+        for group in self.groups:
+            present = [f for f in group.fields if f in values]
+            for field in present:
+                others = _median([values[f] for f in present if f != field])
+                if self.sensors[field].update(values[field], others):
+                    flags[field].add("stuck")
+
+        hits = []
+        for pair in self.pairs:
+            if pair.a in values and pair.b in values:
+                outlier, drifting = pair.update(values[pair.a] - values[pair.b])
+                if outlier:
+                    hits.append((pair, "outlier"))
+                if drifting:
+                    hits.append((pair, "drift"))
+        if hits:
+            self._blame(hits, values, flags)
+
+        out = {}
+        for field, fs in flags.items():
+            if fs:
+                out[field] = sorted(fs)
+                for flag in fs:
+                    self.counts[field, flag] += 1
+        self.degraded = degraded_fields(out) if out else []
+        return out
+
+    def _blame(self, hits, values, flags):
+        """ Pin flagged pairs on the sensor that disagrees with most partners """
+        # each flagged pair votes against both of its sensors
+        votes = collections.defaultdict(set)
+        for pair, flag in hits:
+            votes[pair.a, flag].add(pair.b)
+            votes[pair.b, flag].add(pair.a)
+        partners = collections.Counter()
+        for pair in self.pairs:
+            if pair.a in values and pair.b in values:
+                partners[pair.a] += 1
+                partners[pair.b] += 1
+        for (field, flag), against in votes.items():
+            if len(against) >= 2 and 2 * len(against) > partners[field]:
+                flags[field].add(flag)
+        # with only two sensors a disagreement goes to one already in trouble
+        for pair, flag in hits:
+            if len(pair.group.fields) != 2:
+                continue
+            if flags.get(pair.a) and not flags.get(pair.b):
+                flags[pair.a].add(flag)
+            elif flags.get(pair.b) and not flags.get(pair.a):
+                flags[pair.b].add(flag)
+
+    def report(self):
+        lines = ["Comparator: {} records".format(self.records)]
+        for field in FIELDS:
+            counts = [(flag, self.counts[field, flag]) for flag in FLAGS
+                      if self.counts[field, flag]]
+            if counts:
+                lines.append("  {:<10} ".format(field) + ", ".join(
+                    "{} {}".format(flag, n) for flag, n in counts))
+        return "\n".join(lines)
+
+
+def degraded_fields(flags):
+    """ Flagged fields plus the fields computed from them, in FIELDS order """
+    bad = set(flags)
+    for field, inputs in DERIVED.items():
+        if bad.intersection(inputs):
+            bad.add(field)
+    return [f for f in FIELDS if f in bad]
+
+
+# ============================================================================
+# REPLAY
+# ============================================================================
+
+def replay(arrays, comparator=None):
+    """ Run a Comparator over history laid out like TSStore.read()
+
+    Returns (comparator, degraded) with degraded a uint32 bitmap per row,
+    bit i set when FIELDS[i] would have been held back, like 'valid'.
+    """
+    if comparator is None:
+        comparator = Comparator()
+    checked = [f for f in FIELDS if f in comparator.sensors]
+    ts = (np.asarray(arrays["ts"]) / 1000000.0).tolist()
+    columns = [np.asarray(arrays[f], np.float64).tolist() for f in checked]
+    bit = dict((f, 1 << i) for i, f in enumerate(FIELDS))
+    degraded = np.zeros(len(ts), np.uint32)
+    record = {}
+    for i, row in enumerate(zip(*columns)):
+        record.update(zip(checked, row))
+        record["ts"] = ts[i]
+        if comparator.update(record):
+            mask = 0
+            for field in comparator.degraded:
+                mask |= bit[field]
+            degraded[i] = mask
+    return comparator, degraded
+
+
+def synthetic(n=20000, seed=0):
+    """ Minute readings with a stuck DHT11, a drifting DS18B20 and glitches """
+    rs = np.random.RandomState(seed)
+    t = np.arange(n)
+    air = 60 + 12 * np.sin(2 * math.pi * t / 1440.0) + np.cumsum(rs.normal(0, 0.02, n))
+    rh = 55 - 15 * np.sin(2 * math.pi * t / 1440.0) + rs.normal(0, 1, n)
+    arrays = {"ts": ((1.5e9 + t * 60.0) * 1000000).astype(np.int64)}
+    for field in FIELDS:
+        arrays[field] = np.full(n, np.nan)
+    arrays["t_tecf"] = air + rs.normal(0, 0.1, n)
+    arrays["t_press"] = air + 8 + rs.normal(0, 0.3, n)
+    arrays["t_hum"] = air + 7 + rs.normal(0, 0.3, n)
+    arrays["t_dht"] = np.round((air - 32) / 1.8) * 1.8 + 32
+    arrays["humidity"] = rh - 10 + rs.normal(0, 1, n)
+    arrays["h_dht"] = np.round(rh)
+    # faults: DHT11 stuck for 3 hours, DS18B20 drifts 6F over 2 days, spikes
+    arrays["t_dht"][5000:5180] = arrays["t_dht"][5000]
+    arrays["h_dht"][5000:5180] = arrays["h_dht"][5000]
+    arrays["t_tecf"][12000:15000] += np.linspace(0, 6, 3000)
+    arrays["t_tecf"][15000:] += 6
+    arrays["t_press"][::1511] += 25
+    return arrays
+
+
+def main():
+    if len(sys.argv) < 2:
+        arrays = synthetic()
+        print("synthetic: {} records".format(len(arrays["ts"])))
+    else:
+        from log_import import load_logs
+        from tsstore import TSStore
+        if len(sys.argv) == 2 and os.path.isdir(sys.argv[1]):
+            arrays = TSStore(sys.argv[1]).read()
+        else:
+            arrays = load_logs(sys.argv[1:])[0]
+    start = monotonic()
+    comparator, degraded = replay(arrays)
+    took = monotonic() - start
+    print(comparator.report())
+    print("{} of {} records had something held back; {:.1f} us/record".format(
+        int(np.count_nonzero(degraded)), len(degraded),
+        took / max(len(degraded), 1) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
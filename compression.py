@@ -0,0 +1,407 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - per-channel compression of the record stream
+
+    Steady weather doesn't need a point a minute. Each channel (field) is
+    thinned on its own, within an error bound:
+
+        Deadband      keeps a point when it moves more than 'tolerance'
+                      from the last kept one; read back by holding the
+                      last kept value
+        SwingingDoor  keeps the points where a straight line from the last
+                      kept point can no longer pass within 'tolerance' of
+                      everything since; read back by linear interpolation
+
+    Either way a point is kept at least every max_gap seconds, and reading
+    back the kept points (reconstruct / expand) gives every original
+    sample to within the tolerance. The swinging door here checks the
+    point itself against the door, not just the door's two sides, so the
+    bound holds between every pair of kept points (the textbook version
+    can overshoot it).
+
+    A channel that goes missing (None or NaN) keeps its last point and
+    then a gap marker, NaN, at the first missing sample; nothing is
+    interpolated across a gap. In the time-series store a marker is a NaN
+    with its valid bit set, a thinned-out sample has its valid bit clear.
+
+    Compressor runs a set of channels over records and hands back sparse
+    records (None where a field wasn't kept). The swinging door decides on
+    a point when the next one arrives, so records come out one behind. A
+    record is left out altogether only when none of its channels kept a
+    point, so give each sink just the fields it uses: WU's four channels
+    thin out far better than all eleven (the local store keeps every
+    record by default, see full_ws.py).
+
+    On the station's readings the deadband keeps fewer points than the
+    swinging door on every channel (run this file for the table): the
+    readings are noisy and quantised, the swinging door pays for its
+    stricter bound, so deadband is full_ws.py's default.
+
+    usage: compression.py [STORE_DIR | log_weather-*.log]   (ratio and error)
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from records import FIELDS
+from scheduler import monotonic
+
+# seconds between kept points however steady a channel is
+MAX_GAP = 900
+# error bound per field, in the field's units: about twice each sensor's
+# noise or one step of its resolution, below that it's just keeping noise
+TOLERANCES = {
+    "temp_f": 0.5, "t_hum": 0.5, "t_press": 0.5, "t_dht": 1.0, "t_tecf": 0.2,
+    "dew_pt_dht": 1.0, "dew_pt_tec": 0.5,
+    "t_cpu": 2.0,
+    "humidity": 2.0, "h_dht": 1.0,
+    "pressure": 0.01,
+}
+# in a compressed store's directory, which kind thinned it (mark_store)
+KIND_FILE = "compression.json"
+# what WU gets (see sinks.WUSink); a record only goes out when one changed
+WU_FIELDS = ("temp_f", "dew_pt_tec", "h_dht", "pressure")
+_INF = float("inf")
+
+
+def _missing(v):
+    return v is None or v != v
+
+
+class Deadband(object):
+    """ Keeps a point when it's more than 'tolerance' from the last kept one """
+
+    interpolation = "previous"
+
+    def __init__(self, tolerance, max_gap=MAX_GAP):
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self._kept = None
+        self._last = None
+
+    def add(self, t, v):
+        """ The (t, value) points to keep now that (t, v) came in """
+        if _missing(v):
+            return self._gap(t)
+        kept = self._kept
+        self._last = (t, v)
+        if (kept is None or abs(v - kept[1]) > self.tolerance or
+                t - kept[0] >= self.max_gap):
+            self._kept = (t, v)
+            return [(t, v)]
+        return []
+
+    def _gap(self, t):
+        if self._kept is None:
+            return []
+        out = self.flush()
+        self._kept = self._last = None
+        return out + [(t, float("nan"))]
+
+    def flush(self):
+        """ The last point, so the held value has an end """
+        if self._last is not None and self._last != self._kept:
+            self._kept = self._last
+            return [self._last]
+        return []
+
+
+class SwingingDoor(object):
+    """ Swinging-door trending: keeps the corners of a piecewise linear fit """
+
+    interpolation = "linear"
+
+    def __init__(self, tolerance, max_gap=MAX_GAP):
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self._kept = None
+        self._prev = None
+        self._up = _INF
+        self._low = -_INF
+
+    def _keep_prev(self):
+        self._kept, self._prev = self._prev, None
+        self._up, self._low = _INF, -_INF
+        return self._kept
+
+    def add(self, t, v):
+        """ The (t, value) points to keep now that (t, v) came in """
+        if _missing(v):
+            return self._gap(t)
+        if self._kept is None:
+            self._kept = (t, v)
+            return [(t, v)]
+        out = []
+        if self._prev is not None and t - self._kept[0] > self.max_gap:
+            out.append(self._keep_prev())
+        t0, v0 = self._kept
+        dt = t - t0
+        if dt <= 0:
+            return out
+        slope = (v - v0) / dt
+        if not self._low <= slope <= self._up:
+            # no line from the kept point gets within tolerance of every
+            # point so far and this one: the previous point is a corner
+            out.append(self._keep_prev())
+            t0, v0 = self._kept
+            dt = t - t0
+        self._up = min(self._up, (v + self.tolerance - v0) / dt)
+        self._low = max(self._low, (v - self.tolerance - v0) / dt)
+        self._prev = (t, v)
+        return out
+
+    def _gap(self, t):
+        if self._kept is None:
+            return []
+        out = self.flush()
+        self._kept = None
+        self._up, self._low = _INF, -_INF
+        return out + [(t, float("nan"))]
+
+    def flush(self):
+        """ The point still waiting for a decision """
+        if self._prev is None:
+            return []
+        return [self._keep_prev()]
+
+
+KINDS = {"deadband": Deadband, "swinging_door": SwingingDoor}
+
+
+def default_channels(kind="swinging_door", fields=FIELDS, tolerances=None,
+                     max_gap=MAX_GAP):
+    """ One channel of 'kind' per field, bounds from TOLERANCES by default """
+    tolerances = tolerances or TOLERANCES
+    return dict((field, KINDS[kind](tolerances[field], max_gap)) for field in fields)
+
+
+class Compressor(object):
+    """ Thins records (records.py) channel by channel
+
+    update() takes each record and returns the sparse records that are
+    complete: a field is None where it wasn't kept, NaN at a gap marker,
+    and a timestamp where nothing was kept doesn't come out at all.
+    """
+
+    def __init__(self, channels=None):
+        self.channels = channels if channels is not None else default_channels()
+        self.records_in = 0
+        self.records_out = 0
+        self._pending = {}
+
+    def update(self, record):
+        ts = record["ts"]
+        self.records_in += 1
+        for field, channel in self.channels.items():
+            for t, v in channel.add(ts, record.get(field)):
+                self._pending.setdefault(t, {})[field] = v
+        # every channel has decided on everything before this record
+        return self._ready(ts)
+
+    def flush(self):
+        """ Everything still held back (at shutdown) """
+        for field, channel in self.channels.items():
+            for t, v in channel.flush():
+                self._pending.setdefault(t, {})[field] = v
+        return self._ready(None)
+
+    def _ready(self, before):
+        out = []
+        for t in sorted(self._pending):
+            if before is not None and t >= before:
+                break
+            record = dict.fromkeys(self.channels)
+            record.update(self._pending.pop(t))
+            record["ts"] = t
+            out.append(record)
+        self.records_out += len(out)
+        return out
+
+
+# ============================================================================
+# READING IT BACK
+# ============================================================================
+
+def reconstruct(ts, values, query, interpolation="linear"):
+    """ A channel's kept points evaluated at the query times
+
+    ts and values are the kept points in time order (NaN values are gap
+    markers); query times outside them or inside a gap come back NaN.
+    """
+    ts = np.asarray(ts, dtype=float)
+    values = np.asarray(values, dtype=float)
+    query = np.asarray(query, dtype=float)
+    out = np.full(len(query), np.nan)
+    if not len(ts):
+        return out
+    i = np.searchsorted(ts, query, side="right") - 1
+    exact = (i >= 0) & (ts[np.maximum(i, 0)] == query)
+    between = (i >= 0) & (i < len(ts) - 1) & ~exact
+    lo = i[between]
+    if interpolation == "linear":
+        t0, t1 = ts[lo], ts[lo + 1]
+        v0, v1 = values[lo], values[lo + 1]
+        out[between] = v0 + (query[between] - t0) / (t1 - t0) * (v1 - v0)
+    else:
+        # held, but not past a gap marker
+        out[between] = np.where(np.isnan(values[lo + 1]), np.nan, values[lo])
+    out[exact] = values[i[exact]]
+    return out
+
+
+def expand(arrays, step=60, fields=FIELDS, interpolation="linear"):
+    """ Compressed rows laid out like TSStore.read() back to a regular grid
+
+    Returns the same layout, one row every 'step' seconds from the first
+    row to the last. A field counts as kept where its valid bit is set (or
+    where it isn't NaN, for arrays without a 'valid' bitmap).
+    """
+    ts = np.asarray(arrays["ts"])
+    if not len(ts):
+        return dict(arrays)
+    grid = np.arange(ts[0], ts[-1] + 1, int(step * 1000000), dtype=np.int64)
+    out = {"ts": grid, "valid": np.zeros(len(grid), "<u4")}
+    for bit, field in enumerate(fields):
+        values = np.asarray(arrays[field], dtype=float)
+        if "valid" in arrays:
+            kept = (np.asarray(arrays["valid"]) >> bit) & 1 == 1
+        else:
+            kept = ~np.isnan(values)
+        column = reconstruct(ts[kept], values[kept], grid,
+                             interpolation.get(field, "linear")
+                             if isinstance(interpolation, dict) else interpolation)
+        out[field] = column.astype("<f4")
+        out["valid"] |= (~np.isnan(column)).astype("<u4") << bit
+    return out
+
+
+def mark_store(root, kind):
+    """ Note in a store directory which kind of channel is thinning it """
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    with open(os.path.join(root, KIND_FILE), "w") as f:
+        json.dump({"kind": kind}, f)
+
+
+def store_kind(root):
+    """ The kind mark_store() noted for a store, None if it has none """
+    try:
+        with open(os.path.join(root, KIND_FILE)) as f:
+            return json.load(f)["kind"]
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def read_expanded(store, start=None, end=None, step=60, interpolation=None):
+    """ TSStore.read() of a compressed store, filled back in to every 'step'
+
+    By default each kind is read back the way it was kept: a deadband
+    store holds the last value, a swinging-door one is interpolated.
+    """
+    if interpolation is None:
+        kind = store_kind(store.root)
+        interpolation = KINDS[kind].interpolation if kind in KINDS else "linear"
+    return expand(store.read(start, end), step, interpolation=interpolation)
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def evaluate(ts, values, channel):
+    """ Compress one series and read it back: ratio, errors and time """
+    points = [(t, v) for t, v in zip(ts.tolist(), values.tolist())]
+    kept = []
+    start = monotonic()
+    for t, v in points:
+        kept.extend(channel.add(t, v))
+    kept.extend(channel.flush())
+    took = monotonic() - start
+    good = ~np.isnan(values)
+    back = reconstruct([p[0] for p in kept], [p[1] for p in kept], ts,
+                       channel.interpolation)
+    error = np.abs(back[good] - values[good])
+    real = sum(1 for p in kept if p[1] == p[1])
+    return {
+        "points": int(np.count_nonzero(good)),
+        "kept": real,
+        "ratio": np.count_nonzero(good) / max(real, 1),
+        "max_error": float(error.max()) if len(error) else 0.0,
+        "rmse": float(np.sqrt(np.mean(error ** 2))) if len(error) else 0.0,
+        "unrecovered": int(np.count_nonzero(np.isnan(back[good]))),
+        "us_per_point": took / max(len(points), 1) * 1e6,
+    }
+
+
+def synthetic(n=20000, seed=0):
+    """ comparator.synthetic() plus the fields it leaves out """
+    import comparator
+    arrays = comparator.synthetic(n, seed)
+    rs = np.random.RandomState(seed + 1)
+    arrays["temp_f"] = arrays["t_hum"] - 7 + rs.normal(0, 0.2, n)
+    arrays["t_cpu"] = arrays["t_hum"] + 40 + rs.normal(0, 0.8, n)
+    arrays["pressure"] = 29.9 + np.cumsum(rs.normal(0, 0.0005, n)) + rs.normal(0, 0.003, n)
+    # rule-of-thumb dew point, Td = T - (100 - RH) / 5 in C
+    for dew, temp in (("dew_pt_dht", "t_dht"), ("dew_pt_tec", "t_tecf")):
+        arrays[dew] = arrays[temp] - (100 - arrays["h_dht"]) / 5 * 1.8
+    return arrays
+
+
+def main():
+    if len(sys.argv) < 2:
+        arrays = synthetic()
+        print("synthetic: {} records".format(len(arrays["ts"])))
+    else:
+        import os
+        from log_import import load_logs
+        from tsstore import TSStore
+        if len(sys.argv) == 2 and os.path.isdir(sys.argv[1]):
+            arrays = TSStore(sys.argv[1]).read()
+        else:
+            arrays = load_logs(sys.argv[1:])[0]
+    ts = np.asarray(arrays["ts"]) / 1000000.0
+    print("{:<11} {:>5} {:>7} | {:>14} {:>7} {:>6} | {:>14} {:>7} {:>6}".format(
+        "field", "tol", "points", "deadband", "max err", "rmse",
+        "swinging door", "max err", "rmse"))
+    for field in FIELDS:
+        values = np.asarray(arrays[field], dtype=float)
+        if not np.count_nonzero(~np.isnan(values)):
+            continue
+        tol = TOLERANCES[field]
+        line = "{:<11} {:>5} {:>7}".format(field, tol, np.count_nonzero(~np.isnan(values)))
+        for kind in ("deadband", "swinging_door"):
+            r = evaluate(ts, values, KINDS[kind](tol))
+            line += " | {:>13.1f}x {:>7.3f} {:>6.3f}".format(
+                r["ratio"], r["max_error"], r["rmse"])
+            if r["unrecovered"] or r["max_error"] > tol * (1 + 1e-9):
+                line += " OUT OF BOUNDS"
+        print(line)
+
+    records = []
+    for i in range(len(ts)):
+        record = dict((f, float(arrays[f][i])) for f in FIELDS)
+        record["ts"] = ts[i]
+        records.append(record)
+    for kind in ("deadband", "swinging_door"):
+        for name, fields in (("all fields", FIELDS), ("WU fields", WU_FIELDS)):
+            compressor = Compressor(default_channels(kind, fields))
+            start = monotonic()
+            for record in records:
+                compressor.update(record)
+            compressor.flush()
+            took = monotonic() - start
+            print("{:<13} {:<10} {} records -> {} ({:.1f}x), {:.1f} us/record".format(
+                kind, name, compressor.records_in, compressor.records_out,
+                compressor.records_in / max(compressor.records_out, 1),
+                took / max(compressor.records_in, 1) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
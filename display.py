@@ -0,0 +1,405 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - LED matrix display
+
+    SenseHat.show_message() blocks for the whole scroll (seconds) and
+    writes every frame a pixel at a time: an open(), 64 seeks and 64
+    two-byte writes. Display runs the LED matrix from its own thread
+    instead. Callers queue messages and images and return at once.
+
+    Frames are NumPy uint8 (8, 8, 3) arrays. A scrolling message is
+    rendered to all of its frames in one go and kept in an LRU cache, so
+    the strings that keep coming back ("68.9F", "45%") are only rendered
+    once. Images (the trend arrows) and their rotations are cached the
+    same way. A frame that is the same as the one already showing isn't
+    pushed again.
+
+    LED backends:
+
+        FramebufferLED  packs a frame to RGB565 with NumPy and writes all
+                        128 bytes to the Sense HAT framebuffer at once
+        SenseLED        any object with set_pixels() (a SenseHat, a fake)
+        FakeLED         counts frames, for tests and the benchmark
+
+    Run this file for a benchmark against the old per-pixel writes.
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import collections
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from scheduler import monotonic
+
+# fallback font for when the Sense HAT's own isn't there: 5x7 glyphs, one
+# int per row, bit 4 the leftmost column
+FONT_5X7 = {
+    "0": (0x0E, 0x11, 0x13, 0x15, 0x19, 0x11, 0x0E),
+    "1": (0x04, 0x0C, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    "2": (0x0E, 0x11, 0x01, 0x02, 0x04, 0x08, 0x1F),
+    "3": (0x1F, 0x02, 0x04, 0x02, 0x01, 0x11, 0x0E),
+    "4": (0x02, 0x06, 0x0A, 0x12, 0x1F, 0x02, 0x02),
+    "5": (0x1F, 0x10, 0x1E, 0x01, 0x01, 0x11, 0x0E),
+    "6": (0x06, 0x08, 0x10, 0x1E, 0x11, 0x11, 0x0E),
+    "7": (0x1F, 0x01, 0x02, 0x04, 0x08, 0x08, 0x08),
+    "8": (0x0E, 0x11, 0x11, 0x0E, 0x11, 0x11, 0x0E),
+    "9": (0x0E, 0x11, 0x11, 0x0F, 0x01, 0x02, 0x0C),
+    ".": (0x00, 0x00, 0x00, 0x00, 0x00, 0x0C, 0x0C),
+    "-": (0x00, 0x00, 0x00, 0x1F, 0x00, 0x00, 0x00),
+    "%": (0x18, 0x19, 0x02, 0x04, 0x08, 0x13, 0x03),
+    "C": (0x0E, 0x11, 0x10, 0x10, 0x10, 0x11, 0x0E),
+    "F": (0x1F, 0x10, 0x10, 0x1E, 0x10, 0x10, 0x10),
+    "I": (0x0E, 0x04, 0x04, 0x04, 0x04, 0x04, 0x0E),
+    "h": (0x10, 0x10, 0x16, 0x19, 0x11, 0x11, 0x11),
+    "i": (0x04, 0x00, 0x0C, 0x04, 0x04, 0x04, 0x0E),
+    "n": (0x00, 0x00, 0x16, 0x19, 0x11, 0x11, 0x11),
+    "t": (0x08, 0x08, 0x1C, 0x08, 0x08, 0x09, 0x06),
+    " ": (0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00),
+    "?": (0x0E, 0x11, 0x01, 0x02, 0x04, 0x00, 0x04),
+}
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+
+def to_frame(pixels):
+    """ A list of 64 [r, g, b] (or an array) as an (8, 8, 3) uint8 frame """
+    return np.asarray(pixels, np.uint8).reshape(8, 8, 3)
+
+
+def rotate(frame, rotation):
+    """ The frame as the Sense HAT shows it at set_rotation(rotation) """
+    if rotation % 90:
+        raise ValueError("rotation must be 0, 90, 180 or 270")
+    return np.ascontiguousarray(np.rot90(frame, -(rotation // 90) % 4))
+
+
+def rgb565(frame):
+    """ (8, 8, 3) uint8 frame to the framebuffer's 128 bytes """
+    f = frame.astype(np.uint16)
+    packed = ((f[..., 0] >> 3) << 11) | ((f[..., 1] >> 2) << 5) | (f[..., 2] >> 3)
+    return packed.astype(np.uint16).tobytes()
+
+
+class Font(object):
+    """ Glyph masks, (8, width) bool arrays with trailing blank columns trimmed
+
+    Uses the Sense HAT library's own font when a SenseHat is given, else
+    FONT_5X7; unknown characters come out as '?'.
+    """
+
+    def __init__(self, sense=None):
+        self.sense = sense if hasattr(sense, "_get_char_pixels") else None
+        self._glyphs = {}
+
+    def glyph(self, ch):
+        mask = self._glyphs.get(ch)
+        if mask is None:
+            mask = self._glyphs[ch] = self._load(ch)
+        return mask
+
+    def _load(self, ch):
+        if self.sense is not None:
+            pixels = self.sense._trim_whitespace(self.sense._get_char_pixels(ch))
+            # the library draws text rotated: each run of 8 pixels is a
+            # column, bottom row first
+            cols = np.asarray(pixels).reshape(-1, 8, 3).any(axis=2)
+            return cols.T[::-1]
+        rows = FONT_5X7.get(ch, FONT_5X7["?"])
+        mask = np.zeros((8, 5), bool)
+        for r, bits in enumerate(rows):
+            for c in range(5):
+                mask[r + 1, c] = bool(bits & (0x10 >> c))
+        # trim blank columns either side like the library does
+        used = np.flatnonzero(mask.any(axis=0))
+        if not len(used):
+            return mask[:, :3]
+        return mask[:, used[0]:used[-1] + 1]
+
+
+class FrameCache(object):
+    """ LRU cache of rendered frame sequences """
+
+    def __init__(self, font, size=64):
+        self.font = font
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def _get(self, key, make):
+        frames = self._cache.get(key)
+        if frames is not None:
+            self.hits += 1
+            self._cache[key] = self._cache.pop(key)
+            return frames
+        self.misses += 1
+        frames = make()
+        self._cache[key] = frames
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        return frames
+
+    def message(self, text, fg=WHITE, bg=BLACK, rotation=0):
+        """ Every frame of text scrolling through, (n, 8, 8, 3) """
+        key = ("text", text, tuple(fg), tuple(bg), rotation)
+        return self._get(key, lambda: self._render(text, fg, bg, rotation))
+
+    def _render(self, text, fg, bg, rotation):
+        # eight blank columns either side and one after every letter
+        blank = np.zeros((8, 8), bool)
+        gap = np.zeros((8, 1), bool)
+        parts = [blank]
+        for ch in text:
+            parts.extend([self.font.glyph(ch), gap])
+        parts.append(blank)
+        mask = np.concatenate(parts, axis=1)
+        canvas = np.where(mask[..., None], np.array(fg, np.uint8),
+                          np.array(bg, np.uint8)).astype(np.uint8)
+        n = canvas.shape[1] - 8
+        frames = np.stack([canvas[:, i:i + 8] for i in range(n)])
+        if rotation:
+            frames = np.stack([rotate(f, rotation) for f in frames])
+        frames.setflags(write=False)
+        return frames
+
+    def image(self, frame, rotation=0):
+        frame = to_frame(frame)
+        key = ("image", frame.tobytes(), rotation)
+        return self._get(key, lambda: rotate(frame, rotation)[None])
+
+
+# ============================================================================
+# LED BACKENDS
+# ============================================================================
+
+class FramebufferLED(object):
+    """ Writes whole frames to the Sense HAT framebuffer device """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY)
+
+    def push(self, frame):
+        data = rgb565(frame)
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._fd, data, 0)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, data)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SenseLED(object):
+    """ Pushes frames through set_pixels() (fakes, or a SenseHat without /dev/fb) """
+
+    def __init__(self, sense):
+        self.sense = sense
+
+    def push(self, frame):
+        self.sense.set_pixels(frame.reshape(64, 3).tolist())
+
+
+class FakeLED(object):
+    """ Keeps the last frame and counts them """
+
+    def __init__(self):
+        self.frame = np.zeros((8, 8, 3), np.uint8)
+        self.frames = 0
+
+    def push(self, frame):
+        self.frame = frame
+        self.frames += 1
+
+
+def led_for(sense):
+    """ The fastest backend for a SenseHat (or a fake one) """
+    path = getattr(sense, "_fb_device", None)
+    if path:
+        try:
+            return FramebufferLED(path)
+        except OSError:
+            pass
+    return SenseLED(sense)
+
+
+# ============================================================================
+# DISPLAY THREAD
+# ============================================================================
+
+class Display(threading.Thread):
+    """ Plays queued frame sequences on an LED backend from its own thread
+
+    Each queued item is (frames, seconds per frame). play() replaces
+    whatever is still waiting, so a slow scroll never builds a backlog.
+    """
+
+    def __init__(self, led, font=None, scroll_speed=0.1, cache_size=64):
+        threading.Thread.__init__(self, name="display")
+        self.daemon = True
+        self.led = led
+        self.scroll_speed = scroll_speed
+        self.cache = FrameCache(font or Font(), cache_size)
+        self.rotation = 0
+        self.pushed = 0
+        self.skipped = 0
+        self.dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._last = None
+
+    # ---- building sequences (cheap, cached) -------------------------------
+
+    def message(self, text, text_colour=WHITE, back_colour=BLACK):
+        return (self.cache.message(text, text_colour, back_colour, self.rotation),
+                self.scroll_speed)
+
+    def image(self, pixels, hold=0.0):
+        return self.cache.image(pixels, self.rotation), hold
+
+    def spin(self, pixels, hold=1.0):
+        """ The image turned through 90, 180, 270 and back to 0 (rot_display) """
+        return [(self.cache.image(pixels, (self.rotation + r) % 360), hold)
+                for r in (0, 90, 180, 270)] + [self.image(pixels)]
+
+    def blank(self, colour=BLACK):
+        return self.image(np.tile(np.array(colour, np.uint8), (64, 1)))
+
+    # ---- queueing (never blocks) ------------------------------------------
+
+    def play(self, items):
+        """ Replace anything not yet started with items (a list of sequences) """
+        with self._cond:
+            self.dropped += len(self._items)
+            self._items.clear()
+            self._items.extend(items)
+            self._cond.notify()
+
+    def add(self, items):
+        with self._cond:
+            self._items.extend(items)
+            self._cond.notify()
+
+    def show_message(self, text, text_colour=WHITE, back_colour=BLACK):
+        self.add([self.message(text, text_colour, back_colour)])
+
+    def set_pixels(self, pixels):
+        self.add([self.image(pixels)])
+
+    def idle(self):
+        with self._cond:
+            return not self._items
+
+    # ---- the thread ---------------------------------------------------------
+
+    def _push(self, frame):
+        if self._last is not None and np.array_equal(frame, self._last):
+            self.skipped += 1
+            return
+        self.led.push(frame)
+        self._last = frame
+        self.pushed += 1
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                frames, hold = self._items.popleft()
+            # frame times are kept on a fixed grid, not sleep-after-push
+            due = monotonic()
+            for frame in frames:
+                self._push(frame)
+                due += hold
+                delay = due - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if self._stopping:
+                    return
+
+    def stop(self, timeout=5.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        return "Display: {} frames pushed, {} unchanged, {} sequences dropped, " \
+               "cache {} hits / {} misses".format(self.pushed, self.skipped,
+                                                  self.dropped, self.cache.hits,
+                                                  self.cache.misses)
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def _legacy_push(fb, pixel_list, pix_map):
+    # SenseHat.set_pixels() as the library does it, into a file object
+    for index, pix in enumerate(pixel_list):
+        fb.seek(pix_map[index // 8][index % 8] * 2)
+        r = (pix[0] >> 3) & 0x1F
+        g = (pix[1] >> 2) & 0x3F
+        b = (pix[2] >> 3) & 0x1F
+        fb.write(struct.pack('H', (r << 11) + (g << 5) + b))
+
+
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench(path="/tmp/display_bench.fb", rounds=50):
+    """ CPU per frame: library-style per-pixel writes vs cached NumPy frames """
+    with open(path, "wb") as f:
+        f.write(b"\0" * 128)
+    messages = ["68.9F", "45%", "1h 70.2F"]
+    pix_map = np.arange(64).reshape(8, 8)
+
+    # the old way: build the pixel lists and write each pixel (no sleeping)
+    start = _cpu()
+    frames = 0
+    for _ in range(rounds):
+        for text in messages:
+            rendered = FrameCache(Font()).message(text)  # render every time
+            for frame in rendered:
+                with open(path, "r+b") as fb:
+                    _legacy_push(fb, frame.reshape(64, 3).tolist(), pix_map)
+                frames += 1
+    legacy = (_cpu() - start) / frames
+
+    led = FramebufferLED(path)
+    display = Display(led, scroll_speed=0.0)
+    display.start()
+    start = _cpu()
+    wall = monotonic()
+    for _ in range(rounds):
+        display.add([display.message(text) for text in messages])
+    while not display.idle():
+        time.sleep(0.01)
+    display.stop()
+    took = monotonic() - wall
+    new = (_cpu() - start) / frames
+    led.close()
+    print("{} frames of {}".format(frames, ", ".join(messages)))
+    print("per-pixel writes, rendered each time: {:7.1f} us CPU/frame".format(legacy * 1e6))
+    print("Display thread, cached + RGB565 push: {:7.1f} us CPU/frame, "
+          "{:.0f} frames/s max".format(new * 1e6, frames / took))
+    print(display.stats())
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
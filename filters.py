@@ -0,0 +1,346 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - streaming filters
+
+    Per-sensor smoothing to replace get_smooth(). A FilterBank holds one
+    chain of filters per channel, each with its own ring buffer, so any
+    number of signals can be smoothed independently:
+
+        MovingAverage   running sum over a ring buffer, O(1)
+        EWMA            exponentially weighted average, O(1)
+        RollingMedian   sorted window kept with bisect, O(log n) search
+        OutlierReject   swaps a sample far outside the window's spread
+                        (median +- k * IQR) for the window median
+
+    Every filter also has batch(x), which runs the same filter over a
+    whole NumPy array of history and gives the same answers as feeding
+    the samples in one by one. Missing samples (None / NaN) pass through
+    without touching the filter state.
+
+    Run this file for a microbenchmark against the old get_smooth().
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import bisect
+import math
+import timeit
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    np = None
+
+
+def _missing(x):
+    return x is None or x != x
+
+
+def _windows(x, window):
+    """ (len(x), window) view: row i is x[i-window+1 .. i], NaN before the start """
+    padded = np.concatenate([np.full(window - 1, np.nan), x])
+    step = padded.strides[0]
+    return as_strided(padded, shape=(len(x), window), strides=(step, step),
+                      writeable=False)
+
+
+def _rolling_quantiles(windows, q):
+    """ Percentiles q of each row of _windows(), shape (len(q), rows) """
+    # missing samples never reach here, so only the first rows (still
+    # filling up) have NaN padding; the rest go through np.percentile at once
+    out = np.empty((len(q), len(windows)))
+    partial = min(np.isnan(windows[:, 0]).sum(), len(windows))
+    if partial < len(windows):
+        out[:, partial:] = np.percentile(windows[partial:], q, axis=1)
+    for i in range(partial):
+        row = windows[i]
+        out[:, i] = np.percentile(row[~np.isnan(row)], q)
+    return out
+
+
+def _skip_missing(func):
+    """ Run a batch function over the present samples only, NaN elsewhere """
+    def batch(self, x):
+        x = np.asarray(x, np.float64)
+        out = np.full(len(x), np.nan)
+        present = ~np.isnan(x)
+        if present.any():
+            out[present] = func(self, x[present])
+        return out
+    batch.__doc__ = func.__doc__
+    return batch
+
+
+def _quantile(ordered, q):
+    """ Linear-interpolated quantile of a sorted list (numpy's default) """
+    pos = q * (len(ordered) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+class MovingAverage(object):
+    """ Mean of the last 'window' samples
+
+    With prime=True the first sample fills the whole window, which is what
+    get_smooth() did; otherwise the mean is over the samples seen so far.
+    """
+
+    def __init__(self, window=3, prime=False):
+        self.window = window
+        self.prime = prime
+        self.reset()
+
+    def reset(self):
+        self._buf = []
+        self._pos = 0
+        self._sum = 0.0
+
+    def update(self, x):
+        if _missing(x):
+            return None
+        buf = self._buf
+        if not buf and self.prime:
+            self._buf = buf = [x] * self.window
+            self._sum = x * self.window
+        if len(buf) < self.window:
+            buf.append(x)
+            self._sum += x
+        else:
+            self._sum += x - buf[self._pos]
+            buf[self._pos] = x
+            self._pos += 1
+            if self._pos == self.window:
+                # re-add from scratch once per lap so rounding can't creep in
+                self._pos = 0
+                self._sum = math.fsum(buf)
+        return self._sum / len(buf)
+
+    @_skip_missing
+    def batch(self, x):
+        """ Moving average over a whole array """
+        if self.prime:
+            x = np.concatenate([np.full(self.window - 1, x[0]), x])
+            csum = np.cumsum(np.concatenate([[0.0], x]))
+            return (csum[self.window:] - csum[:-self.window]) / self.window
+        csum = np.cumsum(np.concatenate([[0.0], x]))
+        n = np.arange(1, len(x) + 1)
+        lo = np.maximum(n - self.window, 0)
+        return (csum[n] - csum[lo]) / (n - lo)
+
+
+class EWMA(object):
+    """ Exponentially weighted moving average, y += alpha * (x - y) """
+
+    def __init__(self, alpha=0.3):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self._y = None
+
+    def update(self, x):
+        if _missing(x):
+            return None
+        if self._y is None:
+            self._y = float(x)
+        else:
+            self._y += self.alpha * (x - self._y)
+        return self._y
+
+    @_skip_missing
+    def batch(self, x):
+        """ EWMA over a whole array, in closed form a block at a time """
+        a = self.alpha
+        d = 1.0 - a
+        out = np.empty(len(x))
+        out[0] = x[0]
+        if d == 0.0:
+            out[:] = x
+            return out
+        # inside a block y[j] = d^(j+1) y_prev + a d^j cumsum(x[k] d^-k);
+        # blocks are short enough that d^-k stays well inside float range
+        block = int(max(1, min(4096, 6.0 / -math.log10(d))))
+        y_prev = x[0]
+        powers = d ** np.arange(block + 1)
+        for start in range(1, len(x), block):
+            chunk = x[start:start + block]
+            k = np.arange(len(chunk))
+            acc = np.cumsum(chunk / powers[k])
+            out[start:start + len(chunk)] = powers[k + 1] * y_prev + a * powers[k] * acc
+            y_prev = out[start + len(chunk) - 1]
+        return out
+
+
+class RollingMedian(object):
+    """ Median of the last 'window' samples """
+
+    def __init__(self, window=5):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._buf = []
+        self._pos = 0
+        self._sorted = []
+
+    def _push(self, x):
+        """ Add x to the window, dropping the oldest sample once full """
+        if len(self._buf) < self.window:
+            self._buf.append(x)
+        else:
+            old = self._buf[self._pos]
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+            self._buf[self._pos] = x
+            self._pos = (self._pos + 1) % self.window
+        bisect.insort(self._sorted, x)
+
+    def update(self, x):
+        if _missing(x):
+            return None
+        self._push(x)
+        return _quantile(self._sorted, 0.5)
+
+    @_skip_missing
+    def batch(self, x):
+        """ Rolling median over a whole array """
+        return _rolling_quantiles(_windows(x, self.window), [50])[0]
+
+
+class OutlierReject(RollingMedian):
+    """ Replace samples far from the recent median with that median
+
+    A sample is an outlier when it is more than k robust standard
+    deviations (IQR / 1.349, at least min_scale) from the median of the
+    previous 'window' samples. Outliers still go into the window, so a
+    real step change is accepted once it fills half of it.
+    """
+
+    def __init__(self, window=15, k=4.0, min_scale=0.0, min_samples=5):
+        self.k = k
+        self.min_scale = min_scale
+        self.min_samples = min_samples
+        self.rejected = 0
+        super(OutlierReject, self).__init__(window)
+
+    def update(self, x):
+        if _missing(x):
+            return None
+        out = x
+        ordered = self._sorted
+        if len(ordered) >= self.min_samples:
+            median = _quantile(ordered, 0.5)
+            iqr = _quantile(ordered, 0.75) - _quantile(ordered, 0.25)
+            scale = max(iqr / 1.349, self.min_scale)
+            if abs(x - median) > self.k * scale:
+                out = median
+                self.rejected += 1
+        self._push(x)
+        return out
+
+    @_skip_missing
+    def batch(self, x):
+        """ Outlier rejection over a whole array """
+        # the window *before* each sample
+        prev = _windows(np.concatenate([[np.nan], x[:-1]]), self.window)
+        out = x.copy()
+        check = np.arange(len(x)) >= self.min_samples
+        if check.any():
+            q25, median, q75 = _rolling_quantiles(prev[check], [25, 50, 75])
+            scale = np.maximum((q75 - q25) / 1.349, self.min_scale)
+            bad = np.abs(x[check] - median) > self.k * scale
+            idx = np.flatnonzero(check)[bad]
+            out[idx] = median[bad]
+        return out
+
+
+class FilterChain(object):
+    """ Filters applied one after another to a single channel """
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+
+    def update(self, x):
+        for f in self.filters:
+            x = f.update(x)
+        return x
+
+    def batch(self, x):
+        for f in self.filters:
+            x = f.batch(x)
+        return x
+
+
+class FilterBank(object):
+    """ One FilterChain per channel, e.g. {"sense_temp": [MovingAverage(3)]} """
+
+    def __init__(self, spec):
+        self.chains = dict((channel, FilterChain(filters))
+                           for channel, filters in spec.items())
+
+    def update(self, channel, x):
+        """ Feed x through the channel's chain (unknown channels pass through) """
+        chain = self.chains.get(channel)
+        if chain is None:
+            return x
+        return chain.update(x)
+
+    def batch(self, channel, x):
+        chain = self.chains.get(channel)
+        if chain is None:
+            return np.asarray(x, np.float64)
+        return chain.batch(x)
+
+
+# ============================================================================
+# MICROBENCHMARK
+# ============================================================================
+
+def _legacy_get_smooth(x):
+    # get_smooth() from full_ws.py as it was
+    if not hasattr(_legacy_get_smooth, "t"):
+        _legacy_get_smooth.t = [x, x, x]
+    _legacy_get_smooth.t[2] = _legacy_get_smooth.t[1]
+    _legacy_get_smooth.t[1] = _legacy_get_smooth.t[0]
+    _legacy_get_smooth.t[0] = x
+    return (_legacy_get_smooth.t[0] + _legacy_get_smooth.t[1] +
+            _legacy_get_smooth.t[2]) / 3
+
+
+def bench(n=200000):
+    x = 20 + np.cumsum(np.random.RandomState(0).normal(0, 0.05, n))
+    x[::997] += 15  # a few spikes for the outlier filter
+    samples = x.tolist()
+
+    legacy = [_legacy_get_smooth(v) for v in samples]
+    ma = MovingAverage(3, prime=True)
+    assert np.allclose(legacy, [ma.update(v) for v in samples])
+
+    def per_sample(make):
+        f = make()
+        t = timeit.timeit(lambda: [f.update(v) for v in samples], number=1)
+        return t / n * 1e6
+
+    print("{:<22} {:>10} {:>10}  {}".format("filter", "us/sample", "batch ms", "batch == stream"))
+    t = timeit.timeit(lambda: [_legacy_get_smooth(v) for v in samples], number=1)
+    print("{:<22} {:>10.2f} {:>10}".format("get_smooth (old)", t / n * 1e6, "-"))
+    for name, make in [("MovingAverage(3)", lambda: MovingAverage(3, prime=True)),
+                       ("MovingAverage(60)", lambda: MovingAverage(60)),
+                       ("EWMA(0.2)", lambda: EWMA(0.2)),
+                       ("RollingMedian(15)", lambda: RollingMedian(15)),
+                       ("OutlierReject(15)", lambda: OutlierReject(15))]:
+        f = make()
+        stream = np.array([f.update(v) for v in samples])
+        t = timeit.timeit(lambda: make().batch(x), number=1)
+        same = np.allclose(stream, make().batch(x))
+        print("{:<22} {:>10.2f} {:>10.1f}  {}".format(
+            name, per_sample(make), t * 1000, same))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - on-device time-series forecasts
+
+    Small online forecasters that cost the same for every sample, however
+    long the station has been running:
+
+        HoltWinters  additive level + trend + daily season, O(1) per update
+        OnlineAR     autoregressive model of order p refitted by recursive
+                     least squares (calibration.RLS), O(p^2) per update
+
+    ForecastBank keeps one model per channel (temperature, humidity,
+    pressure) and turns every record into short-horizon forecasts for the
+    display and the sinks. backtest() replays historical arrays through a
+    model and measures accuracy against "no change" and the time per update.
+
+    usage: forecast.py [--field F] [--horizon N] [STORE_DIR | log_weather-*.log]
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import math
+import os
+
+import numpy as np
+
+from calibration import RLS
+from scheduler import monotonic
+
+
+def _missing(x):
+    return x is None or x != x
+
+
+class HoltWinters(object):
+    """ Additive Holt-Winters with a season of 'season' steps
+
+    The first full season sets the level and the seasonal profile; until
+    then forecasts are the last value. A missing sample is replaced by the
+    one-step forecast, so the season stays in step through gaps.
+    """
+
+    def __init__(self, season, alpha=0.05, beta=0.001, gamma=0.1):
+        self.season = season
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.level = None
+        self.trend = 0.0
+        self.seasonal = []
+        self._warmup = []
+        self._i = 0
+        self.last = None
+
+    def update(self, x):
+        if _missing(x):
+            if self.level is None:
+                return
+            x = self.forecast(1)[0]
+        self.last = x
+        if self.level is None:
+            self._warmup.append(x)
+            if len(self._warmup) == self.season:
+                self.level = sum(self._warmup) / self.season
+                self.seasonal = [v - self.level for v in self._warmup]
+                self._warmup = None
+            return
+        s = self.seasonal[self._i]
+        level = self.level
+        self.level = self.alpha * (x - s) + (1 - self.alpha) * (level + self.trend)
+        self.trend = self.beta * (self.level - level) + (1 - self.beta) * self.trend
+        self.seasonal[self._i] = self.gamma * (x - self.level) + (1 - self.gamma) * s
+        self._i = (self._i + 1) % self.season
+
+    def forecast(self, horizon):
+        """ Forecasts for the next 1..horizon steps """
+        if self.level is None:
+            return [self.last] * horizon
+        return [self.level + h * self.trend +
+                self.seasonal[(self._i + h - 1) % self.season]
+                for h in range(1, horizon + 1)]
+
+
+class OnlineAR(object):
+    """ AR(p) on the step-to-step changes, fitted by RLS as data arrives
+
+    d[t] = a1 d[t-1] + ... + ap d[t-p] with d[t] = x[t] - x[t-1]; working
+    on the changes keeps the iterated forecast from running away the way
+    a level AR with a near-unit root does.
+    """
+
+    def __init__(self, order=6, lam=0.999):
+        self.order = order
+        self.rls = RLS([0.0] * order, lam=lam)
+        self.diffs = []
+        self.last = None
+
+    def update(self, x):
+        if _missing(x):
+            if len(self.diffs) < self.order:
+                return
+            x = self.forecast(1)[0]
+        if self.last is not None:
+            d = x - self.last
+            if len(self.diffs) == self.order:
+                self.rls.update(self.diffs, d)
+                self.diffs.pop()
+            self.diffs.insert(0, d)
+        self.last = x
+
+    def forecast(self, horizon):
+        if len(self.diffs) < self.order:
+            return [self.last] * horizon
+        theta = self.rls.theta
+        lags = list(self.diffs)
+        level = self.last
+        out = []
+        for _ in range(horizon):
+            d = float(sum(t * v for t, v in zip(theta, lags)))
+            level += d
+            out.append(level)
+            lags.pop()
+            lags.insert(0, d)
+        return out
+
+
+def default_models(step_minutes=1):
+    """ Forecasters for temperature, humidity and pressure """
+    day = int(24 * 60 // step_minutes)
+    return {
+        "t_tecf": HoltWinters(day),
+        "h_dht": HoltWinters(day),
+        "pressure": OnlineAR(order=6),
+    }
+
+
+class ForecastBank(object):
+    """ One forecaster per channel, updated from every record """
+
+    def __init__(self, models, horizon=60):
+        self.models = models
+        self.horizon = horizon
+
+    def update(self, record):
+        """ Update each model, returns {channel: [forecast for 1..horizon steps]} """
+        out = {}
+        for channel, model in self.models.items():
+            model.update(record.get(channel))
+            forecast = model.forecast(self.horizon)
+            if forecast[0] is not None:
+                out[channel] = forecast
+        return out
+
+
+# ============================================================================
+# BACKTEST
+# ============================================================================
+
+def resample(ts_us, values, step):
+    """ Mean per 'step'-second bucket on a regular grid (NaN for gaps) """
+    ts = np.asarray(ts_us) // 1000000
+    values = np.asarray(values, np.float64)
+    ok = ~np.isnan(values)
+    ts, values = ts[ok], values[ok]
+    if not len(ts):
+        return np.zeros(0, np.int64), np.zeros(0)
+    start = ts.min() // step * step
+    idx = (ts - start) // step
+    n = int(idx.max()) + 1
+    sums = np.bincount(idx, weights=values, minlength=n)
+    counts = np.bincount(idx, minlength=n)
+    with np.errstate(invalid="ignore"):
+        grid = sums / counts
+    return start + np.arange(n) * step, grid
+
+
+def backtest(model, series, horizon):
+    """ Feed a regular series through model, scoring the horizon-step forecast """
+    n = len(series)
+    predicted = np.full(n, np.nan)
+    updating = forecasting = 0.0
+    for i in range(n):
+        start = monotonic()
+        model.update(series[i])
+        mid = monotonic()
+        if i + horizon < n:
+            predicted[i + horizon] = model.forecast(horizon)[-1]
+        updating += mid - start
+        forecasting += monotonic() - mid
+    naive = np.full(n, np.nan)
+    naive[horizon:] = series[:-horizon]
+    ok = ~np.isnan(predicted) & ~np.isnan(series) & ~np.isnan(naive)
+    # skip the first two days so the seasonal models have warmed up
+    ok[:min(n, 2 * 1440)] = False
+    err = predicted[ok] - series[ok]
+    naive_err = naive[ok] - series[ok]
+    return {
+        "points": int(ok.sum()),
+        "mae": float(np.mean(np.abs(err))) if len(err) else float("nan"),
+        "rmse": float(np.sqrt(np.mean(err ** 2))) if len(err) else float("nan"),
+        "naive_mae": float(np.mean(np.abs(naive_err))) if len(err) else float("nan"),
+        "us_per_update": updating / max(n, 1) * 1e6,
+        "us_per_forecast": forecasting / max(n, 1) * 1e6,
+    }
+
+
+def synthetic(days=30, seed=0):
+    """ Minute temperatures with a daily cycle, weather drift and noise """
+    rs = np.random.RandomState(seed)
+    t = np.arange(days * 1440)
+    drift = np.cumsum(rs.normal(0, 0.02, len(t)))
+    return 60 + 12 * np.sin(2 * math.pi * (t / 1440.0 - 0.3)) + drift + rs.normal(0, 0.3, len(t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the forecasters")
+    parser.add_argument("sources", nargs="*", help="a tsstore directory or log files")
+    parser.add_argument("--field", default="t_tecf")
+    parser.add_argument("--horizon", type=int, default=60, help="steps (minutes) ahead")
+    args = parser.parse_args()
+
+    if not args.sources:
+        series = synthetic()
+        print("synthetic: {} minutes".format(len(series)))
+    else:
+        from log_import import load_logs
+        from tsstore import TSStore
+        if len(args.sources) == 1 and os.path.isdir(args.sources[0]):
+            arrays = TSStore(args.sources[0]).read(fields=(args.field,))
+        else:
+            arrays = load_logs(args.sources)[0]
+        series = resample(arrays["ts"], arrays[args.field], 60)[1]
+        print("{}: {} minutes".format(args.field, len(series)))
+
+    for name, model in [("holt-winters", HoltWinters(1440)), ("ar(6)", OnlineAR(6))]:
+        r = backtest(model, series, args.horizon)
+        print("{:<13} {}-step MAE {:.3f} RMSE {:.3f} (no-change MAE {:.3f}) over {} "
+              "points, {:.1f} us/update, {:.1f} us/forecast".format(
+                  name, args.horizon, r["mae"], r["rmse"], r["naive_mae"],
+                  r["points"], r["us_per_update"], r["us_per_forecast"]))
+
+
+if __name__ == "__main__":
+    main()
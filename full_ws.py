@@ -1,555 +1,825 @@
-#!/usr/bin/python
-"""
-******************************************************************************
-    Pi Temperature Station
-
-    This is a Raspberry Pi project that measures weather data 
-    (Current: temperature, humidity and pressure
-    Future: Wind, rain) 
-    
-    It uses the Astro Pi Sense HAT, a DHT11, a DS18B20, and LDR sensors 
-    
-    it uploads the data to a various locations 
-    (Current: Weather Underground weather PWS, a personal mySQL site, 
-    Future: AWS, GCP)
-
-    Future Work:
-    Time-series forcasts 
-    data comparitor
-    Hard-reset via relay
-
-******************************************************************************
-"""
-# might want to know why I need this... 
-from __future__ import print_function
-
-import datetime
-import dht11
-import glob
-import os
-import RPi.GPIO as GPIO
-import sys
-import time
-import urllib2
-
-from config import Config
-from sense_hat import SenseHat
-from urllib import urlencode
-
-# ============================================================================
-# For Reading the 7Q-Tek 18B20 Temperature sensor
-# ============================================================================
-
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
- 
-base_dir = '/sys/bus/w1/devices/'
-device_folder = glob.glob(base_dir + '28*')[0]
-device_file = device_folder + '/w1_slave'
- 
-# ============================================================================
-# CONSTANTS
-# ============================================================================
-
-# specifies how often to measure values from the Sense HAT (in minutes)
-MEASUREMENT_INTERVAL = 1  # minutes
-# Set to False when testing the code and/or hardware
-# Set to True to enable upload of weather data to Weather Underground
-WEATHER_UPLOAD = True
-# the weather underground URL used to upload weather data
-WU_URL = "http://weatherstation.wunderground.com/weatherstation/updateweatherstation.php"
-# some string constants
-SINGLE_HASH = "#"
-HASHES = "################################################"
-SLASH_N = "\n"
-
-# constants used to display an up and down arrows plus bars
-# modified from https://www.raspberrypi.org/learning/getting-started-with-the-sense-hat/worksheet/
-# set up the colours (blue, red, empty)
-
-# ============================================================================
-# GPIO
-# ============================================================================
-
-# initialize GPIO
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-GPIO.cleanup()
-
-# read data using pin 26
-instance = dht11.DHT11(pin=26)
-
-# ============================================================================
-# DEFINE DISPLAY VARIABLES
-# ============================================================================
-
-b = [0, 0, 255]     # blue
-r = [255, 0, 0]     # red
-g = [0, 255, 0]     # green
-e = [0, 0, 0]       # empty
-w = [255, 255, 255] # white
-
-# DEFINE IMAGES
-
-arrow_up = [
-    e, e, e, g, g, e, e, e,
-    e, e, g, g, g, g, e, e,
-    e, g, g, g, g, g, g, e,
-    g, g, e, g, g, e, g, g,
-    g, e, e, g, g, e, e, g,
-    e, e, e, g, g, e, e, e,
-    e, e, e, g, g, e, e, e,
-    e, e, e, g, g, e, e, e
-]
-
-arrow_down = [
-    e, e, e, g, g, e, e, e,
-    e, e, e, g, g, e, e, e,
-    e, e, e, g, g, e, e, e,
-    g, e, e, g, g, e, e, g,
-    g, g, e, g, g, e, g, g,
-    e, g, g, g, g, g, g, e,
-    e, e, g, g, g, g, e, e,
-    e, e, e, g, g, e, e, e
-]
-
-eq_bars = [
-    e, e, e, e, e, e, e, e,
-    e, w, w, w, w, w, w, e,
-    e, w, w, w, w, w, w, e,    
-    e, e, e, e, e, e, e, e,
-    e, w, w, w, w, w, w, e,
-    e, w, w, w, w, w, w, e,
-    e, e, e, e, e, e, e, e,
-    e, e, e, e, e, e, e, e
-]
-
-q_mark = [
-    e, e, e, g, g, e, e, e,
-    e, e, w, e, e, w, e, e,
-    e, e, e, e, e, r, e, e,
-    e, e, e, e, r, e, e, e,
-    e, e, e, g, e, e, e, e,
-    e, e, e, w, e, e, e, e,
-    e, e, e, e, e, e, e, e,
-    e, e, e, r, e, e, e, e
-]
-
-# ============================================================================
-# FUNCTIONS
-# ============================================================================
-
-# Weather Station Upload / Download / log functions
-def log_weather(temp_f, t_hum, t_press, pressure, humidity, t_cpu, t_dht, h_dht,
-                        dew_pt_dht, t_tecf, dew_pt_tec):
-
-    timestr = time.strftime("%Y%m%d")
-    f_loc = "/home/pi/pi_weather_station/Logs/"
-    f_name = f_loc + "log_weather-{}.log".format(timestr)
-
-    with open(f_name, "a") as log:
-        log.write("{}, {}, {}, {}, {}, {}%, {}, {}, {}%, {}, {}, {} \n".format(
-            str(datetime.datetime.now()),temp_f, t_hum, t_press, pressure, 
-            humidity, t_cpu, t_dht, h_dht, dew_pt_dht, t_tecf, dew_pt_tec)) 
-      
-    return
-
-
-def upload_weather(wu_station_id, wu_station_key, temp_f, dew_ptf, 
-                    humidity, pressure):
-    """ Upload Data to Weather Underground """
-    # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
-    # link is broken, some bindings can be found here:
-    # https://www.openhab.org/addons/bindings/weatherunderground/
-    print("Uploading data to Weather Underground")
-    # build a weather data object
-    weather_data = {
-        "action": "updateraw",
-        "ID": wu_station_id,
-        "PASSWORD": wu_station_key,
-        "dateutc": "now",
-        "tempf": str(temp_f),
-        "dewPtF": str(dew_ptf),
-        "humidity": str(humidity),
-        "baromin": str(pressure),
-    }
-    try:
-        upload_url = WU_URL + "?" + urlencode(weather_data)
-        response = urllib2.urlopen(upload_url)
-        html = response.read()
-        print("Server response:", html)
-        # do something
-        response.close()  # best practice to close the file
-    except:
-        print("Exception:", sys.exc_info()[0], SLASH_N)
-                    
-
-# Display manipulations
-def reset_pixels(pixelx):
-    cell = []
-    px = []
-    for i in pixelx:
-        for j in i:
-            cell.append(int(j))
-        px.append(cell[-3:])
-    return(px)
-
-def next_colour(pix):
-    r = pix[0]
-    g = pix[1]
-    b = pix[2]
-
-    # Simple adder, placehold for more complex operations
-    if (r == 255):
-        r = 0
-    else:
-        r += 1
-    if (g == 255):
-        g = 0
-    else:
-        g += 1
-    if (b == 255):
-        b = 0
-    else:
-        b += 1
-
-    pix[0] = r
-    pix[1] = g
-    pix[2] = b
-
-    return (pix)
-
-def rot_display():
-    time.sleep(1)
-    sense.set_rotation(90)
-    time.sleep(1)
-    sense.set_rotation(180)
-    time.sleep(1)
-    sense.set_rotation(270)
-    time.sleep(1)
-    sense.set_rotation(0)
-    return 
-
-# Climate Calculations
-def rht_to_dp(temp, rh):
-    """ Takes Relative Humidity & Temperature then coverts to Dew Point """
-    # from https://en.wikipedia.org/wiki/Dew_point
-    dp = temp - (0.36 * (100 - rh))
-    # Check Calc
-    # print("Temp: {} RH: {} DP: {}".format(temp, rh, dp))
-    return dp
-
-def degc_to_degf(input_temp):
-    """ Convert input temp from Celcius to Fahrenheit """
-    return (input_temp * 1.8) + 32
-
-def pa_to_inches(pressure_in_pa):
-    """ Convert pressure in Pascal to mmHg """
-    pressure_in_inches_of_m = pressure_in_pa * 0.02953
-    return pressure_in_inches_of_m
-
-def mm_to_inches(rainfall_in_mm):
-    """ Convert rainfall in millimeters to Inches """
-    rainfall_in_inches = rainfall_in_mm * 0.0393701
-    return rainfall_in_inches
-
-def khm_to_mph(speed_in_kph):
-    """ Convert speed in kph to MPH  """
-    # for wind speed, when I find a way to measure
-    speed_in_mph = speed_in_kph * 0.621371
-    return speed_in_mph
-
-# Sensor Data Collection and Calculations
-
-# One-wire connection, for 18B20 Temperature Sensor
-def read_w1_temp_raw():
-    f = open(device_file, 'r')
-    lines = f.readlines()
-    f.close()
-    return lines
- 
-def read_w1_temp():
-    lines = read_w1_temp_raw()
-    while lines[0].strip()[-3:] != 'YES':
-        time.sleep(0.2)
-        lines = read_w1_temp_raw()
-    equals_pos = lines[1].find('t=')
-    if equals_pos != -1:
-        temp_string = lines[1][equals_pos+2:]
-        temp_c = float(temp_string) / 1000.0
-        return temp_c
-
-def get_cpu_temp():
-    # 'borrowed' from https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
-    # executes a command at the OS to pull in the CPU temperature
-    res = os.popen('vcgencmd measure_temp').readline()
-    return float(res.replace("temp=", "").replace("'C\n", ""))
-
-
-# use moving average to smooth readings
-def get_smooth(x):
-    # do we have the t object?
-    if not hasattr(get_smooth, "t"):
-        # then create it
-        get_smooth.t = [x, x, x]
-    # manage the rolling previous values
-    # should be a way to do this part cleaner...
-    get_smooth.t[2] = get_smooth.t[1]
-    get_smooth.t[1] = get_smooth.t[0]
-    get_smooth.t[0] = x
-    # average the three last temperatures
-    xs = (get_smooth.t[0] + get_smooth.t[1] + get_smooth.t[2]) / 3
-    # print("3 temps to ave: {}, {}, {}".format(
-    #     get_smooth.t[0], get_smooth.t[1], get_smooth.t[2]))
-    # print("With result: {}".format(xs))
-    return xs
-
-
-def get_sense_temp():
-    # ====================================================================
-    # Unfortunately, getting an accurate temperature reading from the
-    # Sense HAT is improbable, see here:
-    # https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
-    # so we'll have to do some approximation of the actual temp
-    # taking CPU temp into account. The Pi foundation recommended
-    # using the following:
-    # http://yaab-arduino.blogspot.co.uk/2016/08/accurate-temperature-reading-sensehat.html
-    # ====================================================================
-    # First, get temp readings from both sensors
-    t1 = sense.get_temperature_from_humidity()
-    t2 = sense.get_temperature_from_pressure()
-    # t becomes the average of the temperatures from both sensors
-    
-    #currently t humidity doesn't work, thus:
-    t = t2
-    #t = (t1 + t2) / 2
-    # Now, grab the CPU temperature
-    t_cpu = get_cpu_temp()
-    # Calculate the 'real' temperature compensating for CPU heating
-    t_corr = t - ((t_cpu - t) / 1.5)
-    # Finally, average out that value across the last three readings
-    t_corr = get_smooth(t_corr)
-    # convoluted, right?
-    # Return the calculated temperature
-
-    return t_corr
-
-def get_ext_sensor_data():
-
-    return TBD 
-
-def main():
-
-    # Global needed???    
-    global last_temp
-
-    # Initialize some variables (in case of error):
-    t_dht = []
-    h_dht = []
-    dew_pt_dht = []
-    dew_pt_tec = []
-    current_minute = datetime.datetime.now().minute
-
-    # initialize the lastMinute variable to the current time to start
-    last_minute = datetime.datetime.now().minute
-    # on startup, just use the previous minute as lastMinute
-    last_minute -= 1
-    if last_minute == 0:
-        last_minute = 59
-
-    # infinite loop to continuously check weather values
-    while 1:
-        # The temp measurement smoothing algorithm's accuracy is based
-        # on frequent measurements, so we'll take measurements every 5 seconds
-        # but only upload on measurement_interval
-        current_second = datetime.datetime.now().second
-
-        # restrict measurement frequency to 5sec, should be good for all connected devices
-        # are we at the top of the minute or at a 5 second interval?
-        if (current_second == 0) or ((current_second % 5) == 0):
-            # ========================================================
-            # read values from the Sense HAT
-            # ========================================================
-            # Calculate the temperature. The get_sense_temp function 'adjusts' the recorded temperature adjusted for the
-            # current processor temp in order to accommodate any temperature leakage from the processor to
-            # the Sense HAT's sensor. This happens when the Sense HAT is mounted on the Pi in a case.
-            # If you've mounted the Sense HAT outside of the Raspberry Pi case, then you don't need that
-            # calculation. So, when the Sense HAT is external, replace the following line (comment it out  with a #)
-            # calc_temp = get_sense_temp()
-            # with the following line (uncomment it, remove the # at the line start)
-            # calc_temp = sense.get_sense_temperature_from_pressure()
-            # or the following line (each will work)
-            # calc_temp = sense.get_sense_temperature_from_humidity()
-            # ========================================================
-            # At this point, we should have an accurate temperature, so lets use the recorded (or calculated)
-            
-            # Sense HAT temps, pressure, humidity
-            t_hum = degc_to_degf(sense.get_temperature_from_humidity())
-            t_press = degc_to_degf(sense.get_temperature_from_pressure()) 
-            calc_temp = get_sense_temp()
-            temp_c = round(calc_temp, 1)
-            temp_f = round(degc_to_degf(calc_temp), 1)
-            humidity = sense.get_humidity()
-            t_cpu = degc_to_degf(get_cpu_temp())
-
-            # Tek 18B20 Temp:    
-            t_tecf = degc_to_degf(read_w1_temp())
-
-            # DHT11 Temp & Humidity:
-            result = instance.read()
-            if result.is_valid():
-                t_dht = degc_to_degf(result.temperature)
-                h_dht = result.humidity
-                dew_pt_dht = rht_to_dp(t_dht, h_dht)
-                dew_pt_tec = rht_to_dp(t_tecf, h_dht)
-                
-            # convert pressure from millibars to inHg before posting
-            pressure = round(sense.get_pressure() * 0.0295300, 1)
-            print("Measurement Time:      {}".format(str(datetime.datetime.now())))
-            print("Sense Temp (calc):     {} ".format(temp_f)) 
-            print("Sense Temp (hum):      {} ".format(t_hum))
-            print("Sense Temp (press):    {} ".format(t_press))   
-            print("Sense Pressure (inHg): {} ".format(pressure)) 
-            print("Sense Humidity:        {} % ".format(humidity))
-            print("CPU Temp:              {} ".format(t_cpu))
-            print("DHT11 Temp:            {} ".format(t_dht))
-            print("DHT11 Humidity:        {} % ".format(h_dht))
-            print("DHT11 Dew Point:       {} ".format(dew_pt_dht))
-            print("Tek38B10 Temp:         {} ".format(t_tecf))
-            print("Tek38B10 Dew Point:    {} ".format(dew_pt_tec))
-
-            sense.low_light = True
-            if ((current_minute % 2) == 0):
-                sense.show_message("%sF" %round(((t_tecf+temp_f)/2),1), text_colour=r)
-                sense.show_message("%s%%" %h_dht, text_colour=g)
-                time.sleep(5)
-            
-            else:
-                sense.show_message("%sF" %round(((t_tecf+temp_f)/2),1), text_colour=w)
-                sense.show_message("%s%%" %h_dht, text_colour=g)
-                time.sleep(5)
-
-            # Assine the bew dew point calculation for upload
-            dew_ptf = dew_pt_tec
-            # get the current minute
-            current_minute = datetime.datetime.now().minute
-            # is it the same minute as the last time we checked?
-            if current_minute != last_minute:
-                # reset last_minute to the current_minute
-                last_minute = current_minute
-                # is minute zero, or divisible by 10?
-                # we're only going to take measurements every MEASUREMENT_INTERVAL minutes
-                if (current_minute == 0) or ((current_minute % MEASUREMENT_INTERVAL) == 0):
-                    # get the reading timestamp
-                    now = datetime.datetime.now()
-                    print("\n%d minute mark (%d @ %s)" % (MEASUREMENT_INTERVAL, current_minute, str(now)))
-                    
-                    # did the temperature go up or down?
-                    # Better to compare floats with a tolerances
-                    tolerance = 0.2
-                    if abs(last_temp - t_tecf) >= tolerance:
-                        if (last_temp - t_tecf) < 0:
-                            # display a down arrow
-                            sense.set_pixels(arrow_down)			    
-                            # rot_display() 
-                            
-                            #time.sleep(5)
-			                #sense.show_message("%sF" %t_tecf, text_colour=b)
-                            
-
-                        else:
-                            # display a up arrow
-			                #sense.show_message("%sF" %t_tecf, text_colour=r)
-                            # time.sleep(5)
-                            sense.set_pixels(arrow_up)
-                            # rot_display() 
-			                
-
-                    else:
-                        # temperature stayed the same
-                        # display red and blue bars
-                        #sense.show_message("%sF" %t_tecf, text_colour=w)
-                        # time.sleep(5)
-                        sense.set_pixels(eq_bars)
-                        rot_display()
-                        # rot_display()
-
-                    # set last_temp to the current temperature before we measure again
-                    last_temp = t_tecf
-
-                    # is weather upload enabled (True)?
-                    if WEATHER_UPLOAD:
-                        upload_weather(wu_station_id, 
-                                        wu_station_key, 
-                                        temp_f, dew_ptf, 
-                                        h_dht, pressure)
-                               
-                        log_weather(temp_f, t_hum, t_press, pressure, humidity, 
-                                    t_cpu, t_dht, h_dht, dew_pt_dht, t_tecf, dew_pt_tec)
-
-                    else:
-                        print("Skipping Weather Underground upload")
-
-        # wait a second then check again
-        # You can always increase the sleep value below to check less often
-        time.sleep(1)  # this should never happen since the above is an infinite loop
-
-    print("Leaving main()")
-
-
-# ============================================================================
-# here's where we start checking stuff
-# ============================================================================
-print(SLASH_N + HASHES)
-print(SINGLE_HASH, "Pi Weather Station                          ", SINGLE_HASH)
-print(SINGLE_HASH, "with Sense HAT, DHT11, and 18B20 sensors    ", SINGLE_HASH)
-print(SINGLE_HASH, "By Mark H Oliver                            ", SINGLE_HASH)
-print(HASHES)
-
-# make sure we don't have a MEASUREMENT_INTERVAL > 60
-if (MEASUREMENT_INTERVAL is None) or (MEASUREMENT_INTERVAL > 60):
-    print("The application's 'MEASUREMENT_INTERVAL' cannot be empty or greater than 60")
-    sys.exit(1)
-
-# ============================================================================
-#  Read Weather Underground Configuration Parameters
-# ============================================================================
-print("\nInitializing Weather Underground configuration")
-wu_station_id = Config.STATION_ID
-wu_station_key = Config.STATION_KEY
-if (wu_station_id is None) or (wu_station_key is None):
-    print("Missing values from the Weather Underground configuration file\n")
-    sys.exit(1)
-
-# we made it this far, so it must have worked...
-print("Successfully read Weather Underground configuration values")
-print("Station ID:", wu_station_id)
-# print("Station key:", wu_station_key)
-
-# ============================================================================
-# initialize the Sense HAT object
-# ============================================================================
-try:
-    print("Initializing the Sense HAT client")
-    sense = SenseHat()
-    # sense.set_rotation(180)
-    # then write some text to the Sense HAT's 'screen'
-    sense.show_message("Init", text_colour=[255, 255, 0], back_colour=[0, 0, 127])
-    # clear the screen
-    sense.clear()
-    # get the current temp to use when checking the previous measurement
-    last_temp = round(degc_to_degf(read_w1_temp()), 1)
-    print("Current temperature reading:", last_temp)
-except:
-    print("Unable to initialize the Sense HAT library:", sys.exc_info()[0])
-    sys.exit(1)
-
-print("Initialization complete!")
-
-# Now see what we're supposed to do next
-if __name__ == "__main__":
-    try:
-        main()
-    except KeyboardInterrupt:
-        print("\nExiting application\n")
-        sys.exit(0)
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Temperature Station
+
+    This is a Raspberry Pi project that measures weather data 
+    (Current: temperature, humidity and pressure
+    Future: Wind, rain) 
+    
+    It uses the Astro Pi Sense HAT, a DHT11, a DS18B20, and LDR sensors 
+    
+    it uploads the data to a various locations 
+    (Current: Weather Underground weather PWS, a personal mySQL site, 
+    Future: AWS, GCP)
+
+    Future Work:
+    Time-series forcasts 
+    data comparitor
+    Hard-reset via relay
+
+******************************************************************************
+"""
+# might want to know why I need this... 
+from __future__ import print_function
+
+import datetime
+import sys
+import threading
+import time
+
+from acquisition import Acquisition, Sensor, SensorError
+from hal import Devices, fake_devices
+from records import FIELDS, make_record
+from scheduler import Scheduler, aligned_offset, monotonic, wall_time
+from uploader import WU_URL, Checkpoint, DiskQueue, WUUploader
+
+# The NumPy-backed modules (meteo, filters, calibration, display, forecast,
+# the store, rollups and sinks, the ring) and the metrics server are
+# imported in main() and the functions below, once the role says they're
+# needed, so importing this module stays quick and starts nothing
+
+# when the process started, for the cold start report
+STARTED = monotonic()
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# specifies how often to measure values from the Sense HAT (in minutes)
+MEASUREMENT_INTERVAL = 1  # minutes
+# how often to read the sensors, and how often to refresh the LED display
+SAMPLE_INTERVAL = 5  # seconds
+DISPLAY_INTERVAL = 15  # seconds
+# names for the DS18B20 probes by 1-Wire device id, e.g.
+# {"28-0316a2794cff": "outdoor", "28-0416a1f0e2ff": "soil"}; unnamed probes
+# go by their id. W1_PRIMARY is the one logged as t_tecf (None = first id)
+W1_PROBES = {}
+W1_PRIMARY = None
+# a sensor with no fresh read for this long is kept out of uploads
+STALE_AFTER = 120  # seconds
+# how often to print the scheduler's overrun/jitter report
+REPORT_INTERVAL = 600  # seconds
+# port for Prometheus to scrape /metrics (and /profile) on, None to turn off
+# (a consumer process, see ROLE below, uses the next port up)
+METRICS_PORT = 9105
+# every sample goes into this shared-memory ring (shm_ring.py) for other
+# processes to read, None = off. Run with --role acquire for a process that
+# only samples, and --role consume for one that reads the ring and does the
+# display, logging and uploads; the default role does everything
+RING_PATH = "/dev/shm/weather_ring"
+RING_POLL = 1  # seconds, how often a consumer checks the ring
+# Set to False when testing the code and/or hardware
+# Set to True to enable upload of weather data to Weather Underground
+WEATHER_UPLOAD = True
+# the station's height above sea level in metres; when set, WU gets the
+# pressure reduced to sea level (meteo.py) like other stations report it,
+# the local store keeps what the Sense HAT reads either way
+ALTITUDE = None
+# binary time-series store of every record (see tsstore.py)
+STORE_DIR = "/home/pi/pi_weather_station/Store/"
+# set to True to keep writing the old log_weather-YYYYMMDD.log text files too
+TEXT_LOG = False
+# saved 1-minute/1-hour/1-day rollups of the store (see rollups.py)
+ROLLUP_FILE = "/home/pi/pi_weather_station/rollups.npz"
+# versioned CPU-heat correction coefficients (see calibration.py)
+CALIBRATION_FILE = "/home/pi/pi_weather_station/calibration.json"
+# on-disk queue of readings waiting to go to Weather Underground
+UPLOAD_QUEUE = "/home/pi/pi_weather_station/wu_queue.db"
+# where uploads go: WU, or a collector.py of your own
+UPLOAD_URL = WU_URL
+# readings WU has taken, shared with backfill.py so it skips them, None = off
+CHECKPOINT = "/home/pi/pi_weather_station/backfill.db"
+# local SQLite copy of every record (a stand-in for the mySQL site), None = off
+SQL_DB = "/home/pi/pi_weather_station/weather.db"
+# directory for hourly JSON-lines batches (an AWS/GCP bucket stand-in), None = off
+OBJECT_STORE = None
+# per-channel compression (compression.py) of what's archived:
+# "deadband", "swinging_door" or None to keep every record in full.
+# Deadband keeps the fewest points on this station's readings
+COMPRESSION = "deadband"
+# compress what goes to WU too; off, WU gets every record with every field
+# (a thinned upload leaves out whatever didn't change) and no added delay
+COMPRESS_UPLOADS = False
+# compress the local store too; it then has to be read back through
+# compression.read_expanded(), which the kind is noted in the store for
+# (the rollups and calibration expect every row)
+COMPRESS_STORE = False
+# some string constants
+SINGLE_HASH = "#"
+HASHES = "################################################"
+SLASH_N = "\n"
+
+# constants used to display an up and down arrows plus bars
+# modified from https://www.raspberrypi.org/learning/getting-started-with-the-sense-hat/worksheet/
+# set up the colours (blue, red, empty)
+
+# ============================================================================
+# DEVICES
+# ============================================================================
+
+# the Sense HAT, DHT11 (GPIO pin 26), 18B20 and CPU temperature, each set up
+# the first time it's used (see hal.py); init_station() can swap this out
+devices = Devices(w1_names=W1_PROBES, w1_primary=W1_PRIMARY)
+
+# ============================================================================
+# DEFINE DISPLAY VARIABLES
+# ============================================================================
+
+b = [0, 0, 255]     # blue
+r = [255, 0, 0]     # red
+g = [0, 255, 0]     # green
+e = [0, 0, 0]       # empty
+w = [255, 255, 255] # white
+
+# DEFINE IMAGES
+
+arrow_up = [
+    e, e, e, g, g, e, e, e,
+    e, e, g, g, g, g, e, e,
+    e, g, g, g, g, g, g, e,
+    g, g, e, g, g, e, g, g,
+    g, e, e, g, g, e, e, g,
+    e, e, e, g, g, e, e, e,
+    e, e, e, g, g, e, e, e,
+    e, e, e, g, g, e, e, e
+]
+
+arrow_down = [
+    e, e, e, g, g, e, e, e,
+    e, e, e, g, g, e, e, e,
+    e, e, e, g, g, e, e, e,
+    g, e, e, g, g, e, e, g,
+    g, g, e, g, g, e, g, g,
+    e, g, g, g, g, g, g, e,
+    e, e, g, g, g, g, e, e,
+    e, e, e, g, g, e, e, e
+]
+
+eq_bars = [
+    e, e, e, e, e, e, e, e,
+    e, w, w, w, w, w, w, e,
+    e, w, w, w, w, w, w, e,    
+    e, e, e, e, e, e, e, e,
+    e, w, w, w, w, w, w, e,
+    e, w, w, w, w, w, w, e,
+    e, e, e, e, e, e, e, e,
+    e, e, e, e, e, e, e, e
+]
+
+# ============================================================================
+# FUNCTIONS
+# ============================================================================
+
+# Weather Station Upload / Download / log functions
+def log_weather(temp_f, t_hum, t_press, pressure, humidity, t_cpu, t_dht, h_dht,
+                        dew_pt_dht, t_tecf, dew_pt_tec, when=None):
+
+    if when is None:
+        when = datetime.datetime.now()
+
+    timestr = when.strftime("%Y%m%d")
+    f_loc = "/home/pi/pi_weather_station/Logs/"
+    f_name = f_loc + "log_weather-{}.log".format(timestr)
+
+    with open(f_name, "a") as log:
+        log.write("{}, {}, {}, {}, {}, {}%, {}, {}, {}%, {}, {}, {} \n".format(
+            str(when),temp_f, t_hum, t_press, pressure, 
+            humidity, t_cpu, t_dht, h_dht, dew_pt_dht, t_tecf, dew_pt_tec)) 
+      
+    return
+
+
+def log_record(record):
+    """ Write a pipeline record (records.py) to the daily text log """
+    # the log has always shown a missing reading as []
+    values = [[] if record[f] is None else record[f] for f in FIELDS]
+    log_weather(*values, when=datetime.datetime.fromtimestamp(record["ts"]))
+
+
+def compressed(sink, enabled=True, fields=FIELDS):
+    """ The sink behind a compressor for 'fields', if compression is on """
+    from compression import Compressor, default_channels
+    from sinks import CompressedSink
+
+    if not enabled or COMPRESSION is None:
+        return sink
+    return CompressedSink(sink, Compressor(default_channels(COMPRESSION, fields)))
+
+
+def build_pipeline():
+    """ One SinkWorker per destination, see sinks.py """
+    from compression import WU_FIELDS, mark_store
+    from rollups import open_index
+    from sinks import (CallbackSink, ObjectStoreSink, Pipeline, RollupSink,
+                       SQLiteSink, TSStoreSink, WUSink)
+    from tsstore import TSStore
+
+    pipeline = Pipeline(clock=clock)
+    if COMPRESS_STORE and COMPRESSION is not None:
+        mark_store(STORE_DIR, COMPRESSION)
+    pipeline.add(compressed(TSStoreSink(STORE_DIR), COMPRESS_STORE), batch_size=10)
+    # min/max/mean rollups, caught up from the store and saved for
+    # "rollups.py STORE_DIR" to query (it looks for ROLLUP_FILE next to the store)
+    rollups = open_index(ROLLUP_FILE, TSStore(STORE_DIR))
+    pipeline.add(RollupSink(rollups, ROLLUP_FILE), batch_size=10)
+    pipeline.add(CallbackSink("calibrate", update_calibration), batch_size=10)
+    if TEXT_LOG:
+        pipeline.add(CallbackSink("log", log_record), batch_size=10)
+    if WEATHER_UPLOAD:
+        pipeline.add(compressed(WUSink(uploader, wu_station_id, wu_station_key,
+                                       altitude=ALTITUDE), COMPRESS_UPLOADS,
+                                fields=WU_FIELDS))
+    else:
+        print("Skipping Weather Underground upload")
+    if SQL_DB is not None:
+        pipeline.add(SQLiteSink(SQL_DB), policy="spill",
+                     spill_path=SQL_DB + ".spill")
+    if OBJECT_STORE is not None:
+        pipeline.add(compressed(ObjectStoreSink(OBJECT_STORE)), batch_size=60,
+                     max_delay=3600)
+    return pipeline
+
+
+# Display manipulations (frames are numpy (8, 8, 3) arrays, see display.py)
+def reset_pixels(pixelx):
+    from display import to_frame
+    return to_frame(pixelx).reshape(64, 3).tolist()
+
+def rot_display(image):
+    # the image turned all the way round, a second per quarter turn
+    return display.spin(image, hold=1.0)
+
+# Climate Calculations, see meteo.py: they take NumPy arrays of history as
+# well as single readings. The dew point used to be the rough
+# T - 0.36 * (100 - RH), it's the Magnus formula now. meteo is imported on
+# the first call (after that the import is a dictionary lookup)
+def rht_to_dp(t, rh):
+    from meteo import dew_point_f
+    return dew_point_f(t, rh)
+
+def degc_to_degf(t):
+    from meteo import c_to_f
+    return c_to_f(t)
+
+def pa_to_inches(p):
+    from meteo import pa_to_inhg
+    return pa_to_inhg(p)
+
+def mm_to_inches(mm):
+    from meteo import mm_to_inches
+    return mm_to_inches(mm)
+
+def khm_to_mph(speed):
+    from meteo import kph_to_mph
+    return kph_to_mph(speed)
+
+# Sensor Data Collection and Calculations
+
+# One-wire connection, for 18B20 Temperature Sensor(s)
+def read_w1_temp():
+    return devices.w1.read()
+
+def read_w1_temps():
+    """ {probe name: temp C} for every probe that read OK (see w1probes.py) """
+    results = devices.w1.read_all()
+    temps = dict((name, value) for name, value in results.items()
+                 if not isinstance(value, Exception))
+    if not temps:
+        raise SensorError("no DS18B20 read: " + "; ".join(
+            str(value) for value in results.values()))
+    return temps
+
+def get_cpu_temp():
+    return devices.cpu.read()
+
+
+# use moving average to smooth readings, one filter chain per sensor channel
+# (see filters.py for the other filters: EWMA, rolling median, outliers);
+# main() sets it up
+smoothing = None
+
+def new_smoothing():
+    from filters import FilterBank, MovingAverage
+    return FilterBank({
+        "sense_temp": [MovingAverage(3, prime=True)],
+    })
+
+def get_smooth(x, channel="sense_temp"):
+    # average the last three readings of that channel
+    return smoothing.update(channel, x)
+
+
+# CPU-heat correction for the Sense HAT (calibration.py), loaded in main()
+# and replaced as calibration improves
+heat_model = None
+
+def update_calibration(record):
+    """ Refit the heat correction with a new record (runs as a sink) """
+    global heat_model
+    heat_model = calibrator.update(record)
+
+
+def get_sense_temp():
+    # ====================================================================
+    # Unfortunately, getting an accurate temperature reading from the
+    # Sense HAT is improbable, see here:
+    # https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
+    # so we'll have to do some approximation of the actual temp
+    # taking CPU temp into account. The Pi foundation recommended
+    # using the following:
+    # http://yaab-arduino.blogspot.co.uk/2016/08/accurate-temperature-reading-sensehat.html
+    # ====================================================================
+    # First, get temp readings from both sensors
+    sense = devices.sense
+    t1 = sense.get_temperature_from_humidity()
+    t2 = sense.get_temperature_from_pressure()
+    # t becomes the average of the temperatures from both sensors
+    
+    #currently t humidity doesn't work, thus:
+    t = t2
+    #t = (t1 + t2) / 2
+    # Now, grab the CPU temperature
+    t_cpu = get_cpu_temp()
+    # Calculate the 'real' temperature compensating for CPU heating, the
+    # coefficients are fitted against the DS18B20 (see calibration.py) and
+    # start out as the old t - ((t_cpu - t) / 1.5)
+    t_corr = heat_model.apply(t, t_cpu)
+    # Finally, average out that value across the last three readings
+    t_corr = get_smooth(t_corr)
+    # convoluted, right?
+    # Return the calculated temperature
+
+    return t_corr
+
+def read_sense():
+    """ Every Sense HAT reading in one go (for the acquisition layer) """
+    # ========================================================
+    # read values from the Sense HAT
+    # ========================================================
+    # Calculate the temperature. The get_sense_temp function 'adjusts' the recorded temperature adjusted for the
+    # current processor temp in order to accommodate any temperature leakage from the processor to
+    # the Sense HAT's sensor. This happens when the Sense HAT is mounted on the Pi in a case.
+    # If you've mounted the Sense HAT outside of the Raspberry Pi case, then you don't need that
+    # calculation. So, when the Sense HAT is external, replace the following line (comment it out  with a #)
+    # calc_temp = get_sense_temp()
+    # with the following line (uncomment it, remove the # at the line start)
+    # calc_temp = sense.get_sense_temperature_from_pressure()
+    # or the following line (each will work)
+    # calc_temp = sense.get_sense_temperature_from_humidity()
+    # ========================================================
+    # At this point, we should have an accurate temperature, so lets use the recorded (or calculated)
+    from meteo import hpa_to_inhg
+
+    calc_temp = get_sense_temp()
+    sense = devices.sense
+    return {
+        "t_hum": degc_to_degf(sense.get_temperature_from_humidity()),
+        "t_press": degc_to_degf(sense.get_temperature_from_pressure()),
+        "temp_f": round(degc_to_degf(calc_temp), 1),
+        "humidity": sense.get_humidity(),
+        # convert pressure from millibars to inHg before posting
+        "pressure": round(hpa_to_inhg(sense.get_pressure()), 1),
+    }
+
+def read_dht():
+    """ DHT11 (temperature C, humidity %), raises SensorError on a bad read """
+    return devices.dht.read()
+
+def station_sensors():
+    """ The station's sensors with their deadlines and retry budgets """
+    # DS18B20 conversion alone takes ~750 ms; the DHT11 often needs a retry
+    return [
+        Sensor("sense", read_sense, timeout=1.0),
+        Sensor("cpu", get_cpu_temp, timeout=1.0),
+        Sensor("w1", read_w1_temps, timeout=2.0),
+        Sensor("dht", read_dht, timeout=2.0, retries=3, retry_delay=0.2),
+    ]
+
+def get_ext_sensor_data():
+
+    return TBD 
+
+# ============================================================================
+# STATION TASKS
+# ============================================================================
+# Sampling, display, logging and upload each run as their own periodic task
+# (see scheduler.py). They share the most recent reading through 'latest'.
+
+latest = {}
+latest_lock = threading.Lock()
+# "all", "acquire" or "consume" (see RING_PATH)
+role = "all"
+# the ring this process publishes to, or reads from as a consumer
+ring = None
+# what the tasks and sensor deadlines run on; simulator.py swaps in a
+# scheduler.ScaledClock to run the station faster than real time
+clock = monotonic
+# temperature at the last record, for the up/down trend
+last_temp = None
+# read latencies, jitter, queue depths etc. (see metrics.py), from main()
+metrics = None
+
+
+def take_sample():
+    """ Read every sensor and publish the result to 'latest' """
+    # all sensors are read at once; anything that failed or timed out keeps
+    # its last good value from 'latest'
+    devices.tick()
+    snap = acquisition.read()
+    metrics.observe_snapshot(snap)
+    with latest_lock:
+        reading = dict(latest)
+
+    # when each field last had a fresh read, for the comparator's stale check
+    updated = dict(reading.get("updated", {}))
+
+    # Sense HAT temps, pressure, humidity
+    if snap.ok("sense"):
+        reading.update(snap.value("sense"))
+        updated.update(dict.fromkeys(snap.value("sense"), snap.timestamp))
+    if snap.ok("cpu"):
+        reading["t_cpu"] = degc_to_degf(snap.value("cpu"))
+        updated["t_cpu"] = snap.timestamp
+
+    # Tek 18B20 Temp:
+    if snap.ok("w1"):
+        temps = snap.value("w1")
+        primary = devices.w1.primary
+        if primary in temps:
+            reading["t_tecf"] = degc_to_degf(temps[primary])
+            updated["t_tecf"] = snap.timestamp
+        # every probe (the primary too) under its name
+        probes = dict(reading.get("probes", {}))
+        probes.update((name, degc_to_degf(t)) for name, t in temps.items())
+        reading["probes"] = probes
+
+    # DHT11 Temp & Humidity:
+    if snap.ok("dht"):
+        t_dht, h_dht = snap.value("dht")
+        reading["t_dht"] = degc_to_degf(t_dht)
+        reading["h_dht"] = h_dht
+        reading["dew_pt_dht"] = rht_to_dp(reading["t_dht"], h_dht)
+        updated["t_dht"] = updated["h_dht"] = snap.timestamp
+    if "h_dht" in reading and "t_tecf" in reading:
+        reading["dew_pt_tec"] = rht_to_dp(reading["t_tecf"], reading["h_dht"])
+
+    reading["time"] = datetime.datetime.fromtimestamp(snap.timestamp)
+    reading["status"] = snap.status()
+    reading["updated"] = updated
+
+    with latest_lock:
+        latest.update(reading)
+    if ring is not None:
+        ring.publish(make_record(reading, ts=snap.timestamp),
+                     [field for field, t in updated.items() if t == snap.timestamp])
+
+    print("Measurement Time:      {}".format(str(reading["time"])))
+    print("Sense Temp (calc):     {} ".format(reading.get("temp_f", [])))
+    print("Sense Temp (hum):      {} ".format(reading.get("t_hum", [])))
+    print("Sense Temp (press):    {} ".format(reading.get("t_press", [])))
+    print("Sense Pressure (inHg): {} ".format(reading.get("pressure", [])))
+    print("Sense Humidity:        {} % ".format(reading.get("humidity", [])))
+    print("CPU Temp:              {} ".format(reading.get("t_cpu", [])))
+    print("DHT11 Temp:            {} ".format(reading.get("t_dht", [])))
+    print("DHT11 Humidity:        {} % ".format(reading.get("h_dht", [])))
+    print("DHT11 Dew Point:       {} ".format(reading.get("dew_pt_dht", [])))
+    print("Tek38B10 Temp:         {} ".format(reading.get("t_tecf", [])))
+    print("Tek38B10 Dew Point:    {} ".format(reading.get("dew_pt_tec", [])))
+    if "t_tecf" in reading and "h_dht" in reading:
+        from meteo import heat_index
+        print("Heat Index:            {:.1f} ".format(
+            heat_index(reading["t_tecf"], reading["h_dht"])))
+    for name, temp in sorted(reading.get("probes", {}).items()):
+        print("  {:<20} {:.1f}".format(name, temp))
+    print("Sensor Status:         {} ({:.0f} ms)".format(
+        reading["status"], snap.elapsed * 1000.0))
+    if "cold_start" not in latest:
+        with latest_lock:
+            latest["cold_start"] = monotonic() - STARTED
+        print("Cold start:            {:.0f} ms to the first sample".format(
+            latest["cold_start"] * 1000.0))
+
+
+def follow_ring():
+    """ Consumer role: take the acquisition process's latest sample from the ring """
+    last = None
+    rows = ring.read()
+    while len(rows):
+        # only the newest sample matters here; read through everything waiting
+        last = rows[-1]
+        rows = ring.read()
+    if last is None:
+        return
+    from shm_ring import as_record
+    record, fresh = as_record(last, ring.fields)
+    with latest_lock:
+        updated = dict(latest.get("updated", {}))
+        updated.update(dict.fromkeys(fresh, record["ts"]))
+        latest.update((field, value) for field, value in record.items()
+                      if value is not None and field != "ts")
+        latest["time"] = datetime.datetime.fromtimestamp(record["ts"])
+        latest["updated"] = updated
+
+
+def update_display():
+    """ Queue the latest temperature and humidity, then the trend, for the display """
+    # the display thread does the scrolling (display.py), this only queues
+    # frames that are mostly cached already, so it returns at once
+    with latest_lock:
+        reading = dict(latest)
+    if "t_tecf" not in reading or "temp_f" not in reading:
+        # nothing to show until both temperatures are in
+        display.play([display.message("Init", text_colour=[255, 255, 0],
+                                      back_colour=[0, 0, 127]),
+                      display.blank()])
+        return
+
+    if (datetime.datetime.fromtimestamp(wall_time(clock)).minute % 2) == 0:
+        colour = r
+    else:
+        colour = w
+    items = [
+        display.message("%sF" % round(((reading["t_tecf"] + reading["temp_f"]) / 2), 1),
+                        text_colour=colour),
+        display.message("%s%%" % reading.get("h_dht", []), text_colour=g),
+    ]
+    # where the temperature is heading over the next hour
+    forecast = reading.get("forecast", {}).get("t_tecf")
+    if forecast:
+        items.append(display.message("1h %sF" % round(forecast[-1], 1), text_colour=b))
+
+    trend = reading.get("trend")
+    if trend == "down":
+        items.append(display.image(arrow_down))
+    elif trend == "up":
+        items.append(display.image(arrow_up))
+    elif trend == "same":
+        # temperature stayed the same, display the bars
+        items.extend(rot_display(eq_bars))
+    display.play(items)
+
+
+def record_weather():
+    """ Minute mark: work out the temperature trend and publish the reading """
+    global last_temp
+
+    with latest_lock:
+        reading = dict(latest)
+    if "t_tecf" not in reading:
+        return
+    t_tecf = reading["t_tecf"]
+    if last_temp is None:
+        last_temp = t_tecf
+
+    now = datetime.datetime.fromtimestamp(wall_time(clock))
+    print("\n%d minute mark (%d @ %s)" % (MEASUREMENT_INTERVAL, now.minute, str(now)))
+
+    # did the temperature go up or down?
+    # Better to compare floats with a tolerances
+    tolerance = 0.2
+    if abs(last_temp - t_tecf) >= tolerance:
+        if (last_temp - t_tecf) < 0:
+            trend = "down"
+        else:
+            trend = "up"
+    else:
+        trend = "same"
+    # set last_temp to the current temperature before we measure again
+    last_temp = t_tecf
+    with latest_lock:
+        latest["trend"] = trend
+
+    record = make_record(reading, ts=wall_time(clock))
+    record["probes"] = reading.get("probes", {})
+    # check the sensors against each other; the upload sinks leave out
+    # anything the comparator doesn't trust
+    flags = comparator.update(record, reading.get("updated"))
+    record["degraded"] = comparator.degraded
+    if flags:
+        print("Sensor checks:", ", ".join(
+            "{} {}".format(field, "/".join(f)) for field, f in sorted(flags.items())))
+    # short-horizon forecasts ride along with the record for the sinks
+    record["forecast"] = forecasts.update(record)
+    with latest_lock:
+        latest["forecast"] = record["forecast"]
+    pipeline.publish(record)
+
+
+def print_report():
+    """ Scheduler overrun/jitter and sink throughput report """
+    print(tasks.report())
+    if role != "acquire":
+        print(pipeline.report())
+        print(comparator.report())
+        print(display.stats())
+    for stats in devices.read_stats():
+        print(stats)
+    if ring is not None:
+        print("Ring:", ring.stats())
+    if WEATHER_UPLOAD and role != "acquire":
+        print("Upload queue:", uploader.stats())
+
+
+def reload_calibration():
+    """ Acquire role: pick up heat corrections the consumer has fitted since """
+    from calibration import Calibrator, CoefficientStore
+
+    global heat_model
+    heat_model = Calibrator(CoefficientStore(CALIBRATION_FILE)).model
+
+
+def open_ring():
+    """ Consume role: wait for the acquisition process to start its ring """
+    from shm_ring import RingError, RingReader
+
+    waiting = False
+    while True:
+        try:
+            return RingReader(RING_PATH, start="oldest")
+        except (IOError, OSError, RingError) as e:
+            if not waiting:
+                print("Waiting for the acquisition process ({})".format(e))
+                waiting = True
+            time.sleep(1)
+
+
+def main():
+
+    # The temp measurement smoothing algorithm's accuracy is based
+    # on frequent measurements, so we'll take measurements every SAMPLE_INTERVAL
+    # seconds but only log and upload every MEASUREMENT_INTERVAL minutes,
+    # lined up with the top of the minute like before
+    global acquisition, uploader, pipeline, tasks, calibrator, heat_model, forecasts
+    global comparator, display, ring, smoothing, metrics
+    from calibration import Calibrator, CoefficientStore
+    from metrics import MetricsServer, SamplingProfiler, StationMetrics
+
+    metrics = StationMetrics()
+    calibrator = Calibrator(CoefficientStore(CALIBRATION_FILE))
+    heat_model = calibrator.model
+    print("Sense HAT heat correction:", heat_model)
+    acquiring = role in ("all", "acquire")
+    consuming = role in ("all", "consume")
+    tasks = Scheduler(clock=clock)
+
+    if acquiring:
+        # meteo (and NumPy) load now, not within the first sensor read's deadline
+        import meteo
+        from shm_ring import RingWriter
+
+        smoothing = new_smoothing()
+        acquisition = Acquisition(station_sensors(), clock=clock)
+        if RING_PATH is not None:
+            try:
+                ring = RingWriter(RING_PATH)
+                print("Publishing samples to", RING_PATH)
+            except (IOError, OSError) as e:
+                print("Unable to create the sample ring:", e)
+        tasks.add("sample", SAMPLE_INTERVAL, take_sample)
+        metrics.watch_devices(devices)
+    if role == "acquire":
+        # the consumer refits the heat correction, this process applies it
+        tasks.add("calibrate", REPORT_INTERVAL, reload_calibration, offset=REPORT_INTERVAL)
+    if role == "consume":
+        ring = open_ring()
+        print("Reading samples from", RING_PATH)
+        tasks.add("follow", RING_POLL, follow_ring)
+
+    if consuming:
+        from comparator import Comparator
+        from display import Display, Font, led_for
+        from forecast import ForecastBank, default_models
+
+        sense = devices.sense
+        sense.low_light = True
+        display = Display(led_for(sense), Font(sense))
+        display.start()
+        comparator = Comparator(stale_after=STALE_AFTER)
+        # forecasts an hour ahead, one step per record
+        forecasts = ForecastBank(default_models(MEASUREMENT_INTERVAL),
+                                 horizon=max(1, 60 // MEASUREMENT_INTERVAL))
+        checkpoint = None
+        if WEATHER_UPLOAD and CHECKPOINT is not None:
+            checkpoint = Checkpoint(CHECKPOINT, wu_station_id)
+        uploader = WUUploader(DiskQueue(UPLOAD_QUEUE), url=UPLOAD_URL,
+                              checkpoint=checkpoint)
+        if WEATHER_UPLOAD:
+            uploader.start()
+        pipeline = build_pipeline()
+        pipeline.start()
+
+        record_period = MEASUREMENT_INTERVAL * 60
+        record_offset = aligned_offset(record_period, wall_time(clock))
+        tasks.add("display", DISPLAY_INTERVAL, update_display, offset=1)
+        tasks.add("record", record_period, record_weather, offset=record_offset)
+        metrics.watch_pipeline(pipeline)
+        metrics.watch_uploader(uploader)
+    tasks.add("report", REPORT_INTERVAL, print_report, offset=REPORT_INTERVAL)
+
+    metrics.watch_scheduler(tasks)
+    if METRICS_PORT is not None:
+        port = METRICS_PORT + 1 if role == "consume" else METRICS_PORT
+        try:
+            MetricsServer(metrics.registry, port, profiler=SamplingProfiler()).start()
+            print("Metrics on port", port)
+        except (IOError, OSError) as e:
+            print("Unable to start the metrics server:", e)
+    try:
+        tasks.run_forever()
+    finally:
+        if consuming:
+            display.stop()
+            pipeline.stop()
+            uploader.stop()
+        print_report()
+
+    print("Leaving main()")
+
+
+def init_station(fake=False, sysfs_root=None, station_devices=None):
+    """ Check the settings, read the WU configuration and pick the devices
+
+    station_devices is a ready hal.Devices to use instead (simulator.py).
+    """
+    global devices, wu_station_id, wu_station_key
+
+    print(SLASH_N + HASHES)
+    print(SINGLE_HASH, "Pi Weather Station                          ", SINGLE_HASH)
+    print(SINGLE_HASH, "with Sense HAT, DHT11, and 18B20 sensors    ", SINGLE_HASH)
+    print(SINGLE_HASH, "By Mark H Oliver                            ", SINGLE_HASH)
+    print(HASHES)
+
+    # make sure we don't have a MEASUREMENT_INTERVAL > 60
+    if (MEASUREMENT_INTERVAL is None) or (MEASUREMENT_INTERVAL > 60):
+        print("The application's 'MEASUREMENT_INTERVAL' cannot be empty or greater than 60")
+        sys.exit(1)
+
+    # ========================================================================
+    #  Read Weather Underground Configuration Parameters
+    # ========================================================================
+    print("\nInitializing Weather Underground configuration")
+    try:
+        from config import Config
+        wu_station_id = Config.STATION_ID
+        wu_station_key = Config.STATION_KEY
+    except ImportError:
+        wu_station_id = wu_station_key = None
+    if (wu_station_id is None) or (wu_station_key is None):
+        if WEATHER_UPLOAD and not fake:
+            print("Missing values from the Weather Underground configuration file\n")
+            sys.exit(1)
+        print("No Weather Underground configuration, uploads will fail")
+    else:
+        # we made it this far, so it must have worked...
+        print("Successfully read Weather Underground configuration values")
+        print("Station ID:", wu_station_id)
+        # print("Station key:", wu_station_key)
+
+    # ========================================================================
+    # set up the devices
+    # ========================================================================
+    if station_devices is not None:
+        devices = station_devices
+    elif fake:
+        devices = fake_devices(sysfs_root=sysfs_root, w1_names=W1_PROBES,
+                               w1_primary=W1_PRIMARY)
+    elif sysfs_root is not None:
+        devices = Devices(sysfs_root=sysfs_root, w1_names=W1_PROBES,
+                          w1_primary=W1_PRIMARY)
+    # the drivers would start on first use anyway, but doing it here shows
+    # what each one costs and what's missing before the tasks start; a
+    # consumer only needs the Sense HAT, for the display
+    names = ("sense",) if role == "consume" else Devices.names
+    errors = devices.open_all(names)
+    for name in names:
+        if name in errors:
+            print("Unable to initialize {}: {}".format(name, errors[name]))
+        elif name in devices.init_times:
+            print("Initialized {} in {:.0f} ms".format(
+                name, devices.init_times[name] * 1000.0))
+    if "sense" in errors:
+        sys.exit(1)
+
+    print("Initialization complete!")
+
+
+# Now see what we're supposed to do next
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pi Weather Station")
+    parser.add_argument("--fake", action="store_true",
+                        help="run on fake devices (see hal.py)")
+    parser.add_argument("--sysfs", help="sysfs root for the 1-Wire bus")
+    parser.add_argument("--role", choices=("all", "acquire", "consume"), default="all",
+                        help="sample only, or read another process's samples "
+                             "(see RING_PATH)")
+    args = parser.parse_args()
+    role = args.role
+    init_station(fake=args.fake, sysfs_root=args.sysfs)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nExiting application\n")
+        sys.exit(0)
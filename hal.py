@@ -0,0 +1,250 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - device layer
+
+    The station's hardware behind one Devices object:
+
+        sense   Sense HAT (sense_hat.SenseHat)
+        dht     DHT11 on a GPIO pin (dht11 + RPi.GPIO)
+        w1      DS18B20 probes on the 1-Wire bus (w1probes.ProbeSet)
+        cpu     CPU temperature (sysfs_readers, thermal zone or vcgencmd)
+
+    Nothing is touched until a driver is first used: the hardware
+    libraries are imported, the kernel modules loaded and the devices set
+    up on demand, and the time each took is kept in Devices.init_times.
+    So importing this (or full_ws.py) is cheap and works off the Pi.
+
+    Call Devices.tick() at the start of each sample: the CPU temperature
+    is read at most once per tick however many things ask for it.
+
+    The sysfs root can be moved (a fake tree for tests) and any driver
+    can be swapped for a fake; fake_devices() is a full set.
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import os
+import random
+import threading
+
+from acquisition import SensorError
+from scheduler import monotonic
+from sysfs_readers import TickCache, cpu_temp
+from w1probes import ProbeSet
+
+SYSFS_ROOT = "/sys"
+DHT_PIN = 26
+
+
+class DeviceError(Exception):
+    """ A device is missing or can't be set up """
+
+
+def load_w1_modules():
+    """ Load the 1-Wire kernel modules (only on the real sysfs) """
+    os.system('modprobe w1-gpio')
+    os.system('modprobe w1-therm')
+
+
+class DHT11(object):
+    """ DHT11 on a GPIO pin, read() returns (temperature C, humidity %) """
+
+    def __init__(self, pin=DHT_PIN):
+        import dht11
+        import RPi.GPIO as GPIO
+
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.cleanup()
+        self.instance = dht11.DHT11(pin=pin)
+
+    def read(self):
+        result = self.instance.read()
+        if not result.is_valid():
+            raise SensorError("DHT11 invalid read")
+        return result.temperature, result.humidity
+
+
+class Devices(object):
+    """ The station's drivers, each created the first time it's asked for
+
+    fakes maps a device name ("sense", "dht", "w1", "cpu") to a ready
+    driver to use instead of the real one. w1_names maps 1-Wire device ids
+    to probe names and w1_primary is the probe that stands in for t_tecf.
+    """
+
+    names = ("sense", "dht", "w1", "cpu")
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, dht_pin=DHT_PIN, fakes=None,
+                 w1_names=None, w1_primary=None):
+        self.sysfs_root = sysfs_root
+        self.dht_pin = dht_pin
+        self.w1_names = w1_names
+        self.w1_primary = w1_primary
+        self._drivers = dict(fakes or {})
+        self._lock = threading.Lock()
+        # seconds it took to set up each real driver
+        self.init_times = {}
+
+    def _make_sense(self):
+        from sense_hat import SenseHat
+        return SenseHat()
+
+    def _make_dht(self):
+        return DHT11(self.dht_pin)
+
+    def _make_w1(self):
+        if self.sysfs_root == SYSFS_ROOT:
+            load_w1_modules()
+        try:
+            return ProbeSet(self.sysfs_root, self.w1_names, self.w1_primary)
+        except SensorError as e:
+            raise DeviceError(str(e))
+
+    def _make_cpu(self):
+        return TickCache(cpu_temp(self.sysfs_root))
+
+    def get(self, name):
+        driver = self._drivers.get(name)
+        if driver is not None:
+            return driver
+        with self._lock:
+            # another thread may have made it while we waited
+            if name not in self._drivers:
+                start = monotonic()
+                self._drivers[name] = getattr(self, "_make_" + name)()
+                self.init_times[name] = monotonic() - start
+            return self._drivers[name]
+
+    sense = property(lambda self: self.get("sense"))
+    dht = property(lambda self: self.get("dht"))
+    w1 = property(lambda self: self.get("w1"))
+    cpu = property(lambda self: self.get("cpu"))
+
+    def tick(self):
+        """ A new sample starts: cached values are stale from here on """
+        for driver in list(self._drivers.values()):
+            if hasattr(driver, "tick"):
+                driver.tick()
+
+    def read_stats(self):
+        """ ReadStats (sysfs_readers.py) of every driver that keeps them """
+        stats = []
+        for name in self.names:
+            driver = self._drivers.get(name)
+            if hasattr(driver, "readers"):
+                stats.extend(reader.stats for reader in driver.readers())
+        return stats
+
+    def open_all(self, names=None):
+        """ Set up every driver (or those named) now, returns {name: error} for failures """
+        errors = {}
+        for name in names or self.names:
+            try:
+                self.get(name)
+            except Exception as e:
+                errors[name] = e
+        return errors
+
+
+# ============================================================================
+# FAKES
+# ============================================================================
+
+class FakeSenseHat(object):
+    """ Enough of sense_hat.SenseHat for the station, with plausible readings """
+
+    def __init__(self, temp=21.0, humidity=45.0, pressure=1013.0, seed=None):
+        self.temp = temp
+        self.humidity = humidity
+        self.pressure = pressure
+        self.random = random.Random(seed)
+        self.low_light = False
+        self.rotation = 0
+        self.pixels = [[0, 0, 0]] * 64
+        self.messages = []
+
+    def _noise(self, scale):
+        return self.random.gauss(0, scale)
+
+    def get_temperature_from_humidity(self):
+        return self.temp + 8.0 + self._noise(0.1)
+
+    def get_temperature_from_pressure(self):
+        return self.temp + 7.5 + self._noise(0.1)
+
+    def get_humidity(self):
+        return self.humidity + self._noise(0.5)
+
+    def get_pressure(self):
+        return self.pressure + self._noise(0.2)
+
+    def show_message(self, text, text_colour=None, back_colour=None, scroll_speed=0.1):
+        self.messages.append(text)
+
+    def clear(self, *colour):
+        self.pixels = [[0, 0, 0]] * 64
+
+    def set_pixels(self, pixels):
+        self.pixels = list(pixels)
+
+    def set_rotation(self, r=0, redraw=True):
+        self.rotation = r
+
+
+class FakeDHT11(object):
+    """ DHT11 that rounds like the real one and fails now and then """
+
+    def __init__(self, temp=21.0, humidity=45.0, fail_rate=0.2, seed=None):
+        self.temp = temp
+        self.humidity = humidity
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+
+    def read(self):
+        if self.random.random() < self.fail_rate:
+            raise SensorError("DHT11 invalid read")
+        return float(round(self.temp)), float(round(self.humidity))
+
+
+class FakeProbes(object):
+    """ Stands in for a ProbeSet, temps maps probe names to temperatures C """
+
+    def __init__(self, temps):
+        self.temps = dict(temps)
+        self.primary = sorted(self.temps)[0]
+
+    def read_all(self):
+        return dict(self.temps)
+
+    def read(self):
+        return self.temps[self.primary]
+
+
+class FakeValue(object):
+    """ A driver whose read() returns a fixed value (or calls a function) """
+
+    def __init__(self, value):
+        self.value = value
+
+    def read(self):
+        return self.value() if callable(self.value) else self.value
+
+
+def fake_devices(seed=None, sysfs_root=None, w1_names=None, w1_primary=None):
+    """ A full set of fake drivers, the DS18B20s from a fake sysfs if given
+
+    (w1probes.fake_bus() makes one; w1_names and w1_primary as for Devices)
+    """
+    fakes = {
+        "sense": FakeSenseHat(seed=seed),
+        "dht": FakeDHT11(seed=seed),
+        "cpu": FakeValue(48.0),
+    }
+    if sysfs_root is None:
+        fakes["w1"] = FakeProbes({"probe": 21.0})
+        sysfs_root = SYSFS_ROOT
+    return Devices(sysfs_root=sysfs_root, fakes=fakes, w1_names=w1_names,
+                   w1_primary=w1_primary)
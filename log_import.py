@@ -0,0 +1,239 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - bulk importer for the old text logs
+
+    Parses log_weather-YYYYMMDD.log files (as written by log_weather() in
+    full_ws.py) into typed NumPy arrays, a chunk at a time:
+
+        2019-05-01 12:34:56.123456, 71.2, 80.1, 79.5, 30.1, 41.3%, 120.2, 69.8, 40%, 44.5, 70.9, 45.6
+
+    The '%' signs are stripped, '[]' (no good DHT11 read yet) becomes NaN
+    and lines with the wrong number of fields or unparseable values are
+    counted and skipped. The numbers in each chunk are converted by NumPy
+    in one call; a chunk that fails the fast path is bisected to find the bad
+    lines. Files are spread over a process pool.
+
+    The result has the same layout as TSStore.read() (tsstore.py): 'ts'
+    (int64 epoch microseconds, UTC), 'valid' (uint32 bitmap) and one
+    float64 array per field, so analysis and backfill code can take
+    either.
+
+    usage: log_import.py [-j JOBS] [--store DIR] log_weather-*.log
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import multiprocessing
+import time
+import warnings
+
+import numpy as np
+
+from records import FIELDS
+from scheduler import monotonic
+from tsstore import TSStoreWriter
+
+# timestamp plus one column per field
+COLUMNS = 1 + len(FIELDS)
+CHUNK_SIZE = 4 * 1024 * 1024
+# how many pieces a batch with a bad line in it is cut into for retrying
+SPLIT = 16
+
+
+class ImportStats(object):
+    """ Line counts and timing for one import """
+
+    def __init__(self, lines=0, good=0, bad=0, files=0, seconds=0.0):
+        self.lines = lines
+        self.good = good
+        self.bad = bad
+        self.files = files
+        self.seconds = seconds
+
+    def add(self, other):
+        self.lines += other.lines
+        self.good += other.good
+        self.bad += other.bad
+        self.files += other.files
+
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "{} files, {} lines ({} bad) in {:.2f} s, {:.0f} lines/s".format(
+            self.files, self.lines, self.bad, self.seconds, self.lines_per_second())
+
+
+def _empty():
+    out = {"ts": np.zeros(0, np.int64), "valid": np.zeros(0, np.uint32)}
+    for field in FIELDS:
+        out[field] = np.zeros(0, np.float64)
+    return out
+
+
+def local_to_utc_us(naive_us):
+    """ Naive local-time microseconds (as logged) to UTC epoch microseconds """
+    # look up the UTC offset once per distinct hour rather than per line
+    hours, inverse = np.unique(naive_us // 3600000000, return_inverse=True)
+    offsets = np.empty(len(hours), np.int64)
+    for i, hour in enumerate(hours):
+        tt = time.gmtime(int(hour) * 3600)
+        offsets[i] = int(time.mktime(tt[:8] + (-1,))) - int(hour) * 3600
+    return naive_us + offsets[inverse.ravel()] * 1000000
+
+
+def _convert(lines):
+    """ Convert good-looking lines to (values, naive datetimes, rejected lines)
+
+    The numbers of the whole batch go through one np.fromstring call. If
+    that fails the batch is cut into SPLIT pieces and each retried, so a
+    few bad lines cost a handful of extra NumPy calls, not a Python loop.
+    """
+    tokens = b",".join(lines).split(b",")
+    stamps = tokens[0::COLUMNS]
+    del tokens[0::COLUMNS]
+    try:
+        with warnings.catch_warnings():
+            # older NumPy warns and returns a short array instead of raising
+            warnings.simplefilter("ignore")
+            values = np.fromstring(b",".join(tokens), sep=",")
+        if len(values) != len(tokens):
+            raise ValueError("unparseable value")
+        naive = np.array(stamps).astype("U32").astype("datetime64[us]")
+        return values.reshape(len(lines), COLUMNS - 1), naive, 0
+    except ValueError:
+        if len(lines) == 1:
+            return None, None, 1
+    step = -(-len(lines) // SPLIT)
+    parts = [_convert(lines[i:i + step]) for i in range(0, len(lines), step)]
+    rejected = sum(p[2] for p in parts)
+    parts = [p for p in parts if p[0] is not None]
+    if not parts:
+        return None, None, rejected
+    return (np.concatenate([p[0] for p in parts]),
+            np.concatenate([p[1] for p in parts]), rejected)
+
+
+def parse_lines(lines):
+    """ Parse a list of log lines (bytes), returns (arrays, bad line count) """
+    good = [line for line in lines if line.count(b",") == COLUMNS - 1]
+    bad = len(lines) - len(good)
+    if not good:
+        return _empty(), bad
+
+    values, naive, rejected = _convert(good)
+    bad += rejected
+    if values is None:
+        return _empty(), bad
+
+    out = {"ts": local_to_utc_us(naive.astype(np.int64))}
+    present = ~np.isnan(values)
+    valid = np.zeros(len(values), np.uint32)
+    for i, field in enumerate(FIELDS):
+        out[field] = values[:, i]
+        valid |= present[:, i].astype(np.uint32) << i
+    out["valid"] = valid
+    return out, bad
+
+
+def _clean(chunk):
+    return chunk.replace(b"%", b"").replace(b"[]", b"nan").replace(b"\r", b"")
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE):
+    """ Yield lists of whole lines from a file, about chunk_size bytes each """
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            data = tail + data
+            cut = data.rfind(b"\n")
+            if cut < 0:
+                tail = data
+                continue
+            tail = data[cut + 1:]
+            yield [line for line in _clean(data[:cut]).split(b"\n") if line.strip()]
+    if tail.strip():
+        yield [_clean(tail)]
+
+
+def concat(parts):
+    """ Join several parsed results and sort them by time """
+    parts = [p for p in parts if len(p["ts"])]
+    if not parts:
+        return _empty()
+    out = dict((key, np.concatenate([p[key] for p in parts])) for key in parts[0])
+    order = np.argsort(out["ts"], kind="mergesort")
+    if np.any(order[1:] < order[:-1]):
+        out = dict((key, value[order]) for key, value in out.items())
+    return out
+
+
+def load_file(path, chunk_size=CHUNK_SIZE):
+    """ Parse one log file, returns (arrays, ImportStats) """
+    stats = ImportStats(files=1)
+    parts = []
+    for lines in iter_chunks(path, chunk_size):
+        arrays, bad = parse_lines(lines)
+        stats.lines += len(lines)
+        stats.bad += bad
+        stats.good += len(arrays["ts"])
+        parts.append(arrays)
+    return concat(parts), stats
+
+
+def load_logs(paths, jobs=None, chunk_size=CHUNK_SIZE):
+    """ Parse many log files in parallel, returns (arrays, ImportStats) """
+    start = monotonic()
+    paths = sorted(paths)
+    if jobs == 1 or len(paths) < 2:
+        results = [load_file(path, chunk_size) for path in paths]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(load_file, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    total = ImportStats()
+    for _, stats in results:
+        total.add(stats)
+    arrays = concat([arrays for arrays, _ in results])
+    total.seconds = monotonic() - start
+    return arrays, total
+
+
+def import_to_store(arrays, root):
+    """ Append parsed arrays to the binary store (tsstore.py) """
+    writer = TSStoreWriter(root, fsync="never")
+    try:
+        writer.append_arrays(arrays)
+    finally:
+        writer.close()
+    return len(arrays["ts"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import log_weather-*.log files")
+    parser.add_argument("logs", nargs="+", help="log files to import")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--store", help="append the result to this tsstore directory")
+    args = parser.parse_args()
+
+    arrays, stats = load_logs(args.logs, jobs=args.jobs)
+    print(stats)
+    if args.store:
+        start = monotonic()
+        rows = import_to_store(arrays, args.store)
+        print("{} rows written to {} in {:.2f} s".format(
+            rows, args.store, monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - derived meteorological quantities
+
+    Dew point, heat index, humidex, absolute humidity and sea-level
+    pressure, plus the unit conversions the station uses. Every function
+    takes plain numbers or NumPy arrays (of any shape, mixed with scalars)
+    and is written once with NumPy ufuncs, so the code that works out a
+    live tick is the same code that runs over years of history from the
+    store. A scalar in gives a float back.
+
+        dew_point             Magnus formula, Alduchov & Eskridge (1996)
+                              constants, within 0.35 C for -45..60 C
+        heat_index            US NWS: Steadman's simple formula, the
+                              Rothfusz regression from 80 F with both of
+                              its adjustments (F in, F out)
+        humidex               Environment Canada, from air temp and dew point
+        absolute_humidity     g/m3, from the Magnus vapour pressure
+        sea_level_pressure    station pressure reduced by the hypsometric
+                              formula (what WU's 'baromin' expects)
+
+    A missing reading is NaN, and so is anything derived from it.
+    Humidity at or below 0% has no dew point (NaN), above 100% is taken
+    as 100% (the Sense HAT and DHT11 both read a little over when it's wet).
+
+    usage: meteo.py [check | bench [N]]
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import functools
+import math
+import sys
+
+import numpy as np
+
+from scheduler import monotonic
+
+# Magnus coefficients over water (Alduchov & Eskridge 1996)
+MAGNUS_A = 6.1094  # hPa
+MAGNUS_B = 17.625
+MAGNUS_C = 243.04  # C
+# standard atmosphere lapse rate (K/m) and the hypsometric exponent g/(R L)
+LAPSE_RATE = 0.0065
+BARO_EXPONENT = 5.257
+KELVIN = 273.15
+# long arrays go through a formula this many samples at a time, so its
+# temporaries stay in the CPU cache instead of each going out to RAM
+# (the heat index, the longest, runs about 1.4x faster on 10^7 samples)
+BLOCK = 65536
+
+
+def _result(x):
+    """ A float for scalar input, the array as is otherwise """
+    return float(x) if np.ndim(x) == 0 else x
+
+
+def _blocked(func):
+    """ Run func over a long 1-D array (and scalars) a BLOCK at a time """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arrays = [np.asarray(a) for a in args]
+        n = max(a.size for a in arrays)
+        if (n <= BLOCK or kwargs or
+                any(a.ndim > 1 or (a.ndim == 1 and a.size != n) for a in arrays)):
+            return func(*args, **kwargs)
+        out = np.empty(n)
+        for i in range(0, n, BLOCK):
+            out[i:i + BLOCK] = func(*[a[i:i + BLOCK] if a.ndim else a for a in arrays])
+        return out
+    return wrapper
+
+
+# ============================================================================
+# UNITS
+# ============================================================================
+
+def c_to_f(t):
+    return _result(np.multiply(t, 1.8) + 32)
+
+
+def f_to_c(t):
+    return _result((np.asarray(t, dtype=float) - 32) / 1.8)
+
+
+def hpa_to_inhg(p):
+    """ hPa (= millibars, what the Sense HAT reads) to inches of mercury """
+    return _result(np.multiply(p, 0.0295300))
+
+
+def inhg_to_hpa(p):
+    return _result(np.divide(p, 0.0295300))
+
+
+def pa_to_inhg(p):
+    return _result(np.multiply(p, 0.000295300))
+
+
+def mm_to_inches(mm):
+    return _result(np.multiply(mm, 0.0393701))
+
+
+def kph_to_mph(speed):
+    return _result(np.multiply(speed, 0.621371))
+
+
+# ============================================================================
+# HUMIDITY
+# ============================================================================
+
+@_blocked
+def vapour_pressure(t, rh=100.0):
+    """ Water vapour pressure (hPa) at t (C) and rh (%), saturation by default """
+    t = np.asarray(t, dtype=float)
+    rh = np.minimum(rh, 100.0)
+    return _result(rh / 100.0 * MAGNUS_A * np.exp(MAGNUS_B * t / (MAGNUS_C + t)))
+
+
+@_blocked
+def dew_point(t, rh):
+    """ Dew point (C) from air temperature (C) and relative humidity (%) """
+    t = np.asarray(t, dtype=float)
+    rh = np.minimum(rh, 100.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gamma = np.log(np.where(rh > 0, rh, np.nan) / 100.0) + MAGNUS_B * t / (MAGNUS_C + t)
+        return _result(MAGNUS_C * gamma / (MAGNUS_B - gamma))
+
+
+@_blocked
+def dew_point_f(t, rh):
+    """ dew_point() in Fahrenheit, the station's units """
+    return c_to_f(dew_point(f_to_c(t), rh))
+
+
+@_blocked
+def absolute_humidity(t, rh):
+    """ Grams of water per cubic metre of air at t (C) and rh (%) """
+    t = np.asarray(t, dtype=float)
+    # e / (R_v T), R_v = 461.5 J/(kg K), hPa -> Pa and kg -> g
+    return _result(vapour_pressure(t, rh) * 100.0 / (461.5 * (t + KELVIN)) * 1000.0)
+
+
+# ============================================================================
+# COMFORT
+# ============================================================================
+
+@_blocked
+def heat_index(t, rh):
+    """ NWS heat index (F) from air temperature (F) and relative humidity (%)
+
+    Below about 80 F this is Steadman's simple formula (close to the air
+    temperature); from there up, the Rothfusz regression.
+    """
+    t = np.asarray(t, dtype=float)
+    rh = np.minimum(rh, 100.0)
+    simple = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + rh * 0.094)
+    # the Rothfusz polynomial, grouped by powers of rh for fewer temporaries
+    t2 = t * t
+    hi = (-42.379 + 2.04901523 * t - 0.00683783 * t2
+          + rh * (10.14333127 - 0.22475541 * t + 0.00122874 * t2
+                  + rh * (-0.05481717 + 0.00085282 * t - 0.00000199 * t2)))
+    # dry heat reads a little lower, humid warmth a little higher
+    dry = (rh < 13) & (t >= 80) & (t <= 112)
+    hi = hi - np.where(dry, (13 - rh) / 4.0 * np.sqrt(
+        np.maximum(17 - np.abs(t - 95.0), 0) / 17.0), 0.0)
+    humid = (rh > 85) & (t >= 80) & (t <= 87)
+    hi = hi + np.where(humid, (rh - 85) / 10.0 * (87 - t) / 5.0, 0.0)
+    return _result(np.where((simple + t) / 2.0 < 80.0, simple, hi))
+
+
+@_blocked
+def humidex(t, td):
+    """ Environment Canada humidex from air temperature and dew point (C) """
+    t = np.asarray(t, dtype=float)
+    e = 6.11 * np.exp(5417.7530 * (1 / 273.16 - 1 / (KELVIN + np.asarray(td, dtype=float))))
+    return _result(t + 0.5555 * (e - 10.0))
+
+
+# ============================================================================
+# PRESSURE
+# ============================================================================
+
+@_blocked
+def sea_level_pressure(p, altitude, t=15.0):
+    """ Station pressure p reduced to sea level, in p's units
+
+    altitude in metres, t the air temperature (C) at the station.
+    """
+    t = np.asarray(t, dtype=float)
+    h = LAPSE_RATE * np.asarray(altitude, dtype=float)
+    return _result(np.multiply(p, (1 - h / (t + h + KELVIN)) ** -BARO_EXPONENT))
+
+
+@_blocked
+def sea_level_pressure_inhg(p, altitude, t=59.0):
+    """ sea_level_pressure() in the station's units, inHg and F """
+    return sea_level_pressure(p, altitude, f_to_c(t))
+
+
+# ============================================================================
+# RECORDS
+# ============================================================================
+
+def derived(arrays, temp="t_tecf", rh="h_dht", pressure="pressure", altitude=None):
+    """ Derived series from store-layout arrays (tsstore.py, log_import.py)
+
+    Returns dew_point, heat_index and sea_level_pressure in the station's
+    units (F, inHg), humidex and absolute_humidity in their own; the
+    pressure one only when altitude (metres) is given.
+    """
+    t_f = np.asarray(arrays[temp], dtype=float)
+    t_c = f_to_c(t_f)
+    humidity = np.asarray(arrays[rh], dtype=float)
+    td_c = dew_point(t_c, humidity)
+    out = {
+        "dew_point": c_to_f(td_c),
+        "heat_index": heat_index(t_f, humidity),
+        "humidex": humidex(t_c, td_c),
+        "absolute_humidity": absolute_humidity(t_c, humidity),
+    }
+    if altitude is not None:
+        out["sea_level_pressure"] = sea_level_pressure(
+            np.asarray(arrays[pressure], dtype=float), altitude, t_c)
+    return out
+
+
+# ============================================================================
+# CHECKS AND BENCHMARK
+# ============================================================================
+
+# (function, arguments, published value, tolerance)
+REFERENCES = [
+    # NOAA/NWS dew point calculator
+    (dew_point, (20.0, 50.0), 9.3, 0.05),
+    (dew_point, (30.0, 80.0), 26.2, 0.05),
+    (dew_point, (0.0, 90.0), -1.4, 0.05),
+    (dew_point, (-10.0, 60.0), -16.4, 0.2),
+    # NWS heat index chart
+    (heat_index, (80.0, 40.0), 80.0, 0.6),
+    (heat_index, (90.0, 70.0), 106.0, 0.6),
+    (heat_index, (100.0, 50.0), 118.0, 0.6),
+    (heat_index, (86.0, 90.0), 105.0, 0.6),
+    (heat_index, (70.0, 50.0), 69.0, 1.0),
+    # Environment Canada's example (air temp, dew point)
+    (humidex, (30.0, 15.0), 34.0, 0.5),
+    # saturated air at 20 C holds 17.3 g/m3, at 50% 8.65
+    (absolute_humidity, (20.0, 100.0), 17.3, 0.1),
+    (absolute_humidity, (20.0, 50.0), 8.65, 0.05),
+    # ICAO standard atmosphere: 1001.3 hPa at 100 m, 898.8 hPa at 1000 m
+    (sea_level_pressure, (1001.3, 100.0, 14.35), 1013.25, 0.1),
+    (sea_level_pressure, (898.8, 1000.0, 8.5), 1013.25, 0.3),
+]
+
+
+def check():
+    """ Compare against published values, scalars and arrays; True if all pass """
+    ok = True
+    for func, args, expected, tolerance in REFERENCES:
+        got = func(*args)
+        vector = func(*[np.full(3, a) for a in args])
+        good = abs(got - expected) <= tolerance and np.allclose(vector, got)
+        ok &= good
+        print("{:<18} {:<22} {:>9.3f} {:>9.2f}  {}".format(
+            func.__name__, str(args), got, expected, "ok" if good else "FAIL"))
+    # missing readings stay missing, rh > 100 is clipped
+    nan = float("nan")
+    for got in (dew_point(nan, 50.0), dew_point(20.0, 0.0), heat_index(nan, 50.0)):
+        ok &= got != got
+    ok &= dew_point(20.0, 104.0) == dew_point(20.0, 100.0)
+    print("all ok" if ok else "FAILED")
+    return ok
+
+
+def _scalar_dew_point(t, rh):
+    """ dew_point() with math, for comparison """
+    gamma = math.log(rh / 100.0) + MAGNUS_B * t / (MAGNUS_C + t)
+    return MAGNUS_C * gamma / (MAGNUS_B - gamma)
+
+
+def bench(n=10 ** 7):
+    """ ns per sample over an n-sample array, against a scalar loop """
+    rs = np.random.RandomState(0)
+    t_c = rs.uniform(-20, 45, n)
+    t_f = c_to_f(t_c)
+    rh = rs.uniform(5, 100, n)
+    td = dew_point(t_c, rh)
+    p = rs.uniform(950, 1050, n)
+    print("{} samples".format(n))
+    for name, func, args in (
+            ("dew_point", dew_point, (t_c, rh)),
+            ("dew_point_f", dew_point_f, (t_f, rh)),
+            ("heat_index", heat_index, (t_f, rh)),
+            ("humidex", humidex, (t_c, td)),
+            ("absolute_humidity", absolute_humidity, (t_c, rh)),
+            ("sea_level_pressure", sea_level_pressure, (p, 100.0, t_c)),
+            ("c_to_f", c_to_f, (t_c,))):
+        start = monotonic()
+        func(*args)
+        took = monotonic() - start
+        scalar_start = monotonic()
+        for i in range(1000):
+            func(*[a[i] if np.ndim(a) else a for a in args])
+        scalar = (monotonic() - scalar_start) / 1000
+        print("{:<20} {:>6.1f} ns/sample  {:>6.2f} s   scalar call {:>5.1f} us".format(
+            name, took / n * 1e9, took, scalar * 1e6))
+
+    # what the same dew point costs as a Python loop over the array
+    m = min(n, 10 ** 6)
+    start = monotonic()
+    for t, h in zip(t_c[:m].tolist(), rh[:m].tolist()):
+        _scalar_dew_point(t, h)
+    took = monotonic() - start
+    print("{:<20} {:>6.1f} ns/sample  (Python loop with math, {} samples)".format(
+        "dew_point", took / m * 1e9, m))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench(*[int(float(a)) for a in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "check":
+        sys.exit(0 if check() else 1)
+    else:
+        print("usage: meteo.py check | bench [N]")
@@ -0,0 +1,473 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - metrics and profiling endpoint
+
+    Latency histograms and counters for the station, served over HTTP in
+    the Prometheus text format:
+
+        GET /metrics            every metric
+        GET /profile?seconds=N  sample the station's threads for N seconds
+                                and return collapsed stacks (flamegraph.pl
+                                or speedscope read them)
+
+    Recording a value is a bisect and two adds under a lock, a couple of
+    microseconds. Counters that the station already keeps (scheduler
+    overruns, sink depths, probe CRC errors) aren't copied on every event;
+    Gauge and Counter take a function that is called when /metrics is
+    scraped. The profiler only runs while a /profile request is open.
+
+    StationMetrics wires all of it to the scheduler, acquisition, sinks,
+    uploader and devices.
+
+    usage: metrics.py   (overhead benchmark)
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from scheduler import monotonic
+
+# seconds: 0.5 ms .. 30 s, covers a sysfs read up to a stuck upload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_PORT = 9105
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)) + "}"
+
+
+def _num(x):
+    if x == float("inf"):
+        return "+Inf"
+    return repr(float(x)) if isinstance(x, float) else str(x)
+
+
+class Metric(object):
+    """ A named family of values, one per set of label values """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} {}".format(self.name, self.kind)]
+
+
+class Counter(Metric):
+    """ Only goes up; func, if given, returns {label values: count} at scrape """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), func=None):
+        super(Counter, self).__init__(name, help, labels)
+        self.func = func
+        self._values = collections.defaultdict(int)
+
+    def inc(self, *labels, **kw):
+        with self._lock:
+            self._values[labels] += kw.get("by", 1)
+
+    def values(self):
+        if self.func is not None:
+            return self.func()
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        out = self.header()
+        for key, value in sorted(self.values().items()):
+            out.append("{}{} {}".format(self.name, _labels(self.labels, key), _num(value)))
+        return out
+
+
+class Gauge(Counter):
+    """ A value that goes up and down """
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """ Fixed-bucket histogram, observe() is O(log buckets) """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, *labels):
+        """ Context manager that observes how long its block took """
+        return _Timer(self, labels)
+
+    def snapshot(self, *labels):
+        """ (cumulative bucket counts, count, sum) """
+        with self._lock:
+            counts, total = self._series.get(labels, [[0] * (len(self.buckets) + 1), 0.0])
+            counts = list(counts)
+        cumulative, running = [], 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        return cumulative, running, total
+
+    def quantile(self, q, *labels):
+        """ Upper bucket bound that q of the observations fall under """
+        cumulative, count, _ = self.snapshot(*labels)
+        if not count:
+            return None
+        i = bisect.bisect_left(cumulative, q * count)
+        return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+    def render(self):
+        out = self.header()
+        with self._lock:
+            keys = sorted(self._series)
+        for key in keys:
+            cumulative, count, total = self.snapshot(*key)
+            names = self.labels + ("le",)
+            for bound, c in zip(self.buckets + (float("inf"),), cumulative):
+                out.append("{}_bucket{} {}".format(
+                    self.name, _labels(names, key + (_num(bound),)), c))
+            out.append("{}_sum{} {}".format(self.name, _labels(self.labels, key), repr(total)))
+            out.append("{}_count{} {}".format(self.name, _labels(self.labels, key), count))
+        return out
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(monotonic() - self.start, *self.labels)
+
+
+class Registry(object):
+    """ The metrics served at /metrics """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self.add(Counter(name, help, labels, func))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self.add(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as err:
+                # one broken callback shouldn't take the whole page down
+                lines.append("# {} failed: {!r}".format(metric.name, err))
+        return "\n".join(lines) + "\n"
+
+
+# ============================================================================
+# SAMPLING PROFILER
+# ============================================================================
+
+class SamplingProfiler(object):
+    """ Samples the stacks of the named threads every 'interval' seconds
+
+    Counts are kept per collapsed stack ("thread;outer;...;inner"), the
+    format flamegraph.pl takes. Costs nothing while it isn't running.
+    """
+
+    def __init__(self, interval=0.005, threads=None):
+        self.interval = interval
+        self.threads = threads
+        self.samples = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _names(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        if self.threads:
+            names = dict((ident, name) for ident, name in names.items()
+                         if name in self.threads)
+        return names
+
+    def sample(self):
+        me = threading.current_thread().ident
+        names = self._names()
+        for ident, frame in sys._current_frames().items():
+            if ident == me or ident not in names:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name,
+                                                 os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names[ident])
+            self.samples[";".join(reversed(stack))] += 1
+
+    def run_for(self, seconds):
+        """ Sample for 'seconds', returns the collapsed stacks as text """
+        with self._lock:
+            self.samples = collections.Counter()
+            deadline = monotonic() + seconds
+            while monotonic() < deadline:
+                self.sample()
+                time.sleep(self.interval)
+            return "".join("{} {}\n".format(stack, n)
+                           for stack, n in self.samples.most_common())
+
+
+# ============================================================================
+# HTTP ENDPOINT
+# ============================================================================
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        server = self.server
+        if url.path == "/metrics":
+            body = server.registry.render()
+            ctype = "text/plain; version=0.0.4"
+        elif url.path == "/profile" and server.profiler is not None:
+            query = parse_qs(url.query)
+            seconds = min(float(query.get("seconds", ["10"])[0]), 300.0)
+            body = server.profiler.run_for(seconds)
+            ctype = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # scrapes every 15 s would otherwise flood the journal
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """ Serves a Registry (and optionally a profiler) on a background thread """
+
+    def __init__(self, registry, port=METRICS_PORT, host="127.0.0.1", profiler=None):
+        self.httpd = _Server((host, port), _Handler)
+        self.httpd.registry = registry
+        self.httpd.profiler = profiler
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name="metrics")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ============================================================================
+# THE STATION'S METRICS
+# ============================================================================
+
+class StationMetrics(object):
+    """ Every metric the station exports, plus the hooks that feed them """
+
+    def __init__(self, registry=None):
+        self.registry = registry = registry or Registry()
+        self.sensor_latency = registry.histogram(
+            "station_sensor_read_seconds", "Sensor read time, retries included",
+            ("sensor",))
+        self.sensor_reads = registry.counter(
+            "station_sensor_reads_total", "Sensor reads by outcome", ("sensor", "status"))
+        self.sensor_attempts = registry.counter(
+            "station_sensor_attempts_total", "Sensor read attempts, retries included",
+            ("sensor",))
+        self.tick_jitter = registry.histogram(
+            "station_task_jitter_seconds", "How late each periodic task started",
+            ("task",))
+        self.tick_busy = registry.histogram(
+            "station_task_seconds", "Time each periodic task run took", ("task",))
+        self.sink_latency = registry.histogram(
+            "station_sink_write_seconds", "Batch write time per sink", ("sink",))
+        self.upload_latency = registry.histogram(
+            "station_upload_seconds", "WU upload request time", ("status",))
+        self.dht_invalid = registry.gauge(
+            "station_dht_invalid_ratio", "Share of DHT11 read attempts that were invalid",
+            func=self._dht_ratio)
+        self._tasks = []
+        self._workers = []
+        self._uploader = None
+        self._devices = None
+
+        registry.counter("station_task_overruns_total", "Task runs that overran their slot",
+                         ("task",), func=lambda: self._task_stat("overruns"))
+        registry.counter("station_task_skipped_total", "Task slots skipped after overruns",
+                         ("task",), func=lambda: self._task_stat("skipped"))
+        registry.counter("station_task_errors_total", "Task runs that raised",
+                         ("task",), func=lambda: self._task_stat("errors"))
+        registry.gauge("station_sink_queue_depth", "Records waiting for each sink",
+                       ("sink",), func=lambda: self._sink_stat("depth"))
+        registry.counter("station_sink_dropped_total", "Records dropped by each sink",
+                         ("sink",), func=lambda: self._sink_stat("dropped"))
+        registry.counter("station_sink_errors_total", "Failed batch writes",
+                         ("sink",), func=lambda: self._sink_stat("errors"))
+        registry.gauge("station_upload_backlog", "Readings queued for WU",
+                       func=self._backlog)
+        registry.counter("station_w1_crc_errors_total", "DS18B20 reads with a bad CRC",
+                         ("probe",), func=lambda: self._probe_stat("crc_errors"))
+        registry.counter("station_w1_failures_total", "DS18B20 reads that ran out of retries",
+                         ("probe",), func=lambda: self._probe_stat("failures"))
+
+    # ---- hooks --------------------------------------------------------------
+
+    def observe_snapshot(self, snap):
+        """ Call with every acquisition.Snapshot """
+        for name, result in snap.results.items():
+            self.sensor_reads.inc(name, result.status)
+            if result.attempts:
+                self.sensor_attempts.inc(name, by=result.attempts)
+            if result.status != "busy":
+                self.sensor_latency.observe(result.latency, name)
+
+    def _on_task(self, name, jitter, busy):
+        self.tick_jitter.observe(max(jitter, 0.0), name)
+        self.tick_busy.observe(busy, name)
+
+    def _on_sink(self, name, seconds, records):
+        self.sink_latency.observe(seconds, name)
+
+    def _on_upload(self, seconds, status):
+        self.upload_latency.observe(seconds, "error" if status is None else str(status))
+
+    def watch_scheduler(self, scheduler):
+        self._tasks = scheduler.tasks
+        for task in scheduler.tasks:
+            task.observer = self._on_task
+
+    def watch_pipeline(self, pipeline):
+        self._workers = pipeline.workers
+        for worker in pipeline.workers:
+            worker.observer = self._on_sink
+
+    def watch_uploader(self, uploader):
+        self._uploader = uploader
+        uploader.observer = self._on_upload
+
+    def watch_devices(self, devices):
+        self._devices = devices
+
+    # ---- values read at scrape time -----------------------------------------
+
+    def _task_stat(self, key):
+        return dict(((t.name,), getattr(t.stats, key)) for t in self._tasks)
+
+    def _sink_stat(self, key):
+        return dict(((w.sink.name,), w.stats()[key]) for w in self._workers)
+
+    def _backlog(self):
+        if self._uploader is None:
+            return {}
+        return {(): self._uploader.backlog()}
+
+    def _probe_stat(self, key):
+        w1 = self._devices._drivers.get("w1") if self._devices is not None else None
+        if not hasattr(w1, "stats"):
+            return {}
+        return dict(((name, ), s[key]) for name, s in w1.stats().items())
+
+    def _dht_ratio(self):
+        attempts = self.sensor_attempts.values().get(("dht",), 0)
+        good = self.sensor_reads.values().get(("dht", "ok"), 0)
+        if not attempts:
+            return {}
+        return {(): (attempts - good) / attempts}
+
+
+def bench(n=200000):
+    """ What recording costs, and how long a scrape takes """
+    metrics = StationMetrics()
+    hist = metrics.sensor_latency
+    start = monotonic()
+    for i in range(n):
+        hist.observe(0.0123, "sense")
+    observe = (monotonic() - start) / n
+    start = monotonic()
+    for i in range(n):
+        metrics.sensor_reads.inc("sense", "ok")
+    inc = (monotonic() - start) / n
+    for sensor in ("sense", "cpu", "w1", "dht"):
+        hist.observe(0.01, sensor)
+    start = monotonic()
+    page = metrics.registry.render()
+    scrape = monotonic() - start
+    print("histogram observe: {:.2f} us".format(observe * 1e6))
+    print("counter inc:       {:.2f} us".format(inc * 1e6))
+    print("scrape: {} lines in {:.2f} ms".format(page.count("\n"), scrape * 1000))
+
+
+if __name__ == "__main__":
+    bench()
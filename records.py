@@ -0,0 +1,57 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - the recorded reading
+
+    A record is a plain dict: "ts" (seconds since the epoch, UTC) plus one
+    float per measured field, or None when that sensor had nothing good.
+    FIELDS is in the same order as the columns of the old text log.
+
+    A record may also carry "degraded", the fields the cross-sensor
+    comparator (comparator.py) doesn't trust; upload sinks send
+    scrubbed(record) so those never leave the station.
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import time
+
+FIELDS = (
+    "temp_f",      # Sense HAT, CPU-heat corrected (F)
+    "t_hum",       # Sense HAT humidity sensor temperature (F)
+    "t_press",     # Sense HAT pressure sensor temperature (F)
+    "pressure",    # Sense HAT pressure (inHg)
+    "humidity",    # Sense HAT relative humidity (%)
+    "t_cpu",       # CPU temperature (F)
+    "t_dht",       # DHT11 temperature (F)
+    "h_dht",       # DHT11 relative humidity (%)
+    "dew_pt_dht",  # dew point from the DHT11 (F)
+    "t_tecf",      # DS18B20 temperature (F)
+    "dew_pt_tec",  # dew point from the DS18B20 + DHT11 (F)
+)
+
+
+def make_record(reading, ts=None):
+    """ Turn a reading dict (missing keys, [] placeholders) into a record """
+    if ts is None:
+        ts = time.time()
+    record = {"ts": ts}
+    for field in FIELDS:
+        value = reading.get(field)
+        if value is None or value == []:
+            record[field] = None
+        else:
+            record[field] = float(value)
+    return record
+
+
+def scrubbed(record):
+    """ The record with its degraded fields set to None (a copy if any are) """
+    degraded = record.get("degraded")
+    if not degraded:
+        return record
+    record = dict(record)
+    for field in degraded:
+        record[field] = None
+    return record
@@ -0,0 +1,383 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - precomputed rollups and range queries
+
+    Keeps min / max / sum / count per field in 1-minute, 1-hour and 1-day
+    buckets, so "hourly min/max/mean temperature last month" is a slice of
+    a few small arrays instead of a rescan of every daily log.
+
+    Each resolution is a set of NumPy arrays sorted by bucket start time;
+    that sorted start array is the timestamp index, and a range query is
+    two binary searches plus a slice. New records update the current
+    bucket in place (O(1)); history can be loaded in bulk from the binary
+    store (tsstore.py) or the log importer (log_import.py).
+
+    The saved rollups remember how many rows they took from each day of
+    the store, so a day that changes later (history bulk-loaded with
+    log_import.py --store, rows lost in a crash between saves) is cleared
+    and folded in again the next time they are opened.
+
+    usage: rollups.py STORE_DIR [FIELD [ROLLUP_FILE]]   (benchmarks with no arguments)
+           ROLLUP_FILE defaults to rollups.npz next to STORE_DIR, as full_ws.py keeps it
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import calendar
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from records import FIELDS
+from scheduler import monotonic
+
+RESOLUTIONS = (("1m", 60), ("1h", 3600), ("1d", 86400))
+
+
+class Rollup(object):
+    """ min/max/sum/count per field for fixed-size time buckets """
+
+    def __init__(self, seconds, fields=FIELDS, capacity=1024):
+        self.seconds = int(seconds)
+        self.fields = tuple(fields)
+        self.n = 0
+        width = len(self.fields)
+        self._start = np.zeros(capacity, np.int64)
+        self._min = np.full((capacity, width), np.nan)
+        self._max = np.full((capacity, width), np.nan)
+        self._sum = np.zeros((capacity, width))
+        self._count = np.zeros((capacity, width), np.int64)
+
+    def _grow(self, need):
+        capacity = len(self._start)
+        if need <= capacity:
+            return
+        while capacity < need:
+            capacity *= 2
+        extra = capacity - len(self._start)
+        width = len(self.fields)
+        self._start = np.concatenate([self._start, np.zeros(extra, np.int64)])
+        self._min = np.concatenate([self._min, np.full((extra, width), np.nan)])
+        self._max = np.concatenate([self._max, np.full((extra, width), np.nan)])
+        self._sum = np.concatenate([self._sum, np.zeros((extra, width))])
+        self._count = np.concatenate([self._count, np.zeros((extra, width), np.int64)])
+
+    def _row_for(self, bucket):
+        """ Index of the bucket's row, inserting an empty one if needed """
+        n = self.n
+        if n and self._start[n - 1] == bucket:
+            return n - 1
+        if n == 0 or bucket > self._start[n - 1]:
+            self._grow(n + 1)
+            self._start[n] = bucket
+            self.n += 1
+            return n
+        # late data: find (or make room for) its bucket
+        i = int(np.searchsorted(self._start[:n], bucket))
+        if self._start[i] == bucket:
+            return i
+        self._grow(n + 1)
+        for arr in (self._start, self._min, self._max, self._sum, self._count):
+            arr[i + 1:n + 1] = arr[i:n]
+        self._start[i] = bucket
+        self._min[i] = np.nan
+        self._max[i] = np.nan
+        self._sum[i] = 0.0
+        self._count[i] = 0
+        self.n += 1
+        return i
+
+    def add(self, ts, values):
+        """ Fold one sample in; values has one float per field (NaN = missing) """
+        row = self._row_for(int(ts) // self.seconds * self.seconds)
+        present = ~np.isnan(values)
+        self._min[row] = np.fmin(self._min[row], values)
+        self._max[row] = np.fmax(self._max[row], values)
+        self._sum[row] += np.where(present, values, 0.0)
+        self._count[row] += present
+
+    def add_arrays(self, ts, values):
+        """ Fold many samples in; ts in epoch seconds, values is (n, fields) """
+        if not len(ts):
+            return
+        order = np.argsort(ts, kind="mergesort")
+        ts = np.asarray(ts)[order]
+        values = np.asarray(values, np.float64)[order]
+        buckets = ts.astype(np.int64) // self.seconds * self.seconds
+        starts, first = np.unique(buckets, return_index=True)
+        present = ~np.isnan(values)
+        b_min = np.fmin.reduceat(values, first, axis=0)
+        b_max = np.fmax.reduceat(values, first, axis=0)
+        b_sum = np.add.reduceat(np.where(present, values, 0.0), first, axis=0)
+        b_count = np.add.reduceat(present.astype(np.int64), first, axis=0)
+
+        n = self.n
+        if n == 0 or starts[0] > self._start[n - 1]:
+            # the usual case: all of it is newer than what we have
+            self._grow(n + len(starts))
+            self._start[n:n + len(starts)] = starts
+            self._min[n:n + len(starts)] = b_min
+            self._max[n:n + len(starts)] = b_max
+            self._sum[n:n + len(starts)] = b_sum
+            self._count[n:n + len(starts)] = b_count
+            self.n += len(starts)
+            return
+        for i, bucket in enumerate(starts):
+            row = self._row_for(bucket)
+            self._min[row] = np.fmin(self._min[row], b_min[i])
+            self._max[row] = np.fmax(self._max[row], b_max[i])
+            self._sum[row] += b_sum[i]
+            self._count[row] += b_count[i]
+
+    def query(self, field, start=None, end=None):
+        """ Buckets with start <= bucket time < end as a dict of arrays """
+        col = self.fields.index(field)
+        starts = self._start[:self.n]
+        lo = 0 if start is None else int(np.searchsorted(starts, start, side="left"))
+        hi = self.n if end is None else int(np.searchsorted(starts, end, side="left"))
+        count = self._count[lo:hi, col]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum[lo:hi, col] / count
+        return {
+            "ts": starts[lo:hi].copy(),
+            "min": self._min[lo:hi, col].copy(),
+            "max": self._max[lo:hi, col].copy(),
+            "mean": mean,
+            "count": count.copy(),
+        }
+
+    def clear(self, start, end):
+        """ Drop the buckets with start <= bucket time < end """
+        n = self.n
+        lo = int(np.searchsorted(self._start[:n], start, side="left"))
+        hi = int(np.searchsorted(self._start[:n], end, side="left"))
+        gone = hi - lo
+        if not gone:
+            return
+        for arr in (self._start, self._min, self._max, self._sum, self._count):
+            arr[lo:n - gone] = arr[hi:n]
+        # the freed rows go back to empty, _row_for expects that
+        self._min[n - gone:n] = np.nan
+        self._max[n - gone:n] = np.nan
+        self._sum[n - gone:n] = 0.0
+        self._count[n - gone:n] = 0
+        self.n -= gone
+
+    def arrays(self):
+        n = self.n
+        return {
+            "start": self._start[:n], "min": self._min[:n], "max": self._max[:n],
+            "sum": self._sum[:n], "count": self._count[:n],
+        }
+
+    def load_arrays(self, arrays):
+        n = len(arrays["start"])
+        self.n = 0
+        self._grow(n)
+        self._start[:n] = arrays["start"]
+        self._min[:n] = arrays["min"]
+        self._max[:n] = arrays["max"]
+        self._sum[:n] = arrays["sum"]
+        self._count[:n] = arrays["count"]
+        self.n = n
+
+
+class RollupIndex(object):
+    """ The 1-minute, 1-hour and 1-day rollups kept together """
+
+    def __init__(self, fields=FIELDS, resolutions=RESOLUTIONS):
+        self.fields = tuple(fields)
+        self.resolutions = tuple(resolutions)
+        self.rollups = dict((name, Rollup(seconds, self.fields))
+                            for name, seconds in self.resolutions)
+        # newest sample folded in so far (epoch seconds)
+        self.last_ts = None
+        # rows taken from each day of the store (YYYYMMDD -> count), see catch_up
+        self.store_rows = {}
+        self._lock = threading.Lock()
+
+    def add_record(self, record):
+        """ Fold in a record (records.py), called as each sample arrives """
+        values = np.array([np.nan if record.get(f) is None else record[f]
+                           for f in self.fields], np.float64)
+        with self._lock:
+            for rollup in self.rollups.values():
+                rollup.add(record["ts"], values)
+            self.last_ts = max(record["ts"], self.last_ts or record["ts"])
+
+    def add_arrays(self, arrays):
+        """ Fold in history laid out like TSStore.read() / log_import """
+        with self._lock:
+            self._add_arrays(arrays)
+
+    def _add_arrays(self, arrays):
+        if not len(arrays["ts"]):
+            return
+        ts_us = np.asarray(arrays["ts"])
+        values = np.column_stack([np.asarray(arrays[f], np.float64)
+                                  for f in self.fields])
+        newest = ts_us.max() / 1000000.0
+        for rollup in self.rollups.values():
+            rollup.add_arrays(ts_us // 1000000, values)
+        self.last_ts = max(newest, self.last_ts or newest)
+
+    def catch_up(self, store):
+        """ Fold in whatever the store has that these rollups haven't seen
+
+        A day whose row count differs from what was taken from it last time
+        has its buckets cleared and is folded in again whole, so rows older
+        than last_ts are picked up as well as new ones. Returns those days.
+        """
+        redone = []
+        for day in store.days():
+            seg = store.segment(day)
+            if self.store_rows.get(day) == len(seg):
+                continue
+            arrays = {"ts": seg.ts}
+            for field in self.fields:
+                arrays[field] = seg.columns.get(field, np.full(len(seg), np.nan))
+            start = calendar.timegm(time.strptime(day, "%Y%m%d"))
+            with self._lock:
+                # store days are UTC, so every bucket lies inside one day
+                for rollup in self.rollups.values():
+                    rollup.clear(start, start + 86400)
+                self._add_arrays(arrays)
+                self.store_rows[day] = len(seg)
+            redone.append(day)
+        return redone
+
+    def pick_resolution(self, start, end, max_points):
+        """ The finest resolution that covers start..end in max_points buckets """
+        if start is None or end is None:
+            return self.resolutions[-1][0]
+        for name, seconds in self.resolutions:
+            if (end - start) / seconds <= max_points:
+                return name
+        return self.resolutions[-1][0]
+
+    def query(self, field, start=None, end=None, resolution=None, max_points=2000):
+        """ min/max/mean/count of field per bucket for start <= t < end
+
+        start and end are epoch seconds; resolution is "1m", "1h" or "1d",
+        or None to pick the finest one that fits in max_points buckets.
+        """
+        if resolution is None:
+            resolution = self.pick_resolution(start, end, max_points)
+        with self._lock:
+            return self.rollups[resolution].query(field, start, end)
+
+    def save(self, path):
+        """ Write every rollup to one .npz file (atomically) """
+        arrays = {}
+        with self._lock:
+            for name, rollup in self.rollups.items():
+                for key, value in rollup.arrays().items():
+                    arrays[name + "_" + key] = value.copy()
+            last_ts = self.last_ts if self.last_ts is not None else np.nan
+            days = sorted(self.store_rows)
+            rows = [self.store_rows[day] for day in days]
+        # the station and the query command may both save
+        tmp = "{}.{}.tmp.npz".format(path, os.getpid())
+        np.savez(tmp, fields=np.array(self.fields), last_ts=last_ts,
+                 store_days=np.array(days, "U8"), store_rows=np.array(rows, np.int64),
+                 **arrays)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(fields=tuple(str(f) for f in data["fields"]))
+        for name, rollup in index.rollups.items():
+            rollup.load_arrays(dict((key, data[name + "_" + key]) for key in
+                                    ("start", "min", "max", "sum", "count")))
+        last_ts = float(data["last_ts"])
+        index.last_ts = None if np.isnan(last_ts) else last_ts
+        # files saved before store_rows was kept are redone from the store
+        if "store_days" in data.files:
+            index.store_rows = dict((str(day), int(rows)) for day, rows in
+                                    zip(data["store_days"], data["store_rows"]))
+        return index
+
+    @classmethod
+    def from_store(cls, store):
+        """ Build the rollups from every day in a TSStore """
+        index = cls()
+        index.catch_up(store)
+        return index
+
+
+def default_path(store_root):
+    """ Where full_ws.py keeps the rollups for a store: next to it """
+    return os.path.join(os.path.dirname(os.path.normpath(store_root)), "rollups.npz")
+
+
+def open_index(path, store):
+    """ Load the saved rollups (or start empty) and catch them up from the store """
+    if path is not None and os.path.exists(path):
+        index = RollupIndex.load(path)
+    else:
+        index = RollupIndex()
+    index.catch_up(store)
+    return index
+
+
+def bench(days=365):
+    """ A year of 1-minute samples: bulk build, live updates, hourly query """
+    n = days * 1440
+    ts = 1.5e9 + np.arange(n) * 60.0
+    hours = np.arange(n) / 60.0
+    arrays = {"ts": (ts * 1000000).astype(np.int64)}
+    for i, field in enumerate(FIELDS):
+        arrays[field] = 50 + 20 * np.sin(2 * np.pi * hours / 24.0) + i
+
+    index = RollupIndex()
+    start = monotonic()
+    index.add_arrays(arrays)
+    print("bulk build, {} samples: {:.0f} ms".format(n, (monotonic() - start) * 1000))
+
+    record = dict((field, 50.0) for field in FIELDS)
+    start = monotonic()
+    for i in range(10000):
+        record["ts"] = ts[-1] + 60 * (i + 1)
+        index.add_record(record)
+    print("live update: {:.1f} us/record".format((monotonic() - start) * 100))
+
+    start = monotonic()
+    result = index.query("temp_f", ts[0], ts[-1], resolution="1h")
+    took = monotonic() - start
+    print("year of hourly temp_f: {} buckets in {:.3f} ms".format(
+        len(result["ts"]), took * 1000))
+
+
+def main():
+    from tsstore import TSStore
+
+    if len(sys.argv) < 2:
+        bench()
+        return
+    store = TSStore(sys.argv[1])
+    field = sys.argv[2] if len(sys.argv) > 2 else "temp_f"
+    path = sys.argv[3] if len(sys.argv) > 3 else default_path(sys.argv[1])
+    if os.path.exists(path):
+        index = RollupIndex.load(path)
+    else:
+        index = RollupIndex()
+    redone = index.catch_up(store)
+    if redone and os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        index.save(path)
+        print("folded in {} day(s) from the store, saved {}".format(len(redone), path))
+    result = index.query(field, resolution="1d")
+    for i in range(len(result["ts"])):
+        print("{}  min {:6.1f}  max {:6.1f}  mean {:6.1f}  n {}".format(
+            time.strftime("%Y-%m-%d", time.gmtime(result["ts"][i])),
+            result["min"][i], result["max"][i], result["mean"][i],
+            result["count"][i]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - periodic task scheduler
+
+    Runs each part of the station loop (sampling, display, logging,
+    upload) as its own periodic task on a worker thread, so a slow LED
+    scroll or a hung upload can't drag the sample rate down with it.
+
+    Deadlines are kept on the monotonic clock as start + k * period, so
+    the schedule doesn't drift. When a task overruns, the missed slots
+    are skipped (not queued up) and counted. Every task keeps jitter and
+    overrun statistics that can be printed with Scheduler.report().
+
+    The clock can be swapped for a ScaledClock to run the whole schedule
+    faster than real time (simulator.py).
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library
+    monotonic = time.time
+
+
+class ScaledClock(object):
+    """ A monotonic clock running 'speed' times faster than real time
+
+    For simulation (simulator.py): give it to a Scheduler or Acquisition
+    and periods, deadlines and waits all pass that much faster. time() is
+    the matching wall clock, starting at 'start' (epoch seconds, default
+    now).
+    """
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = float(speed)
+        self._real_start = monotonic()
+        self._start = time.time() if start is None else start
+
+    def __call__(self):
+        return (monotonic() - self._real_start) * self.speed
+
+    def time(self):
+        return self._start + self()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def wait(self, event, seconds):
+        return event.wait(seconds / self.speed)
+
+
+def wall_time(clock=monotonic):
+    """ Epoch seconds on clock's timeline (time.time() for the real clock) """
+    return clock.time() if hasattr(clock, "time") else time.time()
+
+
+def sleep_on(clock, seconds):
+    """ time.sleep() in clock's seconds """
+    if hasattr(clock, "sleep"):
+        clock.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def wait_on(clock, event, seconds):
+    """ event.wait() (or a Condition's) with the timeout in clock's seconds """
+    if hasattr(clock, "wait"):
+        return clock.wait(event, seconds)
+    return event.wait(seconds)
+
+
+def aligned_offset(period, now=None):
+    """ Seconds until the wall clock reaches the next multiple of period """
+    if now is None:
+        now = time.time()
+    return (period - (now % period)) % period
+
+
+class TaskStats(object):
+    """ Running counters for one periodic task """
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_last = 0.0
+        self.jitter_max = 0.0
+        self.jitter_sum = 0.0
+        self.busy_last = 0.0
+        self.busy_max = 0.0
+        self.busy_sum = 0.0
+
+    def record(self, jitter, busy):
+        self.runs += 1
+        self.jitter_last = jitter
+        self.jitter_sum += jitter
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+        self.busy_last = busy
+        self.busy_sum += busy
+        if busy > self.busy_max:
+            self.busy_max = busy
+
+    def as_dict(self):
+        runs = max(self.runs, 1)
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_last": self.jitter_last,
+            "jitter_max": self.jitter_max,
+            "jitter_mean": self.jitter_sum / runs,
+            "busy_last": self.busy_last,
+            "busy_max": self.busy_max,
+            "busy_mean": self.busy_sum / runs,
+        }
+
+
+class PeriodicTask(threading.Thread):
+    """ Calls func every period seconds on its own thread """
+
+    def __init__(self, name, period, func, offset=0.0, clock=monotonic):
+        super(PeriodicTask, self).__init__(name=name)
+        self.daemon = True
+        self.period = float(period)
+        self.func = func
+        self.offset = float(offset)
+        self.clock = clock
+        self.stats = TaskStats()
+        # optional observer(name, jitter, busy) called after every run
+        self.observer = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        next_due = self.clock() + self.offset
+        while not self._stop_event.is_set():
+            delay = next_due - self.clock()
+            if delay > 0 and wait_on(self.clock, self._stop_event, delay):
+                break
+
+            start = self.clock()
+            try:
+                self.func()
+            except Exception:
+                self.stats.errors += 1
+                print("Task '{}' failed:".format(self.name), file=sys.stderr)
+                traceback.print_exc()
+            end = self.clock()
+            self.stats.record(start - next_due, end - start)
+            if self.observer is not None:
+                self.observer(self.name, start - next_due, end - start)
+
+            # next slot on the fixed grid; skip any we've already blown past
+            next_due += self.period
+            if end > next_due:
+                missed = int((end - next_due) // self.period) + 1
+                self.stats.overruns += 1
+                self.stats.skipped += missed
+                next_due += missed * self.period
+
+
+class Scheduler(object):
+    """ A set of PeriodicTasks started and stopped together """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.tasks = []
+
+    def add(self, name, period, func, offset=0.0):
+        task = PeriodicTask(name, period, func, offset=offset, clock=self.clock)
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        for task in self.tasks:
+            task.start()
+
+    def stop(self, timeout=None):
+        for task in self.tasks:
+            task.stop()
+        for task in self.tasks:
+            if task.is_alive():
+                task.join(timeout)
+
+    def stats(self):
+        return dict((task.name, task.stats.as_dict()) for task in self.tasks)
+
+    def report(self):
+        """ One line per task with run count, overruns and jitter (ms) """
+        lines = []
+        for task in self.tasks:
+            s = task.stats.as_dict()
+            lines.append(
+                "{:<10} runs={:<6} overruns={:<4} skipped={:<4} errors={:<4} "
+                "jitter mean/max={:.1f}/{:.1f} ms busy max={:.1f} ms".format(
+                    task.name, s["runs"], s["overruns"], s["skipped"],
+                    s["errors"], s["jitter_mean"] * 1000.0,
+                    s["jitter_max"] * 1000.0, s["busy_max"] * 1000.0))
+        return "\n".join(lines)
+
+    def run_forever(self, report_interval=None):
+        """ Start every task and block the calling thread until interrupted """
+        self.start()
+        last_report = self.clock()
+        try:
+            while True:
+                time.sleep(1)
+                if report_interval and self.clock() - last_report >= report_interval:
+                    last_report = self.clock()
+                    print(self.report())
+        finally:
+            self.stop(timeout=5)
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - shared-memory sample ring
+
+    The acquisition daemon (full_ws.py --role acquire) publishes every
+    sample into a ring of fixed-layout records in a memory-mapped file,
+    /dev/shm/weather_ring by default. The display, the sinks and any
+    ad-hoc tool read it from their own processes; a consumer that crashes
+    or stalls can't hold up sampling or the other consumers.
+
+    The file is a 4 KB header and then 'capacity' slots:
+
+        header   magic, version, capacity, slot size, head (records
+                 published so far, u8 at HEAD_OFFSET), the writer's pid and
+                 the field names as JSON
+        slot     seq u8, ts f8 (epoch seconds), valid u4 (bit i = field i
+                 has a value), fresh u4 (bit i = field i was read this
+                 sample), then one f4 per field
+
+    There is one writer and no locks. Record n goes in slot n % capacity;
+    the writer marks the slot's seq odd (2n + 1), writes the record, sets
+    seq to 2n + 2 and only then bumps head. Each reader keeps its own
+    cursor. A read takes the records between its cursor and head, checks
+    every slot's seq, and checks head again afterwards. Anything the
+    writer may have overwritten in the meantime is counted as lost
+    rather than returned. A reader that fell more than a whole ring
+    behind skips ahead, and the records it missed are counted as an
+    overrun.
+
+    Records come back as a NumPy structured array. read(copy=False)
+    returns a view straight onto the mapping. It is only good until the
+    writer laps it; lapped() says whether that happened.
+
+    Python can't issue memory barriers. On x86 the stores are seen in
+    order anyway. On the Pi's ARM cores the seq and head checks catch a
+    slot caught mid-write, but a stale read isn't ruled out formally.
+    In practice the writer spends microseconds between a slot's data and
+    its seq.
+
+    usage: shm_ring.py bench | tail [PATH]
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from records import FIELDS
+from scheduler import monotonic
+
+RING_PATH = "/dev/shm/weather_ring"
+CAPACITY = 4096
+MAGIC = b"WXRING01"
+VERSION = 1
+HEADER_SIZE = 4096
+# magic, version, capacity, slot size, field count, writer pid, started
+_HEADER = struct.Struct("<8sIIIIId")
+HEAD_OFFSET = 64
+FIELDS_OFFSET = 128
+_U64 = struct.Struct("<Q")
+
+
+class RingError(Exception):
+    """ The file isn't a ring, or not one this code can read """
+
+
+def record_dtype(fields=FIELDS):
+    """ The NumPy layout of one slot """
+    return np.dtype([("seq", "<u8"), ("ts", "<f8"), ("valid", "<u4"),
+                     ("fresh", "<u4")] + [(f, "<f4") for f in fields])
+
+
+class RingWriter(object):
+    """ The one process that publishes into the ring
+
+    Creates (or takes over) the file at path; a fresh start always begins
+    at head 0, and readers notice the restart by the new writer pid (or a
+    new file, if the layout changed).
+    """
+
+    def __init__(self, path=RING_PATH, capacity=CAPACITY, fields=FIELDS):
+        if len(fields) > 32:
+            raise ValueError("the valid/fresh bitmaps hold at most 32 fields")
+        self.path = path
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.dtype = record_dtype(self.fields)
+        self.slot_size = self.dtype.itemsize
+        size = HEADER_SIZE + capacity * self.slot_size
+        names = json.dumps(list(self.fields)).encode("ascii")
+        if FIELDS_OFFSET + len(names) > HEADER_SIZE:
+            raise ValueError("too many field names for the header")
+
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            # readers still have the old one mapped; shrinking it under them
+            # would crash them, so they get a new file (and notice the inode)
+            os.unlink(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._map[0:8] = b"\0" * 8
+        self._map[HEADER_SIZE:] = b"\0" * (size - HEADER_SIZE)
+        self._map[FIELDS_OFFSET:FIELDS_OFFSET + len(names)] = names
+        _U64.pack_into(self._map, HEAD_OFFSET, 0)
+        # magic last, so a reader never sees a half-written header as valid
+        _HEADER.pack_into(self._map, 0, b"\0" * 8, VERSION, capacity, self.slot_size,
+                          len(self.fields), os.getpid(), time.time())
+        self._map[0:8] = MAGIC
+        self._body = struct.Struct("<dII" + "f" * len(self.fields))
+        self._index = dict((f, i) for i, f in enumerate(self.fields))
+        self.head = 0
+
+    def publish(self, record, fresh=()):
+        """ Add a record (records.py); fresh names the fields read just now """
+        values = []
+        valid = 0
+        for i, field in enumerate(self.fields):
+            value = record.get(field)
+            if value is None or value == []:
+                values.append(float("nan"))
+            else:
+                valid |= 1 << i
+                values.append(value)
+        bits = 0
+        for field in fresh:
+            if field in self._index:
+                bits |= 1 << self._index[field]
+        self.publish_values(record["ts"], valid, bits, values)
+
+    def publish_values(self, ts, valid, fresh, values):
+        """ The raw form of publish(), values in field order """
+        n = self.head
+        offset = HEADER_SIZE + (n % self.capacity) * self.slot_size
+        _U64.pack_into(self._map, offset, 2 * n + 1)
+        self._body.pack_into(self._map, offset + 8, ts, valid, fresh, *values)
+        _U64.pack_into(self._map, offset, 2 * n + 2)
+        self.head = n + 1
+        _U64.pack_into(self._map, HEAD_OFFSET, self.head)
+
+    def stats(self):
+        return {"path": self.path, "published": self.head, "capacity": self.capacity}
+
+    def close(self):
+        self._map.close()
+
+
+class RingReader(object):
+    """ One consumer's cursor into the ring
+
+    start is "latest" (only what's published from now on) or "oldest"
+    (everything still in the ring).
+    """
+
+    def __init__(self, path=RING_PATH, start="latest"):
+        self.path = path
+        self._start = start
+        self.lost = 0
+        self.overruns = 0
+        self.restarts = 0
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            self._ino = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER_SIZE:
+            raise RingError("{} is too short for a ring".format(self.path))
+        (magic, version, self.capacity, self.slot_size, count, self.writer_pid,
+         self.started) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RingError("{} isn't a version {} ring".format(self.path, VERSION))
+        names = self._map[FIELDS_OFFSET:HEADER_SIZE].split(b"\0", 1)[0]
+        self.fields = tuple(json.loads(names.decode("ascii")))
+        self.dtype = record_dtype(self.fields)
+        if self.dtype.itemsize != self.slot_size or len(self.fields) != count:
+            raise RingError("{} has a slot layout this reader doesn't know".format(self.path))
+        self.slots = np.frombuffer(self._map, dtype=self.dtype, count=self.capacity,
+                                   offset=HEADER_SIZE)
+        head = self.head()
+        self.cursor = head if self._start == "latest" else max(0, head - self.capacity)
+
+    def head(self):
+        return _U64.unpack_from(self._map, HEAD_OFFSET)[0]
+
+    def _restarted(self):
+        return (self._map[0:8] != MAGIC or
+                _HEADER.unpack_from(self._map, 0)[5] != self.writer_pid)
+
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self._ino
+        except OSError:
+            return False
+
+    def read(self, max_records=None, copy=True):
+        """ The records published since the last read, oldest first
+
+        Returns at most one contiguous stretch of the ring (so maybe fewer
+        than are waiting; call again until it comes back empty).
+        """
+        head = self.head()
+        if (head < self.cursor or self._restarted() or
+                (head == self.cursor and self._replaced())):
+            # the writer started over: a new file, or the same one from 0
+            self.restarts += 1
+            self._map.close()
+            self._start = "oldest"
+            self._open()
+            head = self.head()
+        behind = head - self.cursor
+        if behind > self.capacity:
+            self.overruns += 1
+            self.lost += behind - self.capacity
+            self.cursor = head - self.capacity
+        first = self.cursor % self.capacity
+        n = min(head - self.cursor, self.capacity - first)
+        if max_records is not None:
+            n = min(n, max_records)
+        if n <= 0:
+            return self.slots[:0]
+        chunk = self.slots[first:first + n]
+        if copy:
+            chunk = chunk.copy()
+        # a slot mid-write (odd seq) or already rewritten isn't this record
+        expected = 2 * np.arange(self.cursor, self.cursor + n, dtype=np.uint64) + 2
+        good = chunk["seq"] == expected
+        # anything the writer may have started on since we looked at head
+        overwritten = self.head() - self.capacity + 1 - self.cursor
+        if overwritten > 0:
+            good[:overwritten] = False
+        self.cursor += n
+        if not good.all():
+            self.lost += int(n - np.count_nonzero(good))
+            chunk = chunk[good]
+        return chunk
+
+    def lapped(self, records):
+        """ True if the writer has overwritten any of these (a copy=False view) """
+        if not len(records):
+            return False
+        oldest = (int(records["seq"][0]) - 2) // 2
+        return self.head() - self.capacity > oldest
+
+    def wait(self, timeout=None, poll=0.01):
+        """ Sleep until something new is published, False on timeout """
+        deadline = None if timeout is None else monotonic() + timeout
+        while self.head() == self.cursor:
+            if deadline is not None and monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def stats(self):
+        return {"cursor": self.cursor, "head": self.head(), "lost": self.lost,
+                "overruns": self.overruns, "restarts": self.restarts}
+
+    def close(self):
+        self.slots = None
+        self._map.close()
+
+
+def as_record(row, fields):
+    """ One ring row back to a record dict, plus the fields that were fresh """
+    record = {"ts": float(row["ts"])}
+    fresh = []
+    valid, bits = int(row["valid"]), int(row["fresh"])
+    for i, field in enumerate(fields):
+        record[field] = float(row[field]) if valid >> i & 1 else None
+        if bits >> i & 1:
+            fresh.append(field)
+    return record, fresh
+
+
+# ============================================================================
+# BENCHMARK AND TOOLS
+# ============================================================================
+
+def _consume(path, seconds, poll, out):
+    """ Reader process for bench(): latency of every record it sees """
+    reader = RingReader(path)
+    latencies = []
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        records = reader.read()
+        now = time.time()
+        if len(records):
+            latencies.extend((now - records["ts"]).tolist())
+        elif poll:
+            time.sleep(poll)
+    out.put((len(latencies), np.percentile(latencies, [50, 99]).tolist()
+             if latencies else [0, 0], reader.stats()))
+
+
+def bench(path="/dev/shm/weather_ring_bench", n=200000):
+    """ Publish and read throughput, and end-to-end latency across processes """
+    import multiprocessing
+
+    if not os.path.isdir(os.path.dirname(path)):
+        path = os.path.join("/tmp", os.path.basename(path))
+    writer = RingWriter(path, capacity=CAPACITY)
+    values = [60.0] * len(FIELDS)
+    start = monotonic()
+    for i in range(n):
+        writer.publish_values(time.time(), 0x7ff, 0x7ff, values)
+    publish = (monotonic() - start) / n
+    record = dict((f, 60.0) for f in FIELDS)
+    record["ts"] = time.time()
+    start = monotonic()
+    for i in range(n // 10):
+        writer.publish(record, FIELDS)
+    publish_dict = (monotonic() - start) / (n // 10)
+    print("publish: {:.2f} us raw, {:.2f} us from a record dict".format(
+        publish * 1e6, publish_dict * 1e6))
+
+    reader = RingReader(path, start="oldest")
+    total = 0
+    start = monotonic()
+    while True:
+        records = reader.read()
+        if not len(records):
+            break
+        total += len(records)
+    took = monotonic() - start
+    print("read: {} records in {:.1f} ms ({:.0f} records/s, copied)".format(
+        total, took * 1000, total / took))
+
+    for rate, poll in ((1000, 0.001), (1000, 0.0), (20000, 0.001)):
+        queue = multiprocessing.Queue()
+        seconds = 2.0
+        consumer = multiprocessing.Process(target=_consume,
+                                           args=(path, seconds + 0.5, poll, queue))
+        consumer.start()
+        time.sleep(0.3)
+        gap = 1.0 / rate
+        deadline = monotonic() + seconds
+        next_due = monotonic()
+        while monotonic() < deadline:
+            writer.publish_values(time.time(), 0x7ff, 0x7ff, values)
+            next_due += gap
+            delay = next_due - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        seen, (p50, p99), stats = queue.get()
+        consumer.join()
+        print("{:>6}/s, reader {}: {} seen, latency p50 {:.3f} ms p99 {:.3f} ms, "
+              "lost {}".format(rate, "polling every {:.0f} ms".format(poll * 1000)
+                               if poll else "spinning", seen, p50 * 1000, p99 * 1000,
+                               stats["lost"]))
+    writer.close()
+    os.unlink(path)
+
+
+def tail(path=RING_PATH):
+    """ Print every record as it's published """
+    reader = RingReader(path)
+    print("ring {}: {} slots, writer pid {}, {} published".format(
+        path, reader.capacity, reader.writer_pid, reader.head()))
+    while True:
+        reader.wait()
+        for row in reader.read():
+            record, fresh = as_record(row, reader.fields)
+            print(time.strftime("%H:%M:%S", time.localtime(record["ts"])),
+                  " ".join("{}={}{}".format(f, "" if record[f] is None else
+                                            round(record[f], 2), "*" if f in fresh else "")
+                           for f in reader.fields))
+        if reader.lost:
+            print("lost {} records so far".format(reader.lost))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench()
+    elif len(sys.argv) > 1 and sys.argv[1] == "tail":
+        tail(*sys.argv[2:3])
+    else:
+        print("usage: shm_ring.py bench | tail [PATH]")
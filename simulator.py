@@ -0,0 +1,558 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - hardware-free simulator and end-to-end benchmark
+
+    Runs full_ws.main() as it is, off the Pi. Fake sense_hat, dht11 and
+    RPi.GPIO modules (and a config) go into sys.modules, the DS18B20s and
+    the CPU thermal zone are files in a temporary sysfs tree, and WU is a
+    local stand-in server (backfill.StandIn). What the sensors read comes
+    from a trace, synthetic (compression.synthetic()) or replayed from the
+    store or the old text logs, interpolated to the simulated time and
+    looped if the run is longer than the trace.
+
+    The station runs on a scheduler.ScaledClock, 'speed' times faster than
+    real time, and the fakes take their time on the same clock: a Sense
+    HAT read SENSE_LATENCY, a DHT11 read DHT_LATENCY with DHT_INVALID of
+    them coming back invalid, a DS18B20 conversion W1_CONVERSION with
+    CRC_ERRORS of them giving a bad CRC the probe has to retry, and an
+    upload WU_LATENCY.
+
+    run reports what main()'s pipeline managed: samples per real second,
+    tick jitter, sensor outcomes, what each sink wrote, upload lag (in
+    simulated seconds, from a reading being taken to WU getting it),
+    memory and CPU. bench does a set of runs, each in its own process.
+
+    Every millisecond a thread waits for the CPU is 'speed' milliseconds
+    on the simulated clock. Past some speed the host can't keep up and
+    sensor reads start missing their deadlines (the timeouts column)
+    where the Pi wouldn't: compare changes at a speed below that.
+
+    usage: simulator.py run [--speed N] [--minutes N] [--trace STORE | LOGS..]
+                            [--compression KIND|none] [--seed N] [--json]
+           simulator.py bench
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import argparse
+import calendar
+import collections
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+
+from backfill import StandIn
+from hal import Devices, FakeSenseHat
+from meteo import f_to_c, inhg_to_hpa
+from scheduler import ScaledClock, monotonic, wait_on
+from sysfs_readers import fake_thermal
+from w1probes import ProbeSet, fake_bus, write_w1_slave
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+SPEED = 60  # simulated seconds per real second
+MINUTES = 60  # simulated minutes per run
+# how long the hardware takes, in simulated seconds, and how often it fails
+SENSE_LATENCY = 0.004  # each Sense HAT reading (I2C)
+DHT_LATENCY = 0.025  # bit-banging one DHT11 frame
+DHT_INVALID = 0.25  # share of DHT11 reads that come back invalid
+W1_CONVERSION = 0.75  # 12-bit DS18B20 conversion
+CRC_ERRORS = 0.02  # share of conversions read back with a bad CRC
+CRC_GLITCH = 0.1  # until a bad CRC reads OK again
+WU_LATENCY = 0.15  # WU answering an upload
+THERMAL_UPDATE = 2.5  # the CPU thermal zone is rewritten this often
+# DS18B20s on the fake bus: {device id: offset from the trace's t_tecf, C}
+PROBES = {"28-0316a2794cff": 0.0, "28-0416a1f0e2ff": -1.5}
+# what a sensor reads when the trace never has its field (F, %, inHg)
+DEFAULTS = {
+    "t_tecf": 68.0, "t_hum": 75.0, "t_press": 76.0, "humidity": 40.0,
+    "pressure": 29.9, "t_dht": 68.0, "h_dht": 45.0, "t_cpu": 115.0,
+}
+# bench: (speed, simulated minutes, upload compression), about 20 s real each
+SCENARIOS = [
+    (60, 20, "none"),
+    (240, 80, "none"),
+    (960, 320, "none"),
+    (960, 320, "deadband"),
+    (3000, 1000, "none"),
+]
+
+# ============================================================================
+# TRACES
+# ============================================================================
+
+class Trace(object):
+    """ Readings over time (store-layout arrays) to replay, looped past the end """
+
+    def __init__(self, arrays):
+        ts = np.asarray(arrays["ts"], np.float64) / 1000000.0
+        if not len(ts):
+            raise ValueError("empty trace")
+        order = np.argsort(ts, kind="mergesort")
+        ts = ts[order]
+        self.start = float(ts[0])
+        self.end = float(ts[-1])
+        self.span = max(self.end - self.start, 60.0)
+        self._points = {}
+        for field in DEFAULTS:
+            if field not in arrays:
+                continue
+            column = np.asarray(arrays[field], np.float64)[order]
+            valid = ~np.isnan(column)
+            if valid.any():
+                self._points[field] = (ts[valid], column[valid])
+
+    def value(self, field, when):
+        """ field at epoch seconds 'when' """
+        points = self._points.get(field)
+        if points is None:
+            return DEFAULTS[field]
+        when = self.start + (when - self.start) % self.span
+        return float(np.interp(when, *points))
+
+
+def load_trace(paths=None, seed=0):
+    """ A store directory, text logs, or (no paths) two weeks of synthetic minutes """
+    if not paths:
+        from compression import synthetic
+        return Trace(synthetic(20000, seed))
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        from tsstore import TSStore
+        return Trace(TSStore(paths[0]).read())
+    from log_import import load_logs
+    return Trace(load_logs(paths)[0])
+
+
+# ============================================================================
+# SIMULATED HARDWARE
+# ============================================================================
+
+def _rewrite(path, text):
+    """ Overwrite a sysfs file in place (see w1probes.write_w1_slave) """
+    with open(path, "r+") as f:
+        f.write(text)
+        f.truncate()
+
+
+class Simulation(object):
+    """ The fake station's surroundings: trace, clock, sysfs tree and counters """
+
+    def __init__(self, trace, clock, root, seed=None):
+        self.trace = trace
+        self.clock = clock
+        self.root = root
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = collections.defaultdict(int)
+        # simulated seconds from each reading being taken to WU getting it
+        self.lags = []
+        fake_bus(root, dict((device_id, self.probe_temp(device_id))
+                            for device_id in PROBES), bulk=False)
+        fake_thermal(root, self.cpu_temp())
+        self.thermal = os.path.join(root, "class", "thermal", "thermal_zone0", "temp")
+        # a file the display can write frames to like /dev/fb1
+        self.framebuffer = os.path.join(root, "fb1")
+        with open(self.framebuffer, "wb") as f:
+            f.write(b"\0" * 128)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._update, name="sim-sysfs")
+        self._thread.daemon = True
+
+    def value(self, field):
+        return self.trace.value(field, self.clock.time())
+
+    def chance(self, p):
+        return self.random.random() < p
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def probe_temp(self, device_id):
+        return f_to_c(self.value("t_tecf")) + PROBES[device_id]
+
+    def cpu_temp(self):
+        return f_to_c(self.value("t_cpu"))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _update(self):
+        while not wait_on(self.clock, self._stop_event, THERMAL_UPDATE):
+            _rewrite(self.thermal, "{}\n".format(int(round(self.cpu_temp() * 1000))))
+
+    def on_upload(self, params):
+        """ StandIn observer: note how old the reading WU just got is """
+        taken = calendar.timegm(time.strptime(params["dateutc"], "%Y-%m-%d %H:%M:%S"))
+        lag = self.clock.time() - taken
+        with self.lock:
+            self.lags.append(lag)
+
+
+class SimSenseHat(FakeSenseHat):
+    """ FakeSenseHat reading the trace, SENSE_LATENCY a reading """
+
+    def __init__(self, sim):
+        super(SimSenseHat, self).__init__(seed=sim.random.random())
+        self.sim = sim
+        # display.led_for() writes frames here
+        self._fb_device = sim.framebuffer
+
+    def _read(self, field):
+        self.sim.clock.sleep(SENSE_LATENCY)
+        self.sim.count("sense_reads")
+        return self.sim.value(field)
+
+    def get_temperature_from_humidity(self):
+        return f_to_c(self._read("t_hum")) + self._noise(0.05)
+
+    def get_temperature_from_pressure(self):
+        return f_to_c(self._read("t_press")) + self._noise(0.05)
+
+    def get_humidity(self):
+        return self._read("humidity") + self._noise(0.3)
+
+    def get_pressure(self):
+        return inhg_to_hpa(self._read("pressure")) + self._noise(0.1)
+
+
+class DHT11Result(object):
+    """ dht11.DHT11Result """
+
+    ERR_NO_ERROR = 0
+    ERR_MISSING_DATA = 1
+    ERR_CRC = 2
+
+    def __init__(self, error_code, temperature, humidity):
+        self.error_code = error_code
+        self.temperature = temperature
+        self.humidity = humidity
+
+    def is_valid(self):
+        return self.error_code == DHT11Result.ERR_NO_ERROR
+
+
+class SimDHT11(object):
+    """ dht11.DHT11 on the trace: whole degrees and percent, often invalid """
+
+    def __init__(self, sim, pin):
+        self.sim = sim
+        self.pin = pin
+
+    def read(self):
+        self.sim.clock.sleep(DHT_LATENCY)
+        if self.sim.chance(DHT_INVALID):
+            self.sim.count("dht_invalid")
+            error = self.sim.random.choice((DHT11Result.ERR_MISSING_DATA,
+                                            DHT11Result.ERR_CRC))
+            return DHT11Result(error, 0, 0)
+        self.sim.count("dht_ok")
+        return DHT11Result(DHT11Result.ERR_NO_ERROR,
+                           int(round(f_to_c(self.sim.value("t_dht")))),
+                           int(round(self.sim.value("h_dht"))))
+
+
+class SimProbeSet(ProbeSet):
+    """ ProbeSet on the fake bus, each conversion W1_CONVERSION, some with a bad CRC
+
+    Files in a plain directory can't block like the w1-therm driver does,
+    so the conversion is slept here and then the temperatures written.
+    """
+
+    def __init__(self, sim):
+        # Probe's retry_delay is real time, the 0.2 s it stands for isn't
+        super(SimProbeSet, self).__init__(sim.root, bulk=False,
+                                          retry_delay=0.2 / sim.clock.speed)
+        self.sim = sim
+
+    def read_all(self):
+        start = monotonic()
+        self.sim.clock.sleep(W1_CONVERSION)
+        for probe in self.probes:
+            path = os.path.join(probe.path, "w1_slave")
+            temp_c = self.sim.probe_temp(probe.device_id)
+            if not self.sim.chance(CRC_ERRORS):
+                write_w1_slave(path, temp_c)
+                continue
+            # reads bad until CRC_GLITCH has gone by
+            self.sim.count("crc_injected")
+            write_w1_slave(path, temp_c, crc_ok=False)
+            timer = threading.Timer(CRC_GLITCH / self.sim.clock.speed,
+                                    write_w1_slave, (path, temp_c))
+            timer.daemon = True
+            timer.start()
+        self.conversion_time = monotonic() - start
+        return super(SimProbeSet, self).read_all()
+
+
+def _nothing(*args, **kwargs):
+    pass
+
+
+def install_modules(sim, station_id="SIM", station_key="sim"):
+    """ Fake sense_hat, dht11, RPi.GPIO and config modules, all reading 'sim' """
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    module("sense_hat", SenseHat=lambda: SimSenseHat(sim))
+    module("dht11", DHT11=lambda pin: SimDHT11(sim, pin), DHT11Result=DHT11Result)
+    gpio = module("RPi.GPIO", BCM=11, BOARD=10, IN=1, OUT=0, LOW=0, HIGH=1,
+                  setwarnings=_nothing, setmode=_nothing, setup=_nothing,
+                  cleanup=_nothing, output=_nothing, input=lambda pin: 0)
+    module("RPi", GPIO=gpio)
+    module("config", Config=type("Config", (object,), {
+        "STATION_ID": station_id, "STATION_KEY": station_key}))
+
+
+# ============================================================================
+# RUN
+# ============================================================================
+
+def _memory():
+    """ (resident, peak resident) MB of this process """
+    sizes = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    sizes[key] = int(value.split()[0]) / 1024.0
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is kB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return sizes.get("VmRSS"), sizes.get("VmHWM", peak)
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _percentiles(values, qs):
+    if not values:
+        return [None] * len(qs)
+    return [float(v) for v in np.percentile(values, qs)]
+
+
+def run(speed=SPEED, minutes=MINUTES, trace=None, compression="none",
+        seed=0):
+    """ full_ws.main() for 'minutes' of simulated time, returns its figures """
+    import full_ws as ws
+
+    trace = trace or load_trace(seed=seed)
+    root = tempfile.mkdtemp(prefix="ws_sim_")
+    clock = ScaledClock(speed, start=trace.start)
+    sim = Simulation(trace, clock, os.path.join(root, "sys"), seed)
+    install_modules(sim)
+    server = StandIn(WU_LATENCY / speed)
+    server.observer = sim.on_upload
+
+    # everything the station writes goes in the temporary directory
+    ws.clock = clock
+    ws.STORE_DIR = os.path.join(root, "Store") + os.sep
+    ws.ROLLUP_FILE = os.path.join(root, "rollups.npz")
+    ws.CALIBRATION_FILE = os.path.join(root, "calibration.json")
+    ws.UPLOAD_QUEUE = os.path.join(root, "wu_queue.db")
+    ws.CHECKPOINT = os.path.join(root, "backfill.db")
+    ws.SQL_DB = os.path.join(root, "weather.db")
+    ws.RING_PATH = os.path.join(root, "ring")
+    ws.OBJECT_STORE = None
+    ws.TEXT_LOG = False
+    ws.METRICS_PORT = None
+    ws.WEATHER_UPLOAD = True
+    ws.UPLOAD_URL = server.url
+    # compression of the uploads; the store isn't compressed either way
+    if compression != "none":
+        ws.COMPRESSION = compression
+    ws.COMPRESS_UPLOADS = compression != "none"
+    devices = Devices(sysfs_root=sim.root, fakes={"w1": SimProbeSet(sim)})
+
+    # main() runs until the SIGINT at the end of the simulated time
+    timer = threading.Timer(minutes * 60.0 / speed, os.kill, (os.getpid(), signal.SIGINT))
+    timer.daemon = True
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        sim.start()
+        ws.init_station(station_devices=devices)
+        simulated = clock()
+        cpu = _cpu()
+        start = monotonic()
+        timer.start()
+        try:
+            ws.main()
+        except KeyboardInterrupt:
+            pass
+        real = monotonic() - start
+        cpu = _cpu() - cpu
+        simulated = clock() - simulated
+    finally:
+        timer.cancel()
+        sys.stdout.close()
+        sys.stdout = stdout
+        sim.stop()
+        server.shutdown()
+        server.server_close()
+
+    try:
+        tasks = ws.tasks.stats()
+        sample = tasks["sample"]
+        lags = sorted(sim.lags)
+        rss, peak = _memory()
+        p50, p95 = _percentiles(lags, [50, 95])
+        probes = devices.w1.stats().values()
+        figures = {
+            "speed": speed,
+            "compression": compression,
+            "simulated": simulated,
+            "real": real,
+            "samples": sample["runs"],
+            "samples_per_s": sample["runs"] / real,
+            "records": tasks["record"]["runs"],
+            # simulated seconds; divide by speed for real time
+            "jitter_mean": sample["jitter_mean"],
+            "jitter_max": sample["jitter_max"],
+            "busy_mean": sample["busy_mean"],
+            "overruns": sum(t["overruns"] for t in tasks.values()),
+            "skipped": sum(t["skipped"] for t in tasks.values()),
+            "task_errors": sum(t["errors"] for t in tasks.values()),
+            "sensors": dict(("{}/{}".format(*key), n)
+                            for key, n in ws.metrics.sensor_reads.values().items()),
+            "sinks": dict((worker.sink.name, worker.stats())
+                          for worker in ws.pipeline.workers),
+            "uploads": len(lags),
+            "lag_p50": p50,
+            "lag_p95": p95,
+            "lag_max": lags[-1] if lags else None,
+            "uploader": ws.uploader.stats(),
+            "fakes": dict(sim.counts),
+            "crc_errors": sum(p["crc_errors"] for p in probes),
+            "w1_failures": sum(p["failures"] for p in probes),
+            "rss_mb": rss,
+            "peak_mb": peak,
+            "cpu": 100.0 * cpu / real,
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return figures
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "{:.0f}".format(seconds * 1000.0)
+
+
+def report(f):
+    """ run()'s figures for people """
+    speed = f["speed"]
+    print("{:.0f} simulated minutes at {:g}x in {:.1f} s ({}, compression {})".format(
+        f["simulated"] / 60.0, speed, f["real"], "synthetic trace"
+        if f.get("trace") is None else f["trace"], f["compression"]))
+    print("samples   {} ({:.1f}/s real), {} records".format(
+        f["samples"], f["samples_per_s"], f["records"]))
+    print("jitter    mean/max {}/{} ms simulated, {:.2f}/{:.2f} ms real".format(
+        _ms(f["jitter_mean"]), _ms(f["jitter_max"]),
+        f["jitter_mean"] * 1000.0 / speed, f["jitter_max"] * 1000.0 / speed))
+    print("tasks     {} overruns, {} slots skipped, {} errors; sample busy {} ms".format(
+        f["overruns"], f["skipped"], f["task_errors"], _ms(f["busy_mean"])))
+    print("sensors  ", ", ".join("{} {}".format(key, n)
+                                 for key, n in sorted(f["sensors"].items())))
+    fakes = f["fakes"]
+    print("faults    {} invalid DHT11 reads of {}, {} bad CRCs injected, "
+          "{} seen, {} probe failures".format(
+              fakes.get("dht_invalid", 0),
+              fakes.get("dht_invalid", 0) + fakes.get("dht_ok", 0),
+              fakes.get("crc_injected", 0), f["crc_errors"], f["w1_failures"]))
+    for name, s in sorted(f["sinks"].items()):
+        print("sink      {:<12} written={:<6} dropped={:<4} errors={:<4} depth={}".format(
+            name, s["written"], s["dropped"], s["errors"], s["depth"]))
+    if f["uploads"]:
+        print("uploads   {} at WU, lag p50/p95/max {:.1f}/{:.1f}/{:.1f} s simulated".format(
+            f["uploads"], f["lag_p50"], f["lag_p95"], f["lag_max"]))
+    else:
+        print("uploads   none at WU")
+    print("uploader ", f["uploader"])
+    print("memory    {:.1f} MB resident, {:.1f} MB peak; CPU {:.0f}%".format(
+        f["rss_mb"] or 0.0, f["peak_mb"], f["cpu"]))
+
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def bench(scenarios=SCENARIOS):
+    """ run() at several speeds, each in a fresh process so memory doesn't mix """
+    print("{:>5} {:>6} {:<13} {:>6} {:>9} {:>15} {:>8} {:>8} {:>7} {:>15} {:>13} {:>5}".format(
+        "speed", "sim", "compression", "real", "samples/s", "jitter ms real",
+        "overruns", "timeouts", "uploads", "lag p50/p95 s", "RSS/peak MB", "CPU%"))
+    for speed, minutes, compression in scenarios:
+        out = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), "run", "--json",
+            "--speed", str(speed), "--minutes", str(minutes),
+            "--compression", compression])
+        f = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+        timeouts = sum(n for key, n in f["sensors"].items()
+                       if key.endswith("/timeout"))
+        lag = "-" if not f["uploads"] else "{:.1f}/{:.1f}".format(
+            f["lag_p50"], f["lag_p95"])
+        print("{:>4}x {:>5}m {:<13} {:>5.1f}s {:>9.1f} {:>15} {:>8} {:>8} {:>7} "
+              "{:>15} {:>13} {:>5.0f}".format(
+                  speed, minutes, compression, f["real"], f["samples_per_s"],
+                  "{:.2f}/{:.2f}".format(f["jitter_mean"] * 1000.0 / speed,
+                                         f["jitter_max"] * 1000.0 / speed),
+                  f["overruns"], timeouts, f["uploads"], lag,
+                  "{:.0f}/{:.0f}".format(f["rss_mb"] or 0.0, f["peak_mb"]), f["cpu"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the station on simulated hardware")
+    parser.add_argument("command", choices=("run", "bench"))
+    parser.add_argument("--speed", type=float, default=SPEED,
+                        help="simulated seconds per real second")
+    parser.add_argument("--minutes", type=float, default=MINUTES,
+                        help="simulated minutes to run for")
+    parser.add_argument("--trace", nargs="+",
+                        help="a store directory or text logs to replay (default: synthetic)")
+    parser.add_argument("--compression", default="none",
+                        help="compress the uploads (COMPRESS_UPLOADS in full_ws.py) "
+                             "with this, or none")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the figures as JSON")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench()
+        return
+    trace = load_trace(args.trace, args.seed)
+    figures = run(args.speed, args.minutes, trace, args.compression, args.seed)
+    figures["trace"] = " ".join(args.trace) if args.trace else None
+    if args.json:
+        print(json.dumps(figures, sort_keys=True))
+    else:
+        report(figures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - fan-out pipeline to the data sinks
+
+    Each destination (Weather Underground, a SQL database, an object
+    store, the local log) is a Sink and gets its own SinkWorker thread
+    with a bounded queue, so a slow sink never holds up the others.
+    Records are written in batches. The sinks that send data off the
+    station (WU, SQL, object store) leave out fields the comparator has
+    marked degraded (records.scrubbed); the local store keeps everything.
+    CompressedSink thins a sink's records channel by channel first
+    (compression.py).
+
+    When a sink's queue is full the worker's policy decides what happens:
+
+        drop_oldest  throw away the oldest queued record (the default)
+        block        make the publisher wait (this DOES delay other sinks)
+        spill        overflow to an on-disk queue and drain it later
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import collections
+import copy
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from records import FIELDS, scrubbed
+from scheduler import monotonic, sleep_on, wait_on
+from tsstore import TSStoreWriter
+from uploader import DiskQueue, wu_params
+
+POLICIES = ("drop_oldest", "block", "spill")
+
+
+class Sink(object):
+    """ A destination for batches of records """
+
+    name = "sink"
+
+    def write(self, records):
+        """ Write a list of records, raise to have the batch retried """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SinkWorker(threading.Thread):
+    """ Feeds one Sink from a bounded queue on its own thread """
+
+    def __init__(self, sink, max_queue=1000, policy="drop_oldest",
+                 batch_size=100, max_delay=1.0, spill_path=None,
+                 retry_delay=5.0, clock=monotonic):
+        if policy not in POLICIES:
+            raise ValueError("unknown backpressure policy: {}".format(policy))
+        if policy == "spill" and spill_path is None:
+            raise ValueError("the spill policy needs a spill_path")
+        super(SinkWorker, self).__init__(name="sink-" + sink.name)
+        self.daemon = True
+        self.sink = sink
+        self.max_queue = max_queue
+        self.policy = policy
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        # max_delay and retry_delay are on this clock (scheduler.ScaledClock)
+        self.clock = clock
+        self.spill = DiskQueue(spill_path) if policy == "spill" else None
+        # spilled records left over from before a restart come first
+        self._spill_count = len(self.spill) if self.spill is not None else 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.busy = 0.0
+        # optional observer(sink name, seconds, records) after every write
+        self.observer = None
+
+    def depth(self):
+        return len(self._queue) + self._spill_count
+
+    def offer(self, record):
+        """ Queue a record, applying the backpressure policy when full """
+        with self._cond:
+            if self.spill is not None and (len(self._queue) >= self.max_queue
+                                           or self._spilling()):
+                # once spilling, keep going to disk so order is preserved
+                self.spill.put(record)
+                self._spill_count += 1
+                self.spilled += 1
+            else:
+                while self.policy == "block" and len(self._queue) >= self.max_queue \
+                        and not self._stopping:
+                    self._cond.wait(1.0)
+                if len(self._queue) >= self.max_queue:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append(record)
+            self._cond.notify_all()
+
+    def _spilling(self):
+        return self._spill_count > 0
+
+    def _next_batch(self):
+        """ Wait for a batch: full, or max_delay after the first record """
+        with self._cond:
+            deadline = None
+            while not self._stopping:
+                queued = len(self._queue)
+                if queued >= self.batch_size:
+                    break
+                if queued or self._spilling():
+                    if deadline is None:
+                        deadline = self.clock() + self.max_delay
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        break
+                    wait_on(self.clock, self._cond, remaining)
+                else:
+                    self._cond.wait(1.0)
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            self._cond.notify_all()
+        spill_ids = []
+        if self.spill is not None and len(batch) < self.batch_size:
+            for item_id, record in self.spill.peek(self.batch_size - len(batch)):
+                spill_ids.append(item_id)
+                batch.append(record)
+        return batch, spill_ids
+
+    def run(self):
+        try:
+            self._drain()
+        finally:
+            self.sink.close()
+
+    def _drain(self):
+        while True:
+            batch, spill_ids = self._next_batch()
+            if not batch:
+                if self._stopping:
+                    break
+                continue
+            while True:
+                start = monotonic()
+                try:
+                    self.sink.write(batch)
+                    break
+                except Exception as err:
+                    self.errors += 1
+                    print("Sink '{}' write failed: {!r}".format(self.sink.name, err),
+                          file=sys.stderr)
+                    if self._stopping:
+                        # give up on this batch and the rest of the queue;
+                        # spilled records stay on disk for next time
+                        with self._cond:
+                            self.dropped += len(batch) - len(spill_ids) + len(self._queue)
+                            self._queue.clear()
+                        return
+                    sleep_on(self.clock, self.retry_delay)
+            took = monotonic() - start
+            self.busy += took
+            if self.observer is not None:
+                self.observer(self.sink.name, took, len(batch))
+            if spill_ids:
+                self.spill.ack(spill_ids)
+                with self._cond:
+                    self._spill_count -= len(spill_ids)
+            self.written += len(batch)
+            self.batches += 1
+
+    def stop(self, timeout=None):
+        """ Flush what's queued, then stop """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "errors": self.errors,
+            "depth": self.depth(),
+            # records per second of time actually spent writing
+            "throughput": self.written / self.busy if self.busy else 0.0,
+        }
+
+
+class Pipeline(object):
+    """ Publishes every record to each SinkWorker """
+
+    def __init__(self, workers=(), clock=monotonic):
+        self.workers = list(workers)
+        self.clock = clock
+
+    def add(self, sink, **kwargs):
+        kwargs.setdefault("clock", self.clock)
+        worker = SinkWorker(sink, **kwargs)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def publish(self, record):
+        for worker in self.workers:
+            worker.offer(record)
+
+    def stop(self, timeout=10.0):
+        for worker in self.workers:
+            worker.stop(timeout)
+
+    def report(self):
+        lines = []
+        for worker in self.workers:
+            s = worker.stats()
+            lines.append(
+                "{:<10} written={:<7} batches={:<5} dropped={:<5} spilled={:<5} "
+                "errors={:<4} depth={:<5} {:.0f} rec/s".format(
+                    worker.sink.name, s["written"], s["batches"], s["dropped"],
+                    s["spilled"], s["errors"], s["depth"], s["throughput"]))
+        return "\n".join(lines)
+
+
+# ============================================================================
+# SINKS
+# ============================================================================
+
+class CallbackSink(Sink):
+    """ Calls func(record) for every record, e.g. the text log """
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def write(self, records):
+        for record in records:
+            self.func(record)
+
+
+class CompressedSink(Sink):
+    """ Runs records through a compression.Compressor on the way to another sink
+
+    Degraded fields are scrubbed first, so they show up as gaps. Whatever
+    the compressor still holds back goes out on close().
+    """
+
+    def __init__(self, sink, compressor):
+        self.sink = sink
+        self.compressor = compressor
+        self.name = sink.name
+
+    def write(self, records):
+        # the worker retries a failed batch from the top, so the compressor
+        # only moves on once the inner sink has taken what it kept
+        before = copy.deepcopy(self.compressor)
+        out = []
+        for record in records:
+            out.extend(self.compressor.update(scrubbed(record)))
+        if out:
+            try:
+                self.sink.write(out)
+            except Exception:
+                self.compressor = before
+                raise
+
+    def close(self):
+        out = self.compressor.flush()
+        if out:
+            self.sink.write(out)
+        self.sink.close()
+
+
+class TSStoreSink(Sink):
+    """ Appends records to the binary time-series store (tsstore.py) """
+
+    name = "store"
+
+    def __init__(self, root, fsync="interval", fsync_interval=60.0):
+        self.writer = TSStoreWriter(root, fsync=fsync, fsync_interval=fsync_interval)
+
+    def write(self, records):
+        self.writer.append_many(records)
+
+    def close(self):
+        self.writer.close()
+
+
+class RollupSink(Sink):
+    """ Keeps the query rollups (rollups.py) up to date, saving them now and then """
+
+    name = "rollups"
+
+    def __init__(self, index, path=None, save_interval=3600.0):
+        self.index = index
+        self.path = path
+        self.save_interval = save_interval
+        self._last_save = monotonic()
+
+    def write(self, records):
+        for record in records:
+            self.index.add_record(record)
+        if self.path is not None and monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        self.index.save(self.path)
+        self._last_save = monotonic()
+
+    def close(self):
+        if self.path is not None:
+            self.save()
+
+
+class WUSink(Sink):
+    """ Hands records to the store-and-forward WU uploader (uploader.py) """
+
+    name = "wu"
+
+    def __init__(self, uploader, station_id, station_key, altitude=None):
+        self.uploader = uploader
+        self.station_id = station_id
+        self.station_key = station_key
+        self.altitude = altitude
+
+    def write(self, records):
+        params = []
+        for record in map(scrubbed, records):
+            params.append(wu_params(
+                self.station_id, self.station_key, record["temp_f"],
+                record["dew_pt_tec"], record["h_dht"], record["pressure"],
+                when=datetime.datetime.utcfromtimestamp(record["ts"]),
+                altitude=self.altitude))
+        self.uploader.queue.put_many(params)
+        self.uploader.wake()
+
+
+class SQLSink(Sink):
+    """ Multi-row INSERTs into a DB-API database (MySQL, SQLite, ...)
+
+    connect is a function returning a new connection; placeholder is the
+    driver's parameter marker ("%s" for MySQLdb, "?" for sqlite3).
+    """
+
+    name = "sql"
+    # stay under SQLite's default limit of 999 bound variables
+    max_params = 999
+
+    def __init__(self, connect, table="readings", placeholder="%s"):
+        self.connect = connect
+        self.table = table
+        self.placeholder = placeholder
+        self.columns = ("ts",) + FIELDS
+        self._db = None
+
+    def _connection(self):
+        if self._db is None:
+            self._db = self.connect()
+        return self._db
+
+    def write(self, records):
+        db = self._connection()
+        row_marks = "(" + ", ".join([self.placeholder] * len(self.columns)) + ")"
+        rows_per_insert = max(1, self.max_params // len(self.columns))
+        try:
+            cursor = db.cursor()
+            for i in range(0, len(records), rows_per_insert):
+                chunk = records[i:i + rows_per_insert]
+                sql = "INSERT INTO {} ({}) VALUES {}".format(
+                    self.table, ", ".join(self.columns),
+                    ", ".join([row_marks] * len(chunk)))
+                args = []
+                for record in map(scrubbed, chunk):
+                    args.extend(record.get(column) for column in self.columns)
+                cursor.execute(sql, args)
+            db.commit()
+        except Exception:
+            # drop the connection, the worker retries the whole batch
+            self.close()
+            raise
+
+    def close(self):
+        if self._db is not None:
+            try:
+                self._db.close()
+            finally:
+                self._db = None
+
+
+class SQLiteSink(SQLSink):
+    """ SQLSink against a local SQLite file, a stand-in for the MySQL site """
+
+    name = "sqlite"
+
+    def __init__(self, path, table="readings"):
+        self.path = path
+        super(SQLiteSink, self).__init__(self._open, table=table, placeholder="?")
+
+    def _open(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS {} (ts REAL, {})".format(
+            self.table, ", ".join(field + " REAL" for field in FIELDS)))
+        db.execute("CREATE INDEX IF NOT EXISTS {0}_ts ON {0} (ts)".format(self.table))
+        return db
+
+
+class ObjectStoreSink(Sink):
+    """ One JSON-lines object per batch under a directory tree
+
+    A stand-in for an S3/GCS bucket: keys look like
+    prefix/YYYY/MM/DD/<first ts>-<count>.jsonl and every object is written
+    to a temporary name and renamed, so readers never see half an object.
+    JSON has no NaN: a compressed sink's gap markers are written as null
+    and the record's "gaps" lists those fields.
+    """
+
+    name = "objects"
+
+    def __init__(self, root, prefix="weather"):
+        self.root = root
+        self.prefix = prefix
+
+    def write(self, records):
+        first = datetime.datetime.utcfromtimestamp(records[0]["ts"])
+        folder = os.path.join(self.root, self.prefix, first.strftime("%Y/%m/%d"))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        key = os.path.join(folder, "{:.3f}-{}.jsonl".format(records[0]["ts"],
+                                                            len(records)))
+        tmp = key + ".tmp"
+        with open(tmp, "w") as obj:
+            for record in map(scrubbed, records):
+                obj.write(json.dumps(_json_record(record), sort_keys=True,
+                                     allow_nan=False) + "\n")
+        os.rename(tmp, key)
+
+
+def _json_record(record):
+    """ The record with NaN (a compression gap marker) as null, listed in 'gaps' """
+    gaps = sorted(field for field, value in record.items()
+                  if isinstance(value, float) and value != value)
+    record = _no_nan(record)
+    if gaps:
+        record["gaps"] = gaps
+    return record
+
+
+def _no_nan(value):
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, dict):
+        return dict((k, _no_nan(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_no_nan(v) for v in value]
+    return value
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - sysfs readers
+
+    Sensor values that live in sysfs files (CPU temperature, the DS18B20's
+    w1_slave) used to cost an open/read/close per sample, and the CPU
+    temperature a whole vcgencmd process. SysfsReader keeps the file
+    descriptor open and re-reads it from offset 0 with pread(), which
+    makes the kernel produce a fresh value each time. A reader that hits
+    an error reopens its file on the next read (a 1-Wire probe that
+    dropped off and came back).
+
+    CPU temperature comes from /sys/class/thermal instead of vcgencmd.
+    TickCache keeps a value for the rest of a sampling tick, so reading the
+    CPU temperature twice in one tick (once on its own, once for the Sense
+    HAT correction) only touches the hardware once.
+
+    Every reader counts its reads, errors and latency.
+
+    usage: sysfs_readers.py [SYSFS_ROOT]   (benchmarks the CPU temperature)
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import glob
+import os
+import sys
+import threading
+
+from scheduler import monotonic
+
+SYSFS_ROOT = "/sys"
+# thermal zone types that are the SoC on Raspberry Pi kernels
+CPU_ZONE_TYPES = ("cpu-thermal", "cpu_thermal", "bcm2835_thermal")
+
+
+class ReadStats(object):
+    """ Read count, errors and latency of one reader """
+
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, latency):
+        self.reads += 1
+        self.total += latency
+        self.last = latency
+        if latency > self.max:
+            self.max = latency
+
+    def __str__(self):
+        mean = self.total / self.reads if self.reads else 0.0
+        return "{:<20} reads={:<8} errors={:<5} mean={:.3f} ms max={:.3f} ms".format(
+            self.name, self.reads, self.errors, mean * 1000, self.max * 1000)
+
+
+if hasattr(os, "pread"):
+    def _pread(fd, size):
+        return os.pread(fd, size, 0)
+else:
+    def _pread(fd, size):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class SysfsReader(object):
+    """ A sysfs file held open and re-read from the start """
+
+    def __init__(self, path, name=None, size=4096):
+        self.path = path
+        self.size = size
+        self.stats = ReadStats(name or path)
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def read_bytes(self):
+        start = monotonic()
+        with self._lock:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_RDONLY)
+                data = _pread(self._fd, self.size)
+            except (IOError, OSError):
+                self.stats.errors += 1
+                self._close()
+                raise
+        self.stats.add(monotonic() - start)
+        return data
+
+    def read_text(self):
+        return self.read_bytes().decode("ascii", "replace")
+
+    def _close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def find_cpu_zone(sysfs_root=SYSFS_ROOT):
+    """ temp file of the CPU's thermal zone (zone 0 if none says it's the CPU) """
+    zones = sorted(glob.glob(os.path.join(sysfs_root, "class", "thermal",
+                                          "thermal_zone*")))
+    for zone in zones:
+        try:
+            with open(os.path.join(zone, "type")) as f:
+                if f.read().strip() in CPU_ZONE_TYPES:
+                    return os.path.join(zone, "temp")
+        except (IOError, OSError):
+            continue
+    if zones and os.path.exists(os.path.join(zones[0], "temp")):
+        return os.path.join(zones[0], "temp")
+    return None
+
+
+class CPUThermal(object):
+    """ CPU temperature (C) from the thermal zone, millidegrees in sysfs """
+
+    def __init__(self, path):
+        self.reader = SysfsReader(path, name="cpu")
+
+    def read(self):
+        return int(self.reader.read_bytes()) / 1000.0
+
+    def readers(self):
+        return [self.reader]
+
+
+class Vcgencmd(object):
+    """ CPU temperature (C) from vcgencmd, for systems without a thermal zone """
+
+    def __init__(self):
+        self.stats = ReadStats("cpu (vcgencmd)")
+
+    def read(self):
+        start = monotonic()
+        # 'borrowed' from https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
+        # executes a command at the OS to pull in the CPU temperature
+        res = os.popen('vcgencmd measure_temp').readline()
+        try:
+            return float(res.replace("temp=", "").replace("'C\n", ""))
+        except ValueError:
+            self.stats.errors += 1
+            raise
+        finally:
+            self.stats.add(monotonic() - start)
+
+    def readers(self):
+        return [self]
+
+
+def cpu_temp(sysfs_root=SYSFS_ROOT):
+    """ The cheapest CPU temperature source there is """
+    path = find_cpu_zone(sysfs_root)
+    if path is None:
+        return Vcgencmd()
+    return CPUThermal(path)
+
+
+class TickCache(object):
+    """ Wraps a driver so read() hits it at most once per tick
+
+    Call tick() at the start of each sample; reads after that share one
+    value until the next tick(). Concurrent first reads wait for the one
+    in progress rather than reading again.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.hits = 0
+        self._tick = 0
+        self._cached_tick = -1
+        self._value = None
+        self._lock = threading.Lock()
+
+    def tick(self):
+        self._tick += 1
+
+    def read(self):
+        with self._lock:
+            if self._cached_tick != self._tick:
+                self._value = self.driver.read()
+                self._cached_tick = self._tick
+            else:
+                self.hits += 1
+            return self._value
+
+    def readers(self):
+        return self.driver.readers()
+
+
+def fake_thermal(root, temp_c, zone_type="cpu-thermal"):
+    """ A sysfs tree with one CPU thermal zone at temp_c """
+    zone = os.path.join(root, "class", "thermal", "thermal_zone0")
+    if not os.path.isdir(zone):
+        os.makedirs(zone)
+    with open(os.path.join(zone, "type"), "w") as f:
+        f.write(zone_type + "\n")
+    with open(os.path.join(zone, "temp"), "w") as f:
+        f.write("{}\n".format(int(round(temp_c * 1000))))
+    return root
+
+
+def bench(sysfs_root=SYSFS_ROOT, n=2000):
+    """ Persistent pread vs open/read/close per sample (and vcgencmd once) """
+    path = find_cpu_zone(sysfs_root)
+    if path is None:
+        print("no thermal zone under", sysfs_root)
+        return
+    reader = CPUThermal(path)
+    start = monotonic()
+    for _ in range(n):
+        reader.read()
+    persistent = (monotonic() - start) / n
+
+    start = monotonic()
+    for _ in range(n):
+        with open(path) as f:
+            int(f.read())
+    reopen = (monotonic() - start) / n
+    print("thermal zone {}: {:.1f} C".format(path, reader.read()))
+    print("pread on an open fd: {:7.1f} us/read".format(persistent * 1e6))
+    print("open/read/close:     {:7.1f} us/read".format(reopen * 1e6))
+    vc = Vcgencmd()
+    try:
+        vc.read()
+        print("vcgencmd:            {:7.1f} us/read".format(vc.stats.last * 1e6))
+    except ValueError:
+        print("vcgencmd:            not available")
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else SYSFS_ROOT)
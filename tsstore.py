@@ -0,0 +1,280 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - compact binary time-series store
+
+    Replaces the per-minute text log with an append-only columnar store.
+    There is one directory per UTC day:
+
+        <root>/YYYYMMDD/ts.i8       int64 epoch microseconds, one per row
+        <root>/YYYYMMDD/<field>.f4  float32 per measurement (NaN = missing)
+        <root>/YYYYMMDD/valid.u4    uint32 validity bitmap, bit i = field i
+        <root>/YYYYMMDD/meta.json   the field list for the segment
+
+    Every row is fixed-width in every file, so row n is always at offset
+    n * itemsize and a reader can map a whole day straight into NumPy
+    arrays without copying or parsing. If a crash leaves some columns one
+    row longer than others, the extra rows are ignored on read and
+    trimmed the next time the writer opens the segment.
+
+    Rows are normally appended in time order. A day that got some late
+    (a collector station catching up) is sorted on read, into memory.
+
+    The writer only needs the standard library. Readers need NumPy.
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import datetime
+import json
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from records import FIELDS
+from scheduler import monotonic
+
+TS_FILE = "ts.i8"
+VALID_FILE = "valid.u4"
+META_FILE = "meta.json"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+_TS = struct.Struct("<q")
+_VALID = struct.Struct("<I")
+_F32 = struct.Struct("<f")
+_NAN = float("nan")
+
+
+def day_of(ts):
+    """ The segment name (UTC YYYYMMDD) for an epoch timestamp """
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y%m%d")
+
+
+def _column_file(field):
+    return field + ".f4"
+
+
+class TSStoreWriter(object):
+    """ Appends records (records.py) to the daily segments under root
+
+    fsync is "always" (every append), "interval" (at most every
+    fsync_interval seconds) or "never" (leave it to the OS).
+    """
+
+    def __init__(self, root, fields=FIELDS, fsync="interval", fsync_interval=60.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy: {}".format(fsync))
+        if len(fields) > 32:
+            raise ValueError("the validity bitmap holds at most 32 fields")
+        self.root = root
+        self.fields = tuple(fields)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._day = None
+        self._files = None
+        self._last_sync = monotonic()
+        self.rows = 0
+
+    def _open(self, day):
+        self.close()
+        folder = os.path.join(self.root, day)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        meta = os.path.join(folder, META_FILE)
+        if os.path.exists(meta):
+            with open(meta) as f:
+                if tuple(json.load(f)["fields"]) != self.fields:
+                    raise ValueError("segment {} has different fields".format(day))
+        else:
+            with open(meta, "w") as f:
+                json.dump({"fields": list(self.fields), "version": 1}, f)
+
+        names = [TS_FILE, VALID_FILE] + [_column_file(f) for f in self.fields]
+        sizes = [8, 4] + [4] * len(self.fields)
+        paths = [os.path.join(folder, name) for name in names]
+        # trim any torn row left by a crash so all columns line up again
+        rows = min(os.path.getsize(p) // size if os.path.exists(p) else 0
+                   for p, size in zip(paths, sizes))
+        self._files = []
+        for path, size in zip(paths, sizes):
+            f = open(path, "ab")
+            f.truncate(rows * size)
+            self._files.append(f)
+        self._day = day
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        """ Append records (dicts with 'ts' and the fields) in time order """
+        for record in records:
+            day = day_of(record["ts"])
+            if day != self._day:
+                self._open(day)
+            valid = 0
+            values = []
+            for i, field in enumerate(self.fields):
+                value = record.get(field)
+                if value is None or value == []:
+                    values.append(_NAN)
+                else:
+                    valid |= 1 << i
+                    values.append(float(value))
+            files = self._files
+            files[0].write(_TS.pack(int(round(record["ts"] * 1000000))))
+            files[1].write(_VALID.pack(valid))
+            for f, value in zip(files[2:], values):
+                f.write(_F32.pack(value))
+            self.rows += 1
+        self.flush()
+
+    def append_arrays(self, arrays):
+        """ Bulk append columns laid out like TSStore.read() (needs numpy)
+
+        arrays has 'ts' (int64 microseconds, sorted), 'valid' (uint32) and
+        one array per field; each day's rows are written in one go.
+        """
+        if np is None:
+            raise ImportError("bulk appends need numpy")
+        ts = np.asarray(arrays["ts"], dtype="<i8")
+        if not len(ts):
+            return
+        days = ts // (86400 * 1000000)
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(ts)]):
+            day = day_of(ts[lo] / 1000000.0)
+            if day != self._day:
+                self._open(day)
+            self._files[0].write(ts[lo:hi].tobytes())
+            self._files[1].write(np.asarray(arrays["valid"][lo:hi], "<u4").tobytes())
+            for f, field in zip(self._files[2:], self.fields):
+                f.write(np.asarray(arrays[field][lo:hi], "<f4").tobytes())
+            self.rows += int(hi - lo)
+        self.flush()
+
+    def flush(self):
+        if not self._files:
+            return
+        for f in self._files:
+            f.flush()
+        now = monotonic()
+        if self.fsync == "always" or (self.fsync == "interval" and
+                                      now - self._last_sync >= self.fsync_interval):
+            for f in self._files:
+                os.fsync(f.fileno())
+            self._last_sync = now
+
+    def close(self):
+        if self._files:
+            self.flush()
+            for f in self._files:
+                if self.fsync != "never":
+                    os.fsync(f.fileno())
+                f.close()
+        self._files = None
+        self._day = None
+
+
+class Segment(object):
+    """ One day's columns, memory-mapped read-only as NumPy arrays """
+
+    def __init__(self, folder):
+        if np is None:
+            raise ImportError("reading the store needs numpy")
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE)) as f:
+            self.fields = tuple(json.load(f)["fields"])
+        ts = self._map(TS_FILE, "<i8")
+        valid = self._map(VALID_FILE, "<u4")
+        columns = dict((field, self._map(_column_file(field), "<f4"))
+                       for field in self.fields)
+        # a torn last row (crash mid-append) is left out
+        rows = min([len(ts), len(valid)] + [len(c) for c in columns.values()])
+        ts, valid = ts[:rows], valid[:rows]
+        columns = dict((f, c[:rows]) for f, c in columns.items())
+        # read() searches ts, so late rows are sorted into place (a copy)
+        self.in_order = not (np.diff(ts) < 0).any()
+        if not self.in_order:
+            order = np.argsort(ts, kind="mergesort")
+            ts, valid = ts[order], valid[order]
+            columns = dict((f, c[order]) for f, c in columns.items())
+        self.ts = ts
+        self.valid_bits = valid
+        self.columns = columns
+
+    def _map(self, name, dtype):
+        path = os.path.join(self.folder, name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def __len__(self):
+        return len(self.ts)
+
+    def valid(self, field):
+        """ Boolean array, True where the field had a good reading """
+        bit = self.fields.index(field)
+        return (self.valid_bits >> bit) & 1 == 1
+
+
+class TSStore(object):
+    """ Read side of the store: segments, columns and time ranges """
+
+    def __init__(self, root):
+        self.root = root
+
+    def days(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root)
+                      if len(d) == 8 and d.isdigit() and
+                      os.path.exists(os.path.join(self.root, d, META_FILE)))
+
+    def segment(self, day):
+        return Segment(os.path.join(self.root, day))
+
+    def read(self, start=None, end=None, fields=None):
+        """ Rows with start <= ts < end (epoch seconds) as a dict of arrays
+
+        Keys are 'ts' (int64 microseconds), 'valid' (uint32 bitmap) and one
+        float32 array per field. A range inside one day comes back as views
+        on the mapped files; longer ranges are concatenated.
+        """
+        days = self.days()
+        if start is not None:
+            days = [d for d in days if d >= day_of(start)]
+        if end is not None:
+            days = [d for d in days if d <= day_of(end)]
+        parts = []
+        for day in days:
+            seg = self.segment(day)
+            lo, hi = 0, len(seg)
+            if start is not None:
+                lo = np.searchsorted(seg.ts, int(start * 1000000), side="left")
+            if end is not None:
+                hi = np.searchsorted(seg.ts, int(end * 1000000), side="left")
+            if hi > lo:
+                parts.append((seg, lo, hi))
+
+        names = fields if fields is not None else FIELDS
+        if len(parts) == 1:
+            seg, lo, hi = parts[0]
+            out = {"ts": seg.ts[lo:hi], "valid": seg.valid_bits[lo:hi]}
+            for field in names:
+                out[field] = seg.columns[field][lo:hi]
+            return out
+        out = {
+            "ts": np.concatenate([s.ts[lo:hi] for s, lo, hi in parts] or
+                                 [np.zeros(0, "<i8")]),
+            "valid": np.concatenate([s.valid_bits[lo:hi] for s, lo, hi in parts] or
+                                    [np.zeros(0, "<u4")]),
+        }
+        for field in names:
+            out[field] = np.concatenate([s.columns[field][lo:hi] for s, lo, hi in parts]
+                                        or [np.zeros(0, "<f4")])
+        return out
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - store-and-forward Weather Underground uploader
+
+    Readings are put on an on-disk queue (SQLite, so it survives restarts
+    and power cuts) and a background thread sends them to WU in the order
+    they were taken, over one keep-alive HTTP connection. When WU or the
+    network is down the thread backs off exponentially and then drains the
+    backlog once it comes back. Each reading is sent with the time it was
+    taken (dateutc), not "now".
+
+    The queue is capped at max_items; past that the oldest readings are
+    dropped. Only one reading is held in memory at a time.
+
+    Given a Checkpoint, every reading WU acks or rejects is recorded there
+    by station and dateutc, the same record backfill.py keeps, so a
+    backfill over a live period skips what the uploader already sent.
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import calendar
+import datetime
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlencode, urlsplit
+except ImportError:
+    # Python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib import urlencode
+    from urlparse import urlsplit
+
+from scheduler import monotonic
+
+# the weather underground URL used to upload weather data
+WU_URL = "http://weatherstation.wunderground.com/weatherstation/updateweatherstation.php"
+
+# checkpoint outcomes
+SENT, REJECTED = "sent", "rejected"
+
+
+def wu_params(station_id, station_key, temp_f, dew_ptf, humidity, pressure,
+              when=None, altitude=None):
+    """ Build the WU 'updateraw' parameters, skipping readings we don't have
+
+    pressure is what the station reads (inHg); given the station's altitude
+    (metres) it goes to WU reduced to sea level.
+    """
+    # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
+    # link is broken, some bindings can be found here:
+    # https://www.openhab.org/addons/bindings/weatherunderground/
+    if when is None:
+        when = datetime.datetime.utcnow()
+    if altitude is not None and _have(pressure):
+        # meteo needs NumPy, so only when there's an altitude to correct for
+        from meteo import sea_level_pressure_inhg
+        if _have(temp_f):
+            pressure = sea_level_pressure_inhg(pressure, altitude, temp_f)
+        else:
+            pressure = sea_level_pressure_inhg(pressure, altitude)
+        pressure = round(pressure, 2)
+    params = {
+        "action": "updateraw",
+        "ID": station_id,
+        "PASSWORD": station_key,
+        "dateutc": when.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    readings = {
+        "tempf": temp_f,
+        "dewptf": dew_ptf,
+        "humidity": humidity,
+        "baromin": pressure,
+    }
+    for key, value in readings.items():
+        if _have(value):
+            params[key] = str(value)
+    return params
+
+
+def taken_at(params):
+    """ Epoch second of the reading in a wu_params() dict, from its dateutc """
+    return calendar.timegm(time.strptime(params["dateutc"], "%Y-%m-%d %H:%M:%S"))
+
+
+def _have(value):
+    # a sensor that never gave a good read shows up as [] or None,
+    # a gap in a compressed stream (compression.py) as NaN
+    return not (value is None or value == [] or value != value)
+
+
+class DiskQueue(object):
+    """ FIFO of JSON-able items in a SQLite file, capped at max_items """
+
+    def __init__(self, path, max_items=100000):
+        self.path = path
+        self.max_items = max_items
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS queue ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, item TEXT)")
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def put(self, item):
+        self.put_many([item])
+
+    def put_many(self, items):
+        with self._lock:
+            self._db.executemany("INSERT INTO queue (item) VALUES (?)",
+                                 [(json.dumps(item),) for item in items])
+            count = self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+            excess = count - self.max_items
+            if excess > 0:
+                self._db.execute("DELETE FROM queue WHERE id IN "
+                                 "(SELECT id FROM queue ORDER BY id LIMIT ?)",
+                                 (excess,))
+                self.dropped += excess
+            self._db.commit()
+
+    def peek(self, n=1):
+        """ Oldest n items as (id, item) pairs, left on the queue """
+        with self._lock:
+            rows = self._db.execute("SELECT id, item FROM queue ORDER BY id "
+                                    "LIMIT ?", (n,)).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, ids):
+        """ Remove items once they've been delivered """
+        with self._lock:
+            self._db.executemany("DELETE FROM queue WHERE id = ?",
+                                 [(i,) for i in ids])
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Checkpoint(object):
+    """ The readings of one station that WU has acked or rejected, in SQLite """
+
+    def __init__(self, path, station):
+        self.path = path
+        self.station = station
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sent (station TEXT, ts INTEGER, "
+                         "outcome TEXT, PRIMARY KEY (station, ts))")
+        self._db.commit()
+
+    def done(self, start=None, end=None):
+        """ Epoch seconds already dealt with in [start, end) """
+        rows = self._db.execute(
+            "SELECT ts FROM sent WHERE station = ? AND ts >= ? AND ts < ?",
+            (self.station, int(start or 0), int(end or 2 ** 62)))
+        return set(row[0] for row in rows)
+
+    def mark(self, outcomes):
+        """ Record (epoch second, outcome) pairs """
+        self._db.executemany("INSERT OR REPLACE INTO sent VALUES (?, ?, ?)",
+                             [(self.station, ts, outcome) for ts, outcome in outcomes])
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class WUConnection(object):
+    """ One kept-alive HTTP(S) connection to the upload URL, opened on demand """
+
+    def __init__(self, url=WU_URL, timeout=10.0):
+        parts = urlsplit(url)
+        self.timeout = timeout
+        self._scheme = parts.scheme
+        self._host = parts.netloc
+        self._path = parts.path or "/"
+        self._conn = None
+
+    def _connect(self):
+        if self._scheme == "https":
+            return HTTPSConnection(self._host, timeout=self.timeout)
+        return HTTPConnection(self._host, timeout=self.timeout)
+
+    def send(self, params):
+        """ One GET of the parameters, returns (status, body) """
+        if self._conn is None:
+            self._conn = self._connect()
+        self._conn.request("GET", self._path + "?" + urlencode(params))
+        response = self._conn.getresponse()
+        # read the whole body or the connection can't be reused
+        body = response.read()
+        if response.getheader("connection", "").lower() == "close":
+            self.close()
+        return response.status, body
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class WUUploader(threading.Thread):
+    """ Drains a DiskQueue of WU parameter dicts to the upload URL in order """
+
+    def __init__(self, queue, url=WU_URL, timeout=10.0, backoff_min=2.0,
+                 backoff_max=600.0, checkpoint=None):
+        super(WUUploader, self).__init__(name="wu-uploader")
+        self.daemon = True
+        self.queue = queue
+        # optional Checkpoint of what WU has taken, shared with backfill.py
+        self.checkpoint = checkpoint
+        self.url = url
+        self.timeout = timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._http = WUConnection(url, timeout)
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self.sent = 0
+        self.rejected = 0
+        self.failures = 0
+        self.last_error = None
+        # optional observer(seconds, HTTP status or None) after every send
+        self.observer = None
+
+    def put(self, params):
+        """ Queue one reading and wake the uploader """
+        self.queue.put(params)
+        self.wake()
+
+    def wake(self):
+        """ Tell the uploader there's something new on the queue """
+        self._wake.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def backlog(self):
+        return len(self.queue)
+
+    def send(self, params):
+        """ One GET on the kept-alive connection, returns (status, body) """
+        return self._http.send(params)
+
+    def run(self):
+        delay = 0.0
+        while not self._stop_event.is_set():
+            items = self.queue.peek(1)
+            if not items:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            item_id, params = items[0]
+            start = monotonic()
+            try:
+                status, body = self.send(params)
+            except (HTTPException, IOError, OSError) as err:
+                self._http.close()
+                status, body = None, None
+                self.last_error = repr(err)
+            if self.observer is not None:
+                self.observer(monotonic() - start, status)
+
+            if status is not None and 200 <= status < 300:
+                self._done(item_id, params, SENT)
+                self.sent += 1
+                delay = 0.0
+                continue
+            if status is not None and 400 <= status < 500 and status not in (408, 429):
+                # WU won't ever take this one (bad ID/key, bad params)
+                print("WU rejected upload:", status, body, file=sys.stderr)
+                self._done(item_id, params, REJECTED)
+                self.rejected += 1
+                continue
+
+            # server or network trouble: keep the item and back off
+            self.failures += 1
+            if status is not None:
+                self.last_error = "HTTP {}".format(status)
+            delay = min(self.backoff_max, max(self.backoff_min, delay * 2))
+            # a little jitter so a fleet of stations doesn't retry in step
+            self._stop_event.wait(delay * (0.5 + random.random() / 2))
+        self._http.close()
+
+    def _done(self, item_id, params, outcome):
+        # checkpointed before the ack: a crash in between only means the
+        # reading is sent twice, never that backfill skips one WU lacks
+        if self.checkpoint is not None:
+            self.checkpoint.mark([(taken_at(params), outcome)])
+        self.queue.ack([item_id])
+
+    def stats(self):
+        return {
+            "backlog": self.backlog(),
+            "sent": self.sent,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "dropped": self.queue.dropped,
+            "last_error": self.last_error,
+        }
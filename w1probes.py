@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+******************************************************************************
+    Pi Weather Station - DS18B20 probes on the 1-Wire bus
+
+    Every temperature probe on every 1-Wire master is found under
+    /sys/bus/w1/devices and known by its device id (28-0316a2794cff),
+    which never changes, plus an optional name ("outdoor", "soil").
+
+    A DS18B20 takes ~750 ms to convert a temperature. Reading N probes
+    one after another costs N conversions; instead ProbeSet.read_all()
+    writes "trigger" to each master's therm_bulk_read so all probes
+    convert at once, waits for them, then reads every probe in parallel.
+    On kernels without therm_bulk_read each probe converts on its own
+    read, still in parallel.
+
+    A reading with a bad CRC is retried up to max_retries times, then the
+    probe reports a SensorError for this tick. The w1_slave files stay
+    open between reads (sysfs_readers.SysfsReader).
+
+    fake_bus() builds a sysfs tree with probes in it for testing.
+
+    usage: w1probes.py [SYSFS_ROOT]   (reads every probe found)
+
+******************************************************************************
+"""
+from __future__ import print_function, division
+
+import glob
+import os
+import sys
+import threading
+import time
+
+from acquisition import SensorError
+from scheduler import monotonic
+from sysfs_readers import SysfsReader
+
+SYSFS_ROOT = "/sys"
+# 1-Wire family codes of the temperature sensors the w1-therm driver handles
+THERM_FAMILIES = ("10", "22", "28", "3b", "42")
+# 12-bit conversion time plus some slack
+CONVERSION_TIMEOUT = 1.0  # seconds
+
+
+def devices_dir(sysfs_root=SYSFS_ROOT):
+    return os.path.join(sysfs_root, "bus", "w1", "devices")
+
+
+def parse_w1_slave(lines):
+    """ Temperature (C) from w1_slave's two lines, None if the CRC failed """
+    if len(lines) < 2 or lines[0].strip()[-3:] != "YES":
+        return None
+    equals_pos = lines[1].find("t=")
+    if equals_pos == -1:
+        return None
+    return float(lines[1][equals_pos + 2:]) / 1000.0
+
+
+class Probe(object):
+    """ One temperature probe, read through its w1_slave file """
+
+    def __init__(self, device_id, path, name=None, max_retries=3, retry_delay=0.2):
+        self.device_id = device_id
+        self.path = path
+        self.name = name or device_id
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.reads = 0
+        self.crc_errors = 0
+        self.failures = 0
+        self.latency = 0.0
+        self.reader = SysfsReader(os.path.join(path, "w1_slave"), name=self.name)
+
+    def read_raw(self):
+        return self.reader.read_text().splitlines()
+
+    def read(self):
+        """ Temperature in C, raises SensorError once the retries run out """
+        start = monotonic()
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    time.sleep(self.retry_delay)
+                temp_c = parse_w1_slave(self.read_raw())
+                if temp_c is not None:
+                    self.reads += 1
+                    return temp_c
+                self.crc_errors += 1
+            self.failures += 1
+            raise SensorError("{}: bad CRC {} times".format(
+                self.name, self.max_retries + 1))
+        finally:
+            self.latency = monotonic() - start
+
+    def __repr__(self):
+        return "Probe({!r}, {!r})".format(self.device_id, self.name)
+
+
+def discover(sysfs_root=SYSFS_ROOT, names=None, **probe_options):
+    """ Every temperature probe on the bus, sorted by device id
+
+    names maps a device id to a friendly name.
+    """
+    names = names or {}
+    probes = []
+    for path in sorted(glob.glob(os.path.join(devices_dir(sysfs_root), "*-*"))):
+        device_id = os.path.basename(path)
+        if device_id.split("-")[0].lower() not in THERM_FAMILIES:
+            continue
+        probes.append(Probe(device_id, path, names.get(device_id), **probe_options))
+    return probes
+
+
+class ProbeSet(object):
+    """ All the probes, converted together and read in parallel
+
+    primary names the probe read() returns (the first one by default).
+    """
+
+    def __init__(self, sysfs_root=SYSFS_ROOT, names=None, primary=None,
+                 bulk=True, conversion_timeout=CONVERSION_TIMEOUT, **probe_options):
+        self.sysfs_root = sysfs_root
+        self.probes = discover(sysfs_root, names, **probe_options)
+        if not self.probes:
+            raise SensorError("no 1-Wire temperature probes under " +
+                              devices_dir(sysfs_root))
+        self.primary = primary or self.probes[0].name
+        if self.primary not in [p.name for p in self.probes]:
+            raise SensorError("no probe named " + self.primary)
+        self.conversion_timeout = conversion_timeout
+        self.masters = []
+        if bulk:
+            self.masters = [SysfsReader(path, name=path.split(os.sep)[-2])
+                            for path in sorted(glob.glob(os.path.join(
+                                devices_dir(sysfs_root), "w1_bus_master*",
+                                "therm_bulk_read")))]
+        self.conversion_time = 0.0
+
+    def _convert_all(self):
+        """ Start a conversion on every master and wait for it to finish """
+        start = monotonic()
+        for master in self.masters:
+            with open(master.path, "w") as f:
+                f.write("trigger\n")
+        deadline = start + self.conversion_timeout
+        while monotonic() < deadline:
+            if not any(_bulk_status(master) == -1 for master in self.masters):
+                break
+            time.sleep(0.05)
+        self.conversion_time = monotonic() - start
+
+    def read_all(self):
+        """ {probe name: temperature C, or the SensorError it raised} """
+        if self.masters:
+            self._convert_all()
+        results = {}
+
+        def read(probe):
+            try:
+                results[probe.name] = probe.read()
+            except (SensorError, IOError, OSError, ValueError) as e:
+                results[probe.name] = e if isinstance(e, SensorError) else \
+                    SensorError("{}: {}".format(probe.name, e))
+
+        threads = [threading.Thread(target=read, args=(probe,))
+                   for probe in self.probes[1:]]
+        for thread in threads:
+            thread.start()
+        # the calling thread takes the first probe itself
+        read(self.probes[0])
+        for thread in threads:
+            thread.join()
+        return results
+
+    def read(self):
+        """ The primary probe's temperature in C """
+        value = self.read_all()[self.primary]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def readers(self):
+        return self.masters + [p.reader for p in self.probes]
+
+    def stats(self):
+        return dict((p.name, {"id": p.device_id, "reads": p.reads,
+                              "crc_errors": p.crc_errors, "failures": p.failures,
+                              "latency": p.latency})
+                    for p in self.probes)
+
+
+def _bulk_status(master):
+    """ therm_bulk_read: -1 converting, 1 done, 0 nothing pending """
+    try:
+        return int(master.read_bytes().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# ============================================================================
+# FAKE BUS
+# ============================================================================
+
+def write_w1_slave(path, temp_c, crc_ok=True):
+    """ Write a w1_slave file the way the w1-therm driver formats it """
+    raw = int(round(temp_c * 16)) & 0xffff
+    data = "{:02x} {:02x} 4b 46 7f ff 0c 10 1c".format(raw & 0xff, raw >> 8)
+    text = "{} : crc=1c {}\n{} t={}\n".format(
+        data, "YES" if crc_ok else "NO", data, int(round(temp_c * 1000)))
+    # overwritten in place, then cut to length: a probe reading it meanwhile
+    # (the simulator rewrites it under them) never sees an empty file
+    with open(path, "r+" if os.path.exists(path) else "w") as f:
+        f.write(text)
+        f.truncate()
+
+
+def fake_bus(root, probes, bulk=True):
+    """ A sysfs tree under root with probes ({device id: temp C}) on one master """
+    base = devices_dir(root)
+    master = os.path.join(base, "w1_bus_master1")
+    if not os.path.isdir(master):
+        os.makedirs(master)
+    if bulk:
+        with open(os.path.join(master, "therm_bulk_read"), "w") as f:
+            f.write("0\n")
+    for device_id, temp_c in probes.items():
+        folder = os.path.join(base, device_id)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        write_w1_slave(os.path.join(folder, "w1_slave"), temp_c)
+    return root
+
+
+def main():
+    probes = ProbeSet(sys.argv[1] if len(sys.argv) > 1 else SYSFS_ROOT)
+    start = monotonic()
+    results = probes.read_all()
+    took = monotonic() - start
+    stats = probes.stats()
+    for probe in probes.probes:
+        value = results[probe.name]
+        print("{:<18} {:<12} {:>8} {:6.0f} ms".format(
+            probe.device_id, probe.name,
+            "error" if isinstance(value, Exception) else "{:.3f}".format(value),
+            stats[probe.name]["latency"] * 1000))
+    print("{} probes in {:.0f} ms ({:.0f} ms converting)".format(
+        len(probes.probes), took * 1000, probes.conversion_time * 1000))
+
+
+if __name__ == "__main__":
+    main()